@@ -5,9 +5,11 @@ calibrated data, and check the flags after final calibration.
 
 import copy
 
-from casatasks import flagdata, applycal
+from casatasks import applycal
 
 from . import pipeline_save
+from .flagledger import get_flag_ledger
+from .flagversions import get_flag_versions
 from .utils import logprint, runtiming
 
 
@@ -19,15 +21,8 @@ task_logprint("*** Starting EVLA_pipe_applycals.py ***")
 time_list = runtiming("applycals", "start")
 QA2_applycals = "Pass"
 
-myinitialflags = flagdata(
-    vis=ms_active,
-    mode="summary",
-    spwchan=True,
-    spwcorr=True,
-    basecnt=True,
-    action="calculate",
-    savepars=False,
-)
+flag_ledger = get_flag_ledger(ms_active)
+myinitialflags = flag_ledger.summary()
 task_logprint("Finished flags summary before final applycal.")
 
 
@@ -39,6 +34,12 @@ FinalGainTables.append("finalampgaincal.g")
 FinalGainTables.append("finalphasegaincal.g")
 ntables = len(FinalGainTables)
 
+flag_versions = get_flag_versions(ms_active)
+flag_versions.save(
+    flag_versions.next_name("applycal"),
+    comment="Flags autosave before applycal",
+)
+
 applycal(
     vis=ms_active,
     field="",
@@ -52,19 +53,11 @@ applycal(
     parang=False,
     calwt=[False] * ntables,
     applymode="calflagstrict",
-    flagbackup=True,
+    flagbackup=False,
 )
 
 
-myinitialflags = flagdata(
-    vis=ms_active,
-    mode="summary",
-    spwchan=True,
-    spwcorr=True,
-    basecnt=True,
-    action="calculate",
-    savepars=False,
-)
+myinitialflags = flag_ledger.summary()
 task_logprint("Finished flags summary after final applycal.")
 
 
@@ -3,9 +3,9 @@ Check flagging of bandpass and delay calibrators using `rflag` mode
 of `flagdata`.
 """
 
-from casatasks import flagdata
-
 from . import pipeline_save
+from .flagledger import track_flags
+from .rflag import run_rflag
 from .utils import logprint, runtiming
 
 
@@ -24,23 +24,30 @@ if bandpass_field_select_string != delay_field_select_string:
     checkflagfields += "," + delay_field_select_string
 
 # Run only on the bandpass and delay calibrators - testgainscans
-flagdata(
-    vis=ms_active,
-    mode="rflag",
-    field=checkflagfields,
-    correlation="ABS_" + corrstring,
-    scan=testgainscans,
-    ntime="scan",
-    combinescans=False,
-    datacolumn="corrected",
-    winsize=3,
-    timedevscale=4.0,
-    freqdevscale=4.0,
-    extendflags=False,
-    action="apply",
-    display="",
-    flagbackup=False,
-    savepars=True,
+with track_flags(ms_active, scan=testgainscans):
+    screened = run_rflag(
+        ms_active,
+        field=checkflagfields,
+        correlation="ABS_" + corrstring,
+        scan=testgainscans,
+        ntime="scan",
+        combinescans=False,
+        datacolumn="corrected",
+        winsize=3,
+        timedevscale=4.0,
+        freqdevscale=4.0,
+        extendflags=False,
+        display="",
+        flagbackup=False,
+        savepars=True,
+        prescreen=True,
+        engine=rflag_engine,
+        report="logs/checkflag_prescreen.txt",
+    )
+
+nskipped = sum(not entry["rflag"] for entry in screened)
+task_logprint(
+    f"rflag skipped on {nskipped} of {len(screened)} clean spw/scan selections"
 )
 
 # Until we know what the QA criteria are for this script, leave QA2
@@ -2,9 +2,9 @@
 Check flagging of all calibrators using `rflag` mode of `flagdata`.
 """
 
-from casatasks import flagdata
-
 from . import pipeline_save
+from .flagledger import track_flags
+from .rflag import run_rflag
 from .utils import logprint, runtiming
 
 
@@ -18,23 +18,30 @@ QA2_checkflag_semiFinal = "Pass"
 
 task_logprint("Checking RFI flagging of all calibrators")
 
-flagdata(
-    vis=ms_active,
-    mode="rflag",
-    field=calibrator_field_select_string,
-    correlation="ABS_" + corrstring,
-    scan=calibrator_scan_select_string,
-    ntime="scan",
-    combinescans=False,
-    datacolumn="corrected",
-    winsize=3,
-    timedevscale=4.0,
-    freqdevscale=4.0,
-    extendflags=False,
-    action="apply",
-    display="",
-    flagbackup=False,
-    savepars=True,
+with track_flags(ms_active, scan=calibrator_scan_select_string):
+    screened = run_rflag(
+        ms_active,
+        field=calibrator_field_select_string,
+        correlation="ABS_" + corrstring,
+        scan=calibrator_scan_select_string,
+        ntime="scan",
+        combinescans=False,
+        datacolumn="corrected",
+        winsize=3,
+        timedevscale=4.0,
+        freqdevscale=4.0,
+        extendflags=False,
+        display="",
+        flagbackup=False,
+        savepars=True,
+        prescreen=True,
+        engine=rflag_engine,
+        report="logs/checkflag_semiFinal_prescreen.txt",
+    )
+
+nskipped = sum(not entry["rflag"] for entry in screened)
+task_logprint(
+    f"rflag skipped on {nskipped} of {len(screened)} clean spw/scan selections"
 )
 
 # Until we know what the QA criteria are for this script, leave QA2
@@ -7,12 +7,21 @@ import copy
 import numpy as np
 import scipy as sp
 
-from casatasks import rmtables, gaincal, bandpass, flagdata, applycal, split, setjy
+from casatasks import rmtables, gaincal, bandpass, flagdata, applycal, setjy
 from casatools import table
-from casaplotms import plotms
 
 from . import pipeline_save
-from .utils import logprint, runtiming, RefAntHeuristics
+from .calplot import plot_caltable
+from .calsubset import CalibratorSubset
+from .flagledger import track_flags
+from .utils import (
+        logprint,
+        runtiming,
+        RefAntHeuristics,
+        getCalFlaggedSoln,
+        getCalAmpPhaseMax,
+        CalSolutionCube,
+)
 
 tb = table()
 
@@ -228,42 +237,29 @@ AllCalTables.append("averagephasegain.g")
 
 ntables = len(AllCalTables)
 
-applycal(
-    vis=ms_active,
-    field="",
-    spw="",
-    selectdata=True,
-    scan=calibrator_scan_select_string,
-    docallib=False,
-    gaintable=AllCalTables,
-    interp=[""],
-    spwmap=[],
-    calwt=[False] * ntables,
-    parang=False,
-    applymode="calflagstrict",
-    flagbackup=False,
-)
+with track_flags(ms_active, scan=calibrator_scan_select_string):
+    applycal(
+        vis=ms_active,
+        field="",
+        spw="",
+        selectdata=True,
+        scan=calibrator_scan_select_string,
+        docallib=False,
+        gaintable=AllCalTables,
+        interp=[""],
+        spwmap=[],
+        calwt=[False] * ntables,
+        parang=False,
+        applymode="calflagstrict",
+        flagbackup=False,
+    )
 
 
-os.system("rm -rf calibrators.ms")
-split(
-    vis=ms_active,
-    outputvis="calibrators.ms",
-    datacolumn="corrected",
-    field="",
-    spw="",
-    width=int(max(channels)),
-    antenna="",
-    timebin="0s",
-    timerange="",
-    scan=calibrator_scan_select_string,
-    intent="",
-    array="",
-    uvrange="",
-    correlation="",
-    observation="",
-    keepflags=False,
+# Bring calibrators.ms up to date with the final calibration applied above
+calibrator_subset = CalibratorSubset(
+    ms_active, calibrator_scan_select_string, int(max(channels)),
 )
+task_logprint(f"Calibrator MS {calibrator_subset.update(clear_models=True)}")
 
 
 # FIXME The code from here until the `setjy`-loop is duplicated from `fluxboot`
@@ -484,220 +480,76 @@ gaincal(
 task_logprint("Final calibration tables created")
 
 
-try:
-    tb.open("finaldelay.k")
-    fpar = tb.getcol("FPARAM")
-finally:
-    tb.close()
-delays = np.abs(fpar)
-maxdelay = np.max(delays)
+maxdelay = CalSolutionCube.from_caltable("finaldelay.k").max_amp()
 
 
 task_logprint("Plotting final calibration tables")
-nplots = int(numAntenna / 3)
-if (numAntenna % 3) > 0:
-    nplots += 1
-
-for ii in range(nplots):
-    plotfile = f"finaldelay{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    plotms(
-        vis="finaldelay.k",
-        xaxis="freq",
-        yaxis="delay",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
-        plotrange=[],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
 
-for ii in range(nplots):
-    plotfile = f"finalBPinitialgainphase{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    plotms(
-        vis="finalBPinitialgain.g",
+plot_caltable("finaldelay.k", numAntenna, [
+    dict(prefix="finaldelay", xaxis="freq", yaxis="delay"),
+])
+
+plot_caltable("finalBPinitialgain.g", numAntenna, [
+    dict(
+        prefix="finalBPinitialgainphase",
         xaxis="time",
         yaxis="phase",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, -180, 180],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
+    ),
+])
 
-try:
-    tb.open("finalBPcal.b")
-    dataVarCol = tb.getvarcol("CPARAM")
-    flagVarCol = tb.getvarcol("FLAG")
-finally:
-    tb.close()
-rowlist = dataVarCol.keys()
-nrows = len(rowlist)
-maxmaxamp = 0.0
-maxmaxphase = 0.0
-
-for rrow in rowlist:
-    dataArr = dataVarCol[rrow]
-    flagArr = flagVarCol[rrow]
-    amps = np.abs(dataArr)
-    phases = np.arctan2(np.imag(dataArr), np.real(dataArr))
-    good = np.logical_not(flagArr)
-    tmparr = amps[good]
-    if len(tmparr) > 0:
-        maxamp = np.max(amps[good])
-        if maxamp > maxmaxamp:
-            maxmaxamp = maxamp
-    tmparr = np.abs(phases[good])
-    if len(tmparr) > 0:
-        maxphase = np.max(np.abs(phases[good])) * 180.0 / np.pi
-        if maxphase > maxmaxphase:
-            maxmaxphase = maxphase
-ampplotmax = maxmaxamp
-phaseplotmax = maxmaxphase
-
-for ii in range(nplots):
-    plotfile = f"finalBPcal_amp{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    plotms(
-        vis="finalBPcal.b",
+ampplotmax, phaseplotmax = getCalAmpPhaseMax("finalBPcal.b")
+
+plot_caltable("finalBPcal.b", numAntenna, [
+    dict(
+        prefix="finalBPcal_amp",
         xaxis="freq",
         yaxis="amp",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, 0, ampplotmax],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
-
-for ii in range(nplots):
-    plotfile = f"finalBPcal_phase{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    plotms(
-        vis="finalBPcal.b",
+    ),
+    dict(
+        prefix="finalBPcal_phase",
         xaxis="freq",
         yaxis="phase",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, -phaseplotmax, phaseplotmax],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
+    ),
+])
 
-for ii in range(nplots):
-    plotfile = f"phaseshortgaincal{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    plotms(
-        vis="phaseshortgaincal.g",
+plot_caltable("phaseshortgaincal.g", numAntenna, [
+    dict(
+        prefix="phaseshortgaincal",
         xaxis="time",
         yaxis="phase",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, -180, 180],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
+    ),
+])
 
-try:
-    tb.open("finalampgaincal.g")
-    cpar = tb.getcol("CPARAM")
-    flgs = tb.getcol("FLAG")
-finally:
-    tb.close()
-amps = np.abs(cpar)
-good = np.logical_not(flgs)
-maxamp = np.max(amps[good])
+maxamp, _ = getCalAmpPhaseMax("finalampgaincal.g")
 plotmax = max(2.0, maxamp)
 
-for ii in range(nplots):
-    plotfile = f"finalamptimecal{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    plotms(
-        vis="finalampgaincal.g",
+plot_caltable("finalampgaincal.g", numAntenna, [
+    dict(
+        prefix="finalamptimecal",
         xaxis="time",
         yaxis="amp",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, 0, plotmax],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
-
-for ii in range(nplots):
-    plotfile = f"finalampfreqcal{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    plotms(
-        vis="finalampgaincal.g",
+    ),
+    dict(
+        prefix="finalampfreqcal",
         xaxis="freq",
         yaxis="amp",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, 0, plotmax],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
+    ),
+])
 
-for ii in range(nplots):
-    plotfile = f"finalphasegaincal{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    plotms(
-        vis="finalphasegaincal.g",
+plot_caltable("finalphasegaincal.g", numAntenna, [
+    dict(
+        prefix="finalphasegaincal",
         xaxis="time",
         yaxis="phase",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, -180, 180],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
+    ),
+])
 
 
 # Calculate fractions of flagged solutions for final QA2
@@ -1,12 +1,19 @@
 """
 Determine bad deformatters in the MS and flag them.  Looks for bandpass
-solutions that have small ratio of min/max amplitudes.
+solutions that have small ratio of min/max amplitudes or a large range of
+phases.
 """
 
+import numpy as np
+
 from casatasks import flagdata
+from casatools import table
 
 from . import pipeline_save
-from .utils import logprint, runtiming, getBCalStatistics
+from .flagcmds import compile_commands
+from .flagledger import track_flags
+from .flagversions import get_flag_versions
+from .utils import logprint, runtiming, CalSolutionCube
 
 
 def task_logprint(msg):
@@ -18,32 +25,94 @@ time_list = runtiming("flag_baddeformatters", "start")
 QA2_flag_baddeformatters = "Pass"
 
 
-def flag_on_deformatters(
+DEFORMATTER_TESTS = (
+    dict(
         testq="amp",
         tstat="rat",
-        doprintall=True,
         testlimit=0.15,
         testunder=True,
+        flagreason="bad_deformatters_amp or RFI",
+    ),
+    dict(
+        testq="phase",
+        tstat="diff",
+        testlimit=50,
+        testunder=False,
+        flagreason="bad_deformatters_phase or RFI",
+    ),
+)
+
+
+def spw_test_values(cube, inner, testq="amp", tstat="rat", testunder=True):
+    """
+    Value of the statistic `tstat` of the quantity `testq` over the `inner`
+    channels for each antenna and spw of `cube`, taking the extreme over the
+    polarizations (the minimum if `testunder`, otherwise the maximum).  NaN
+    where no polarization has unflagged channels.
+    """
+    if testq == "amp":
+        values = cube.amp()
+    elif testq == "phase":
+        values = cube.phase(deg=True)
+    elif testq == "real":
+        values = cube.data.real
+    else:
+        values = cube.data.imag
+    number, stats = cube.stats(values, keep=("antenna", "spw", "pol"), channels=inner)
+    if tstat == "rat":
+        tval = np.divide(
+                stats["min"], stats["max"],
+                out=np.zeros_like(stats["min"]), where=stats["max"] != 0.0,
+        )
+    elif tstat == "diff":
+        tval = stats["max"] - stats["min"]
+    else:
+        # simple test on quantity
+        tval = stats[tstat]
+    tval = np.where(number > 0, tval, np.nan)
+    # `fmin`/`fmax` skip NaN and give NaN only when all polarizations are.
+    extremum = np.fmin if testunder else np.fmax
+    return extremum.reduce(tval, axis=2)
+
+
+def antenna_flag_commands(antNames, flagmask):
+    """
+    Minimized `flagdata` list-mode commands flagging the spws of each
+    antenna in the (nant, nspw) `flagmask`.
+    """
+    commands = []
+    for iant in np.flatnonzero(flagmask.any(axis=1)):
+        spwstr = ",".join(str(ispw) for ispw in np.flatnonzero(flagmask[iant]))
+        commands.append(f"mode='manual' antenna='{antNames[iant]}' spw='{spwstr}'")
+    return compile_commands(commands)
+
+
+def flag_on_deformatters(
+        tests=DEFORMATTER_TESTS,
+        doprintall=True,
         nspwlimit=4,
         doflagundernspwlimit=True,
         doflagemptyspws=False,
         calBPtablename="testBPcal.b",
-        flagreason="bad_deformatters_amp or RFI",
     ):
     """
     Parameters
     ----------
-    testq : string, default "amp"
-        Which quantity to test? Valid: ["amp", "phase", "real", "imag"]
-    tstat : string, default "rat"
-        Which stat to use? Valid: ['min','max','mean','var'] or
-        'rat'=min/max or 'diff'=max-min.
+    tests : iterable of dict
+        Criteria, each with the keys:
+        testq : string
+            Which quantity to test? Valid: ["amp", "phase", "real", "imag"]
+        tstat : string
+            Which stat to use? Valid: ['min','max','mean','var'] or
+            'rat'=min/max or 'diff'=max-min.
+        testlimit : number
+            Flag values under or over this limit.
+        testunder : bool
+            If true, test under the limit, otherwise test over.
+        flagreason : string
+            Description of the criterion for the log.
     doprintall : string, default True
         Print detailed flagging stats
-    testlimit : number
-        Flag values under or over this limit.
-    testunder : bool
-        If true, test under the limit, otherwise test over.
     nspwlimit : integer, default 4
         Number of spw per baseband to trigger flagging entire baseband.
     doflagundernspwlimit : bool, default True
@@ -52,24 +121,23 @@ def flag_on_deformatters(
         Flag data for spws with no unflagged channel solutions in any poln?
     calBPtablename : string, default "testBPcal.b"
         Calibration table to apply to.
-    flagreason : string
-        Comment for flags passed to `flagdata`.
     """
-    assert testq in ("amp", "phase", "real", "imag")
-    assert tstat in ("amp", "phase", "real", "imag", "rat", "diff")
+    for test in tests:
+        assert test["testq"] in ("amp", "phase", "real", "imag")
+        assert test["tstat"] in ("min", "max", "mean", "var", "rat", "diff")
     # Print input values to logger
-    task_logprint(f"Testing on quantity: {testq}")
-    task_logprint(f"Using statistic: {tstat}")
-    if testunder:
-        task_logprint(f"Flagging values under limit = {testlimit}")
-    else:
-        task_logprint(f"Flagging values over limit = {testlimit}")
+    for test in tests:
+        testq, tstat, testlimit = test["testq"], test["tstat"], test["testlimit"]
+        under = "under" if test["testunder"] else "over"
+        task_logprint(
+                f"Testing {testq} {tstat}: flagging values {under} limit = "
+                f"{testlimit} (REASON = {test['flagreason']})"
+        )
     task_logprint(f"Identifying basebands with more than {nspwlimit} bad spw")
     if doflagundernspwlimit:
         task_logprint(f"Identifying individual spw when less than {nspwlimit} bad spw")
     if doflagemptyspws:
         task_logprint("Identifying spw with no unflagged channels")
-    task_logprint(f"Using flag REASON = {flagreason}")
     # Actually flag the data based on the derived flags (or just report)?
     may_15_2012 = 56062.7
     if startdate <= may_15_2012:
@@ -80,110 +148,88 @@ def flag_on_deformatters(
         task_logprint("Will flag data based on what we found")
     else:
         task_logprint("Will NOT flag data based on what we found (just report)")
-    # Get bandpass calibrator statistics and begin calculations.
-    calBPstatresult = getBCalStatistics(calBPtablename)
-    flaglist = []
+    # Get bandpass calibrator solutions and begin calculations.
+    cube = CalSolutionCube.from_caltable(calBPtablename)
+    mytb = table()
+    try:
+        mytb.open(calBPtablename + "/ANTENNA")
+        antNameCol = mytb.getcol("NAME")
+    finally:
+        mytb.close()
+    try:
+        mytb.open(calBPtablename + "/SPECTRAL_WINDOW")
+        spwNameCol = mytb.getcol("NAME")
+    finally:
+        mytb.close()
+    nspw = len(spwNameCol)
+    antIds = cube.antennas
+    antNames = [antNameCol[iant] for iant in antIds]
+    # Rx band and baseband of each spw from the JVLA names "rxband#baseband#spw"
+    bandList = []
+    spwBand = np.zeros(nspw, dtype=int)
+    for ispw in range(nspw):
+        try:
+            (rx, bb, sb) = spwNameCol[ispw].split("#")
+        except ValueError:
+            rx, bb = "Unknown", "Unknown"
+        if (rx, bb) not in bandList:
+            bandList.append((rx, bb))
+        spwBand[ispw] = bandList.index((rx, bb))
+    nband = len(bandList)
+    # (nspw, nband) membership of every spw in the table
+    bandMembers = spwBand[:, None] == np.arange(nband)[None, :]
+    cubeBand = bandMembers[cube.spws]
+
+    inner = cube.inner_channels(0.1)
+    hasSoln = cube.present.any(axis=2)
+    if doprintall:
+        for ia, js in zip(*np.nonzero(~hasSoln)):
+            rx, bb = bandList[spwBand[cube.spws[js]]]
+            task_logprint(f"  Ant {antIds[ia]} ({antNames[ia]}) {rx} {bb} spw={cube.spws[js]} missing solution")
+    # (nant, nspw) spws to flag over all of the tests, in spw table order
+    flagmask = np.zeros((len(antIds), nspw), dtype=bool)
+    emptymask = np.zeros((len(antIds), nspw), dtype=bool)
+    for test in tests:
+        testq, tstat, testlimit = test["testq"], test["tstat"], test["testlimit"]
+        testval = spw_test_values(cube, inner, testq, tstat, test["testunder"])
+        valid = ~np.isnan(testval)
+        with np.errstate(invalid="ignore"):
+            if test["testunder"]:
+                bad = valid & (testval < testlimit)
+            else:
+                bad = valid & (testval > testlimit)
+        # these have no unflagged channels in any poln
+        emptymask[:, cube.spws] |= hasSoln & ~valid
+        if doprintall:
+            for ia, js in zip(*np.nonzero(bad)):
+                rx, bb = bandList[spwBand[cube.spws[js]]]
+                task_logprint(f"  Found Ant {antIds[ia]} ({antNames[ia]}) {rx} {bb} spw={cube.spws[js]} {testq} {tstat}={testval[ia, js]:6.4f}")
+        # Number of bad spws of each antenna in each baseband
+        nbadspws = bad.astype(int) @ cubeBand.astype(int)
+        badband = (nbadspws > 0) & (nbadspws >= nspwlimit)
+        # Flag all spw in the bad basebands
+        flagmask |= (badband.astype(int) @ bandMembers.T.astype(int)) > 0
+        for ia, kb in zip(*np.nonzero(badband)):
+            rx, bb = bandList[kb]
+            bbspws = np.flatnonzero(bandMembers[:, kb]).tolist()
+            task_logprint(f"Ant {antIds[ia]} ({antNames[ia]}) {rx} {bb} bad baseband spws={bbspws} ({testq} {tstat})")
+        if doflagundernspwlimit:
+            # Flag spws individually
+            single = bad & ~badband[:, spwBand[cube.spws]]
+            flagmask[:, cube.spws] |= single
+            for ia, kb in zip(*np.nonzero((single.astype(int) @ cubeBand.astype(int)) > 0)):
+                rx, bb = bandList[kb]
+                badspws = cube.spws[single[ia] & cubeBand[:, kb]].tolist()
+                task_logprint(f"Ant {antIds[ia]} ({antNames[ia]}) {rx} {bb} bad spws={badspws} ({testq} {tstat})")
+    for ia, kb in zip(*np.nonzero((emptymask.astype(int) @ bandMembers.astype(int)) > 0)):
+        rx, bb = bandList[kb]
+        flaggedspws = np.flatnonzero(emptymask[ia] & bandMembers[:, kb]).tolist()
+        task_logprint(f"Ant {antIds[ia]} ({antNames[ia]}) {rx} {bb} no unflagged solutions spws={flaggedspws}")
+    flaglist = antenna_flag_commands(antNames, flagmask)
     extflaglist = []
-    for iant in calBPstatresult["antband"].keys():
-        antName = calBPstatresult["antDict"][iant]
-        badspwlist = []
-        flaggedspwlist = []
-        for rrx in calBPstatresult["antband"][iant].keys():
-            for bband in calBPstatresult["antband"][iant][rrx].keys():
-                # List of spw in this baseband
-                spwl = calBPstatresult["rxBasebandDict"][rrx][bband]
-                nbadspws = 0
-                badspws = []
-                flaggedspws = []
-                if len(spwl) > 0:
-                    if doprintall:
-                        task_logprint(f" Ant {iant} ({antName}) {rrx} {bband} processing spws={spwl}")
-                    for ispw in spwl:
-                        testvalid = False
-                        if ispw in calBPstatresult["antspw"][iant]:
-                            for poln in calBPstatresult["antspw"][iant][ispw].keys():
-                                # Get stats of this ant/spw/poln
-                                inner_stats = calBPstatresult["antspw"][iant][ispw][poln]["inner"]
-                                nbp = inner_stats["number"]
-                                if nbp > 0:
-                                    if tstat == "rat":
-                                        bpmax = inner_stats[testq]["max"]
-                                        bpmin = inner_stats[testq]["min"]
-                                        if bpmax == 0.0:
-                                            tval = 0.0
-                                        else:
-                                            tval = bpmin / bpmax
-                                    elif tstat == "diff":
-                                        bpmax = inner_stats[testq]["max"]
-                                        bpmin = inner_stats[testq]["min"]
-                                        tval = bpmax - bpmin
-                                    else:
-                                        # simple test on quantity
-                                        tval = inner_stats[testq][tstat]
-                                    if not testvalid:
-                                        testval = tval
-                                        testvalid = True
-                                    elif testunder:
-                                        if tval < testval:
-                                            testval = tval
-                                    else:
-                                        if tval > testval:
-                                            testval = tval
-                            # Test on extrema of the polarizations for this ant/spw
-                            if not testvalid:
-                                # these have no unflagged channels in any poln
-                                flaggedspws.append(ispw)
-                            else:
-                                if (testunder and testval < testlimit) or (
-                                    not testunder and testval > testlimit
-                                ):
-                                    nbadspws += 1
-                                    badspws.append(ispw)
-                                    if doprintall:
-                                        task_logprint(f"  Found Ant {iant} ({antName}) {rrx} {bband} spw={ispw} {testq} {tstat}={testval:6.4f}")
-                        else:
-                            # this spw is missing from this antenna/rx
-                            if doprintall:
-                                task_logprint(f"  Ant {iant} ({antName}) {rrx} {bband} spw={ispw} missing solution")
-                # Test to see if this baseband should be entirely flagged
-                if nbadspws > 0 and nbadspws >= nspwlimit:
-                    # Flag all spw in this baseband
-                    bbspws = calBPstatresult["rxBasebandDict"][rrx][bband]
-                    badspwlist.extend(bbspws)
-                    task_logprint(f"Ant {iant} ({antName}) {rrx} {bband} bad baseband spws={bbspws}")
-                elif nbadspws > 0 and doflagundernspwlimit:
-                    # Flag spws individually
-                    badspwlist.extend(badspws)
-                    task_logprint(f"Ant {iant} ({antName}) {rrx} {bband} bad spws={badspws}\n")
-                if len(flaggedspws) > 0:
-                    # These spws have no unflagged channels in any pol
-                    flaggedspwlist.extend(flaggedspws)
-                    task_logprint(f"Ant {iant} ({antName}) {rrx} {bband} no unflagged solutions spws={flaggedspws}")
-        if len(badspwlist) > 0:
-            spwstr = ""
-            for ispw in badspwlist:
-                if spwstr == "":
-                    spwstr = str(ispw)
-                else:
-                    spwstr += "," + str(ispw)
-            reastr = flagreason
-            # Add entry for this antenna
-            # flagstr = "mode='manual' antenna='"+str(iant)+"' spw='"+spwstr+"' reason='"+reastr+"'"
-            # Use name for flagging
-            flagstr = f"mode='manual' antenna='{antName}' spw='{spwstr}'"
-            flaglist.append(flagstr)
-        if doflagemptyspws and len(flaggedspwlist) > 0:
-            spwstr = ""
-            for ispw in flaggedspwlist:
-                if spwstr == "":
-                    spwstr = str(ispw)
-                else:
-                    spwstr += "," + str(ispw)
-            # Add entry for this antenna
-            reastr = "no_unflagged_solutions"
-            # Use name for flagging
-            flagstr = f"mode='manual' antenna='{antName}' spw='{spwstr}'"
-            extflaglist.append(flagstr)
+    if doflagemptyspws:
+        extflaglist = antenna_flag_commands(antNames, emptymask & ~flagmask)
+        flagmask |= emptymask
     nflagcmds = len(flaglist) + len(extflaglist)
     if nflagcmds < 1:
         task_logprint("No bad basebands/spws found")
@@ -198,44 +244,33 @@ def flag_on_deformatters(
             flaglist.extend(extflaglist)
         if doflagdata:
             logprint("Flagging these in the ms:")
-            # Now flag with flaglist
-            flagdata(
-                vis=ms_active,
-                mode="list",
-                inpfile=flaglist,
-                action="apply",
-                flagbackup=True,
-                savepars=True,
+            # Now flag with flaglist, all tests in one pass
+            flagspws = np.flatnonzero(flagmask.any(axis=0)).tolist()
+            flag_versions = get_flag_versions(ms_active)
+            flag_versions.save(
+                    flag_versions.next_name("flagdata"),
+                    comment="Flags autosave before flagging bad deformatters",
             )
+            with track_flags(ms_active, spw=flagspws):
+                flagdata(
+                    vis=ms_active,
+                    mode="list",
+                    inpfile=flaglist,
+                    action="apply",
+                    flagbackup=False,
+                    savepars=True,
+                )
     return None
 
 
-task_logprint("Flag based on amplitudes.")
-flag_on_deformatters(
-    testq="amp",
-    tstat="rat",
-    doprintall=True,
-    testlimit=0.15,
-    testunder=True,
-    nspwlimit=4,
-    doflagundernspwlimit=True,
-    doflagemptyspws=False,
-    calBPtablename="testBPcal.b",
-    flagreason="bad_deformatters_amp or RFI",
-)
-
-task_logprint("Flag based on phase.")
+task_logprint("Flag based on amplitudes and phases.")
 flag_on_deformatters(
-    testq="phase",
-    tstat="diff",
+    tests=DEFORMATTER_TESTS,
     doprintall=True,
-    testlimit=50,
-    testunder=False,
     nspwlimit=4,
     doflagundernspwlimit=True,
     doflagemptyspws=False,
     calBPtablename="testBPcal.b",
-    flagreason="bad_deformatters_phase or RFI",
 )
 
 
@@ -1,14 +1,16 @@
 """
 Perform deterministic flagging using `flagdata` in list-mode: online flags,
-zeros, pointing scans, and quacking.
+shadowing, zeros, pointing and setup scans, quacking, and edge channels, all
+applied in one pass over the MS. Summaries placed between the flag agents of
+the list measure the on-source time and the data flagged by each of them.
 """
-# NOTE Urvashi Rao points out that it may be possible to consolidate these to
-# run faster (minus the flagcmd step) using the toolkit, see:
-#     http://www.aoc.nrao.edu/~rurvashi/ActiveFlaggerDocs/node11.html
 
-from casatasks import flagdata, flagmanager
+from casatasks import flagdata
 
-from . import pipeline_save
+from . import pipeline_save, substep_done
+from .flagcmds import compile_commands, parse_command
+from .flagledger import get_flag_ledger
+from .flagversions import get_flag_versions
 from .utils import runtiming, logprint
 
 
@@ -16,6 +18,18 @@ def task_logprint(msg):
     logprint(msg, logfileout="logs/flagall.log")
 
 
+def summary_command(name):
+    return f"mode='summary' name='{name}'"
+
+
+def list_summaries(result):
+    """Reports of the summary agents of a list-mode `flagdata` by name."""
+    return {
+            report["name"]: report for report in result.values()
+            if isinstance(report, dict) and "name" in report
+    }
+
+
 # Apply deterministic flags
 task_logprint("*** Starting EVLA_pipe_flagall.py ***")
 time_list = runtiming("flagall", "start")
@@ -24,185 +38,45 @@ QA2_flagall = "Pass"
 task_logprint("Deterministic flagging")
 
 outputflagfile = "flagging_commands1.txt"
-os.system(f"rm -rf {outputflagfile}")
 
-task_logprint(
-    "Determine fraction of time on-source (may not be correct for pipeline re-runs on datasets already flagged)"
-)
-
-# Report initial statistics
-myinitialflags = flagdata(
-    vis=ms_active,
-    mode="summary",
-    spwchan=True,
-    spwcorr=True,
-    basecnt=True,
-    action="calculate",
-    savepars=False,
-)
-task_logprint("Initial flags summary")
-start_total = myinitialflags["total"]
-start_flagged = myinitialflags["flagged"]
-task_logprint("Initial flagged fraction = " + str(start_flagged / start_total))
-#adding a test comment...
 online_flag_name = msname.rstrip("ms") + "flagonline.txt"
-if os.path.isfile(online_flag_name):
-    flagdata(
-        vis=ms_active,
-        mode="list",
-        inpfile=online_flag_name,
-        tbuff=1.5 * int_time,
-        reason="ANTENNA_NOT_ON_SOURCE",
-        action="apply",
-        flagbackup=True,
-        savepars=True,
-        outfile=outputflagfile,
-    )
-    task_logprint("ANTENNA_NOT_ON_SOURCE flags carried out")
-else:
-    task_logprint("No Online flags txt file! ANTENNA_NOT_ON_SOURCE flags NOT carried out!!")
-
-# Now shadow flagging
-flagdata(
-    vis=ms_active,
-    mode="shadow",
-    tolerance=0.0,
-    action="apply",
-    flagbackup=False,
-    savepars=False,
-)
-
-# Report new statistics
-slewshadowflags = flagdata(
-    vis=ms_active,
-    mode="summary",
-    spwchan=True,
-    spwcorr=True,
-    basecnt=True,
-    action="calculate",
-    savepars=False,
-)
-
-init_on_source_vis = start_total - slewshadowflags["flagged"]
-
-task_logprint("Initial on-source fraction = " + str(init_on_source_vis / start_total))
-
-try:
-    # Restore original flags
-    flagmanager(
-        vis=ms_active,
-        mode="restore",
-        versionname="flagdata_1",
-        merge="replace",
-    )
-except:
-    task_logprint("Cannot restore original flags!")
-
-os.system(f"rm -rf {outputflagfile}")
-
-# First do zero flagging (reason='CLIP_ZERO_ALL')
-myzeroflags = flagdata(
-    vis=ms_active,
-    mode="clip",
-    correlation="ABS_ALL",
-    clipzeros=True,
-    action="apply",
-    flagbackup=False,
-    savepars=False,
-    outfile=outputflagfile,
-)
-task_logprint("Zero flags carried out")
-
-# Now report statistics
-myafterzeroflags = flagdata(
-    vis=ms_active,
-    mode="summary",
-    spwchan=True,
-    spwcorr=True,
-    basecnt=True,
-    action="calculate",
-    savepars=False,
-)
-task_logprint("Zero flags summary")
-
-afterzero_total = myafterzeroflags["total"]
-afterzero_flagged = myafterzeroflags["flagged"]
-task_logprint(
-    "After ZERO flagged fraction = " + str(afterzero_flagged / afterzero_total)
-)
-
-zero_flagged = myafterzeroflags["flagged"] - myinitialflags["flagged"]
-task_logprint("Delta ZERO flagged fraction = " + str(zero_flagged / afterzero_total))
-
-# Now shadow flagging
-flagdata(
-    vis=ms_active,
-    mode="shadow",
-    tolerance=0.0,
-    action="apply",
-    flagbackup=False,
-    savepars=False,
-)
-task_logprint("Shadow flags carried out")
-
-# Now report statistics after shadow
-myaftershadowflags = flagdata(
-    vis=ms_active,
-    mode="summary",
-    spwchan=True,
-    spwcorr=True,
-    basecnt=True,
-    action="calculate",
-    savepars=False,
-)
-task_logprint("Shadow flags summary")
-
-aftershadow_total = myaftershadowflags["total"]
-aftershadow_flagged = myaftershadowflags["flagged"]
-task_logprint(
-    "After SHADOW flagged fraction = " + str(aftershadow_flagged / aftershadow_total)
-)
-
-shadow_flagged = myaftershadowflags["flagged"] - myafterzeroflags["flagged"]
-task_logprint(
-    "Delta SHADOW flagged fraction = " + str(shadow_flagged / aftershadow_total)
-)
+flag_ledger = get_flag_ledger(ms_active)
 
+# Online flags, split into the ANTENNA_NOT_ON_SOURCE flags that define the
+# on-source time and all others.
+not_on_source_list = []
+online_list = []
 if os.path.isfile(online_flag_name):
-    flagdata(
-        vis=ms_active,
-        mode="list",
-        inpfile=online_flag_name,
-        tbuff=1.5 * int_time,
-        reason="any",
-        action="apply",
-        flagbackup=False,
-        savepars=True,
-        outfile=outputflagfile,
+    with open(online_flag_name) as f:
+        for line in f:
+            fields = parse_command(line)
+            if fields is None:
+                continue
+            if fields.get("reason", "").strip("'\"") == "ANTENNA_NOT_ON_SOURCE":
+                not_on_source_list.append(line.strip())
+            else:
+                online_list.append(line.strip())
+    task_logprint(
+        f"Read {len(not_on_source_list)} ANTENNA_NOT_ON_SOURCE and "
+        f"{len(online_list)} other online flag commands"
     )
-
-    task_logprint("Online flags applied")
 else:
-    task_logprint("No online flags applied!")
+    task_logprint("No Online flags txt file! Online flags NOT carried out!!")
 
 # Define list of flagdata parameters to use in 'list' mode
 flagdata_list = []
-cmdreason_list = []
 
 # Flag pointing scans, if there are any
 if len(pointing_state_IDs) != 0:
     task_logprint("Flag pointing scans")
-    flagdata_list.append("mode='manual' intent='*POINTING*'")
-    cmdreason_list.append("pointing")
+    flagdata_list.append("mode='manual' intent='*POINTING*' reason='pointing'")
 
 # Flag setup scans
 task_logprint("Flag setup scans")
-flagdata_list.append("mode='manual' intent='UNSPECIFIED#UNSPECIFIED'")
-cmdreason_list.append("setup")
+flagdata_list.append("mode='manual' intent='UNSPECIFIED#UNSPECIFIED' reason='setup'")
 
 task_logprint("Flag setup scans")
-flagdata_list.append("mode='manual' intent='SYSTEM_CONFIGURATION#UNSPECIFIED'")
-cmdreason_list.append("setup")
+flagdata_list.append("mode='manual' intent='SYSTEM_CONFIGURATION#UNSPECIFIED' reason='setup'")
 
 # Quack the data
 task_logprint("Quack the data")
@@ -212,8 +86,8 @@ flagdata_list.append(
     + f" quackinterval={1.5*int_time}"
     + " quackmode='beg'"
     + " quackincrement=False"
+    + " reason='quack'"
 )
-cmdreason_list.append("quack")
 
 
 ######################################################################
@@ -236,8 +110,7 @@ for ispw in range(numSpws):
     SPWtoflag += f"{ispw}:{startch1}~{startch2};{endch1}~{endch2},"
 SPWtoflag = SPWtoflag.rstrip(",")
 
-flagdata_list.append(f"mode='manual' spw='{SPWtoflag}'")
-cmdreason_list.append("spw_ends")
+flagdata_list.append(f"mode='manual' spw='{SPWtoflag}' reason='spw_ends'")
 
 # Flag 10 end channels at edges of basebands
 #
@@ -266,57 +139,104 @@ for ii in range(len(low_spws)):
 if bottomSPW != "":
     task_logprint("Flag end 10 channels at edges of basebands")
     SPWtoflag = bottomSPW + "," + topSPW
-    flagdata_list.append("mode='manual' spw='" + SPWtoflag + "'")
-    cmdreason_list.append("baseband_edge_chans")
-
-# Write out list for use in flagdata mode 'list'
-with open(outputflagfile, "a") as f:
-    for line in flagdata_list:
-        f.write(line + "\n")
-
-# Apply all flags
-task_logprint("Applying all flags to data")
-
-flagdata(
-    vis=ms_active,
-    mode="list",
-    inpfile=outputflagfile,
-    action="apply",
-    flagbackup=False,
-    savepars=True,
-    cmdreason=",".join(cmdreason_list),
-)
+    flagdata_list.append(f"mode='manual' spw='{SPWtoflag}' reason='baseband_edge_chans'")
+
+# The whole list in the order the agents are applied, with a summary after
+# each group: flags on entry, antennas not on source, shadowing, zeros, the
+# remaining online flags, and the deterministic flags above.
+tbuff = 1.5 * int_time
+all_flags_list = (
+    [summary_command("initial")]
+    + compile_commands(not_on_source_list, tbuff=tbuff)
+    + [summary_command("not_on_source")]
+    + ["mode='shadow' tolerance=0.0 reason='shadow'", summary_command("on_source")]
+    + ["mode='clip' correlation='ABS_ALL' clipzeros=True reason='CLIP_ZERO_ALL'"]
+    + [summary_command("zero")]
+    + compile_commands(online_list, tbuff=tbuff)
+    + [summary_command("online")]
+    + compile_commands(flagdata_list)
+    + [summary_command("all")]
+)
+
+if substep_done("deterministic_flags"):
+    task_logprint("Deterministic flags and statistics restored from checkpoint")
+else:
+    os.system(f"rm -rf {outputflagfile}")
+    # Write out list for use in flagdata mode 'list'
+    with open(outputflagfile, "w") as f:
+        for line in all_flags_list:
+            f.write(line + "\n")
+
+    # The first flag backup holds the flags as they are now. If the stage is
+    # run again, or restarted after the flags were applied, start over from
+    # it so that the summaries do not count the deterministic flags twice.
+    flag_versions = get_flag_versions(ms_active)
+    if "flagdata_1" in flag_versions:
+        task_logprint("Restoring flags from 'flagdata_1'")
+        flag_versions.restore("flagdata_1")
+        flag_ledger.restore_version("flagdata_1")
+    else:
+        flag_versions.save("flagdata_1", comment="Flags before deterministic flagging")
+        flag_ledger.save_version("flagdata_1")
+
+    # Apply all flags
+    task_logprint("Applying all flags to data")
+
+    summaries = list_summaries(flagdata(
+        vis=ms_active,
+        mode="list",
+        inpfile=outputflagfile,
+        tbuff=tbuff,
+        action="apply",
+        flagbackup=False,
+        savepars=True,
+    ))
+
+    task_logprint("Flagging completed ")
+    task_logprint(f"Flag commands saved in file {outputflagfile}")
+
+    # Report statistics
+    start_total = summaries["initial"]["total"]
+    start_flagged = summaries["initial"]["flagged"]
+    task_logprint("Initial flagged fraction = " + str(start_flagged / start_total))
+
+    init_on_source_vis = start_total - summaries["on_source"]["flagged"]
+    task_logprint("Initial on-source fraction = " + str(init_on_source_vis / start_total))
+
+    aftershadow_total = summaries["on_source"]["total"]
+    shadow_flagged = summaries["on_source"]["flagged"] - summaries["not_on_source"]["flagged"]
+    task_logprint(
+        "Delta SHADOW flagged fraction = " + str(shadow_flagged / aftershadow_total)
+    )
+
+    afterzero_total = summaries["zero"]["total"]
+    zero_flagged = summaries["zero"]["flagged"] - summaries["on_source"]["flagged"]
+    task_logprint("Delta ZERO flagged fraction = " + str(zero_flagged / afterzero_total))
+
+    online_flagged = summaries["online"]["flagged"] - summaries["zero"]["flagged"]
+    task_logprint("Delta ONLINE flagged fraction = " + str(online_flagged / start_total))
 
-task_logprint("Flagging completed ")
-task_logprint(f"Flag commands saved in file {outputflagfile}")
+    all_flagged = summaries["all"]["flagged"]
+    determ_flagged = all_flagged - summaries["online"]["flagged"]
+    task_logprint(
+        "Delta intents/quack/channel flagged fraction = "
+        + str(determ_flagged / start_total)
+    )
+
+    frac_flagged_on_source1 = 1.0 - (
+        (start_total - all_flagged) / init_on_source_vis
+    )
+
+    pipeline_save(substep="deterministic_flags")
 
 # Save flags
 task_logprint("Saving flags")
 
-flagmanager(
-    vis=ms_active,
-    mode="save",
-    versionname="allflags1",
-    comment="Deterministic flags saved after application",
-    merge="replace",
+get_flag_versions(ms_active).save(
+    "allflags1", comment="Deterministic flags saved after application",
 )
 task_logprint(f"Flag column saved to 'allflags1'")
 
-# Report new statistics
-all_flags = flagdata(
-    vis=ms_active,
-    mode="summary",
-    spwchan=True,
-    spwcorr=True,
-    basecnt=True,
-    action="calculate",
-    savepars=False,
-)
-
-frac_flagged_on_source1 = 1.0 - (
-    (start_total - all_flags["flagged"]) / init_on_source_vis
-)
-
 task_logprint("Fraction of on-source data flagged = " + str(frac_flagged_on_source1))
 
 if frac_flagged_on_source1 >= 0.3:
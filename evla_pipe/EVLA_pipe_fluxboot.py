@@ -8,9 +8,9 @@ import numpy as np
 import scipy as sp
 
 from casatasks import fluxscale, casalog
-from casaplotms import plotms
 
 from . import pipeline_save
+from .scheduler import plotms
 from .utils import MAINLOG, logprint, runtiming, find_EVLA_band
 
 
@@ -4,19 +4,20 @@
 import numpy as np
 import warnings 
 
-from casatasks import (listobs, plotweather, flagcmd, plotants)
+from casatasks import flagcmd
 from casatools import table
 from casatools import ms as mstool
-from casaplotms import plotms
 
 from . import pipeline_save
+from .msindex import get_msindex
+from .scheduler import get_scheduler
 from .utils import (
-        uniq, runtiming, logprint, find_EVLA_band, spwsforfield, find_3C84,
-        buildscans,
+        uniq, runtiming, logprint, find_EVLA_band, find_3C84, buildscans,
 )
 
 tb = table()
 ms = mstool()
+scheduler = get_scheduler()
 
 
 def task_logprint(msg):
@@ -30,7 +31,10 @@ QA2_msinfo = "Pass"
 task_logprint("Listing ms contents")
 listname = msname.rstrip("ms") + "listobs"
 os.system(f"rm -rf {listname}")
-listobs(
+scheduler.submit_casa_task(
+    "listobs",
+    reads=("ms:meta",),
+    writes=("file:listobs",),
     vis=msname,
     selectdata=False,
     listfile=listname,
@@ -81,21 +85,20 @@ try:
 finally:
     tb.close()
 
+# Index the scan, field, intent, and spw metadata of the main table. This is
+# read from the sidecar file next to the MS if it is up to date.
+ms_index = get_msindex(msname)
+
 # Map field IDs to spws
-field_spws = [spwsforfield(msname, ii) for ii in range(numFields)]
+field_spws = [
+        [int(spw) for spw in ms_index.query(field=ii).spws]
+        for ii in range(numFields)
+]
 
 # Identify scan numbers, map scans to field ID, and run scan summary
 # (needed for figuring out integration time later).
-try:
-    tb.open(msname)
-    scanNums = sorted(np.unique(tb.getcol("SCAN_NUMBER")))
-    field_scans = []
-    for ii in range(numFields):
-        subtable = tb.query(f"FIELD_ID=={ii}")
-        field_scans.append(list(np.unique(subtable.getcol("SCAN_NUMBER"))))
-        subtable.close()
-finally:
-    tb.close()
+scanNums = ms_index.scans
+field_scans = [ms_index.query(field=ii).scans for ii in range(numFields)]
 
 ## NOTE
 ## field_scans is now a list of lists containing the scans for each field.
@@ -238,50 +241,26 @@ for state_ID in range(len(intents)):
             delay_state_IDs.append(state_ID)
             calibrator_state_IDs.append(state_ID)
         elif scan_intent == "CALIBRATE_FLUX":
-            tb.open(msname)
-            subtable = tb.query('STATE_ID in[%s]' %state_ID)
-            flux_field_id = np.unique(subtable.getcol('FIELD_ID'))
-            tb.close()
-            tb.open(msname+'/FIELD')
-            temp_field_names = tb.getcol('NAME')
-            fluxField = temp_field_names[flux_field_id][0]
-            tb.close()
+            flux_field_id = np.unique(ms_index.query(state=state_ID).field)
+            fluxField = field_names[flux_field_id][0]
             
             flux_state_IDs.append(state_ID)
             calibrator_state_IDs.append(state_ID)
         elif scan_intent == "CALIBRATE_POLARIZATION":
-            tb.open(msname)
-            subtable = tb.query('STATE_ID in[%s]' %state_ID)
-            pol_field_id = np.unique(subtable.getcol('FIELD_ID'))
-            tb.close()
-            tb.open(msname+'/FIELD')
-            temp_field_names = tb.getcol('NAME')
-            polField = temp_field_names[pol_field_id][0]
-            tb.close()
+            pol_field_id = np.unique(ms_index.query(state=state_ID).field)
+            polField = field_names[pol_field_id][0]
             polarization_angle_state_IDs.append(state_ID)
             calibrator_state_IDs.append(state_ID)
         elif scan_intent == "CALIBRATE_POL_ANGLE":
-            tb.open(msname)
-            subtable = tb.query('STATE_ID in[%s]' %state_ID)
-            pol_angle_field_id = np.unique(subtable.getcol('FIELD_ID'))
-            tb.close()
-            tb.open(msname+'/FIELD')
-            temp_field_names = tb.getcol('NAME')
-            polAngleField = temp_field_names[pol_angle_field_id][0]
-            tb.close()
+            pol_angle_field_id = np.unique(ms_index.query(state=state_ID).field)
+            polAngleField = field_names[pol_angle_field_id][0]
             print('polAngleField = ', polAngleField)
             
             polarization_angle_state_IDs.append(state_ID)
             calibrator_state_IDs.append(state_ID)
         elif scan_intent == "CALIBRATE_POL_LEAKAGE":
-            tb.open(msname)
-            subtable = tb.query('STATE_ID in[%s]' %state_ID)
-            pol_lkg_field_id = np.unique(subtable.getcol('FIELD_ID'))
-            tb.close()
-            tb.open(msname+'/FIELD')
-            temp_field_names = tb.getcol('NAME')
-            polLeakField = temp_field_names[pol_lkg_field_id][0]
-            tb.close()
+            pol_lkg_field_id = np.unique(ms_index.query(state=state_ID).field)
+            polLeakField = field_names[pol_lkg_field_id][0]
             print('polLeakField = ', polLeakField)
             polarization_lkg_state_IDs.append(state_ID)
             calibrator_state_IDs.append(state_ID)            
@@ -294,8 +273,7 @@ for state_ID in range(len(intents)):
         elif scan_intent == "CALIBRATE_POINTING":
             pointing_state_IDs.append(state_ID)
             calibrator_state_IDs.append(state_ID)
-        
-tb.open(msname)
+
 
 if len(flux_state_IDs) == 0:
     QA2_msinfo = "Fail"
@@ -307,12 +285,11 @@ else:
         flux_state_select_string += ",%s" % flux_state_IDs[state_ID]
     flux_state_select_string += "]"
     print('flux_state_select_string', flux_state_select_string)
-    subtable = tb.query(flux_state_select_string)
-    flux_scan_list = list(np.unique(subtable.getcol("SCAN_NUMBER")))
+    subtable = ms_index.query(state=flux_state_IDs)
+    flux_scan_list = subtable.scans
     flux_scan_select_string = ",".join(["%s" % ii for ii in flux_scan_list])
     task_logprint(f"Flux density calibrator(s) scans are {flux_scan_select_string}")
-    flux_field_list = list(np.unique(subtable.getcol("FIELD_ID")))
-    subtable.close()
+    flux_field_list = subtable.fields
     flux_field_select_string = ",".join(str(ii) for ii in flux_field_list)
     task_logprint(f"Flux density calibrator(s) are fields {flux_field_select_string}")
 
@@ -327,12 +304,11 @@ else:
     for state_ID in range(1, len(bandpass_state_IDs)):
         bandpass_state_select_string += ",%s" % bandpass_state_IDs[state_ID]
     bandpass_state_select_string += "]"
-    subtable = tb.query(bandpass_state_select_string)
-    bandpass_scan_list = list(np.unique(subtable.getcol("SCAN_NUMBER")))
+    subtable = ms_index.query(state=bandpass_state_IDs)
+    bandpass_scan_list = subtable.scans
     bandpass_scan_select_string = ",".join(str(ii) for ii in bandpass_scan_list)
     task_logprint(f"Bandpass calibrator(s) scans are {bandpass_scan_select_string}")
-    bandpass_field_list = list(np.unique(subtable.getcol("FIELD_ID")))
-    subtable.close()
+    bandpass_field_list = subtable.fields
     bandpass_field_select_string = ",".join(str(ii) for ii in bandpass_field_list)
     task_logprint(f"Bandpass calibrator(s) are fields {bandpass_field_select_string}")
     if len(bandpass_field_list) > 1:
@@ -356,12 +332,11 @@ else:
     for state_ID in range(1, len(delay_state_IDs)):
         delay_state_select_string += ",%s" % delay_state_IDs[state_ID]
     delay_state_select_string += "]"
-    subtable = tb.query(delay_state_select_string)
-    delay_scan_list = list(np.unique(subtable.getcol("SCAN_NUMBER")))
+    subtable = ms_index.query(state=delay_state_IDs)
+    delay_scan_list = subtable.scans
     delay_scan_select_string = ",".join(str(ii) for ii in delay_scan_list)
     task_logprint(f"Delay calibrator(s) scans are {delay_scan_select_string}")
-    delay_field_list = list(np.unique(subtable.getcol("FIELD_ID")))
-    subtable.close()
+    delay_field_list = subtable.fields
     delay_field_select_string = ",".join(str(ii) for ii in delay_field_list)
     task_logprint(f"Delay calibrator(s) are fields {delay_field_select_string}")
 
@@ -379,8 +354,7 @@ if len(polarization_angle_state_IDs) == 0:
             if str(polcals_A[i]) in field_names:
                 polAngleField = str(polcals_A[i])
                 target_index = np.where(field_names==polcals_A[i]) #search for category A pol calibrators in field name list
-                temp = tb.query('FIELD_ID == %s' % target_index[0][0])
-                pol_angle_state_ids = np.unique(temp.getcol('STATE_ID'))
+                pol_angle_state_ids = np.unique(ms_index.query(field=target_index[0][0]).state)
                 task_logprint('Found scan for %s!' % polcals_A[i])
                 task_logprint('STATE_ID for this target is: %s' % pol_angle_state_ids)
                 polarization_angle_state_IDs.append(pol_angle_state_ids[0])
@@ -402,8 +376,7 @@ if len(polarization_angle_state_IDs) == 0:
                     has_leak_polcal = True
                     polLeakField = polcals_C[i]
                     target_index = np.where(field_names==polcals_C[i]) #search for category C (leakage) pol calibrators in field name list
-                    temp = tb.query('FIELD_ID == %s' % target_index[0][0])
-                    pol_lkg_state_ids = np.unique(temp.getcol('STATE_ID'))
+                    pol_lkg_state_ids = np.unique(ms_index.query(field=target_index[0][0]).state)
                     task_logprint('Found scan for %s!' % polcals_C[i])
                     task_logprint('STATE_ID for this target is: %s' % pol_lkg_state_ids)
                     polarization_lkg_state_IDs.append(pol_lkg_state_ids[0])
@@ -418,8 +391,7 @@ if len(polarization_angle_state_IDs) == 0:
                     polLeakField = str(input("Enter field name of pol leakage calibrator: "))
 
                     target_index = np.where(field_names==polLeakField) #search for category C (leakage) pol calibrators in field name list
-                    temp = tb.query('FIELD_ID == %s' % target_index[0][0])
-                    pol_lkg_state_ids = np.unique(temp.getcol('STATE_ID'))
+                    pol_lkg_state_ids = np.unique(ms_index.query(field=target_index[0][0]).state)
                     #print('target_index = ', target_index)
                     #print('state_ids = ', state_ids)
                     task_logprint('Found scan for %s!' % polcals_C[i])
@@ -431,13 +403,12 @@ if len(polarization_angle_state_IDs) == 0:
                     for state_ID in range(1, len(polarization_angle_state_IDs)):
                         polarization_angle_state_select_string += ",%s" % polarization_angle_state_IDs[state_ID]
                     polarization_angle_state_select_string += "]"
-                    subtable_polangle = tb.query(polarization_angle_state_select_string)
+                    subtable_polangle = ms_index.query(state=polarization_angle_state_IDs)
 
-                    polarization_angle_scan_list = list(np.unique(subtable_polangle.getcol("SCAN_NUMBER")))
+                    polarization_angle_scan_list = subtable_polangle.scans
                     polarization_angle_scan_select_string = ",".join(str(ii) for ii in polarization_angle_scan_list)
                     task_logprint(f"Polarization angle calibrator(s) scans are {polarization_angle_scan_select_string}")
-                    polarization_angle_field_list = list(np.unique(subtable_polangle.getcol("FIELD_ID")))
-                    subtable_polangle.close()
+                    polarization_angle_field_list = subtable_polangle.fields
                     polarization_angle_field_select_string = ",".join(str(ii) for ii in polarization_angle_field_list)
                     task_logprint(f"Polarization angle calibrator(s) are fields {polarization_angle_field_select_string}")
                     
@@ -445,13 +416,12 @@ if len(polarization_angle_state_IDs) == 0:
                     for state_ID in range(1, len(polarization_lkg_state_IDs)):
                         polarization_lkg_state_select_string += ",%s" % polarization_lkg_state_IDs[state_ID]
                     polarization_lkg_state_select_string += "]"
-                    subtable_pollkg = tb.query(polarization_lkg_state_select_string)
+                    subtable_pollkg = ms_index.query(state=polarization_lkg_state_IDs)
 
-                    polarization_lkg_scan_list = list(np.unique(subtable_pollkg.getcol("SCAN_NUMBER")))
+                    polarization_lkg_scan_list = subtable_pollkg.scans
                     polarization_lkg_scan_select_string = ",".join(str(ii) for ii in polarization_lkg_scan_list)
                     task_logprint(f"Polarization lkg calibrator(s) scans are {polarization_lkg_scan_select_string}")
-                    polarization_lkg_field_list = list(np.unique(subtable_pollkg.getcol("FIELD_ID")))
-                    subtable_pollkg.close()
+                    polarization_lkg_field_list = subtable_pollkg.fields
                     polarization_lkg_field_select_string = ",".join(str(ii) for ii in polarization_lkg_field_list)
                     task_logprint(f"Polarization lkg calibrator(s) are fields {polarization_lkg_field_select_string}")
                     
@@ -465,13 +435,12 @@ if len(polarization_angle_state_IDs) == 0:
                 for state_ID in range(1, len(polarization_angle_state_IDs)):
                     polarization_angle_state_select_string += ",%s" % polarization_angle_state_IDs[state_ID]
                 polarization_angle_state_select_string += "]"
-                subtable_polangle = tb.query(polarization_angle_state_select_string)
+                subtable_polangle = ms_index.query(state=polarization_angle_state_IDs)
 
-                polarization_angle_scan_list = list(np.unique(subtable_polangle.getcol("SCAN_NUMBER")))
+                polarization_angle_scan_list = subtable_polangle.scans
                 polarization_angle_scan_select_string = ",".join(str(ii) for ii in polarization_angle_scan_list)
                 task_logprint(f"Polarization angle calibrator(s) scans are {polarization_angle_scan_select_string}")
-                polarization_angle_field_list = list(np.unique(subtable_polangle.getcol("FIELD_ID")))
-                subtable_polangle.close()
+                polarization_angle_field_list = subtable_polangle.fields
                 polarization_angle_field_select_string = ",".join(str(ii) for ii in polarization_angle_field_list)
                 task_logprint(f"Polarization angle calibrator(s) are fields {polarization_angle_field_select_string}")
                     
@@ -479,13 +448,12 @@ if len(polarization_angle_state_IDs) == 0:
                 for state_ID in range(1, len(polarization_lkg_state_IDs)):
                     polarization_lkg_state_select_string += ",%s" % polarization_lkg_state_IDs[state_ID]
                 polarization_lkg_state_select_string += "]"
-                subtable_pollkg = tb.query(polarization_lkg_state_select_string)
+                subtable_pollkg = ms_index.query(state=polarization_lkg_state_IDs)
 
-                polarization_lkg_scan_list = list(np.unique(subtable_pollkg.getcol("SCAN_NUMBER")))
+                polarization_lkg_scan_list = subtable_pollkg.scans
                 polarization_lkg_scan_select_string = ",".join(str(ii) for ii in polarization_lkg_scan_list)
                 task_logprint(f"Polarization lkg calibrator(s) scans are {polarization_lkg_scan_select_string}")
-                polarization_lkg_field_list = list(np.unique(subtable_pollkg.getcol("FIELD_ID")))
-                subtable_pollkg.close()
+                polarization_lkg_field_list = subtable_pollkg.fields
                 polarization_lkg_field_select_string = ",".join(str(ii) for ii in polarization_lkg_field_list)
                 task_logprint(f"Polarization lkg calibrator(s) are fields {polarization_lkg_field_select_string}")
                 
@@ -497,13 +465,12 @@ else:
     for state_ID in range(1, len(polarization_angle_state_IDs)):
         polarization_angle_state_select_string += ",%s" % polarization_angle_state_IDs[state_ID]
     polarization_angle_state_select_string += "]"
-    subtable_polangle = tb.query(polarization_angle_state_select_string)
+    subtable_polangle = ms_index.query(state=polarization_angle_state_IDs)
 
-    polarization_angle_scan_list = list(np.unique(subtable_polangle.getcol("SCAN_NUMBER")))
+    polarization_angle_scan_list = subtable_polangle.scans
     polarization_angle_scan_select_string = ",".join(str(ii) for ii in polarization_angle_scan_list)
     task_logprint(f"Polarization angle calibrator(s) scans are {polarization_angle_scan_select_string}")
-    polarization_angle_field_list = list(np.unique(subtable_polangle.getcol("FIELD_ID")))
-    subtable_polangle.close()
+    polarization_angle_field_list = subtable_polangle.fields
     polarization_angle_field_select_string = ",".join(str(ii) for ii in polarization_angle_field_list)
     task_logprint(f"Polarization angle calibrator(s) are fields {polarization_angle_field_select_string}")
 
@@ -511,13 +478,12 @@ else:
     for state_ID in range(1, len(polarization_lkg_state_IDs)):
         polarization_lkg_state_select_string += ",%s" % polarization_lkg_state_IDs[state_ID]
     polarization_lkg_state_select_string += "]"
-    subtable_pollkg = tb.query(polarization_lkg_state_select_string)
+    subtable_pollkg = ms_index.query(state=polarization_lkg_state_IDs)
 
-    polarization_lkg_scan_list = list(np.unique(subtable_pollkg.getcol("SCAN_NUMBER")))
+    polarization_lkg_scan_list = subtable_pollkg.scans
     polarization_lkg_scan_select_string = ",".join(str(ii) for ii in polarization_lkg_scan_list)
     task_logprint(f"Polarization lkg calibrator(s) scans are {polarization_lkg_scan_select_string}")
-    polarization_lkg_field_list = list(np.unique(subtable_pollkg.getcol("FIELD_ID")))
-    subtable_pollkg.close()
+    polarization_lkg_field_list = subtable_pollkg.fields
     polarization_lkg_field_select_string = ",".join(str(ii) for ii in polarization_lkg_field_list)
     task_logprint(f"Polarization lkg calibrator(s) are fields {polarization_lkg_field_select_string}")
 
@@ -530,12 +496,11 @@ else:
     for state_ID in range(1, len(phase_state_IDs)):
         phase_state_select_string += ",%s" % phase_state_IDs[state_ID]
     phase_state_select_string += "]"
-    subtable = tb.query(phase_state_select_string)
-    phase_scan_list = list(np.unique(subtable.getcol("SCAN_NUMBER")))
+    subtable = ms_index.query(state=phase_state_IDs)
+    phase_scan_list = subtable.scans
     phase_scan_select_string = ",".join(str(ii) for ii in phase_scan_list)
     task_logprint(f"Phase calibrator(s) scans are {phase_scan_select_string}")
-    phase_field_list = list(np.unique(subtable.getcol("FIELD_ID")))
-    subtable.close()
+    phase_field_list = subtable.fields
     phase_field_select_string = ",".join(str(ii) for ii in phase_field_list)
     task_logprint(f"Phase calibrator(s) are fields {phase_field_select_string}")
 
@@ -550,12 +515,11 @@ else:
     for state_ID in range(1, len(amp_state_IDs)):
         amp_state_select_string += ",%s" % amp_state_IDs[state_ID]
     amp_state_select_string += "]"
-    subtable = tb.query(amp_state_select_string)
-    amp_scan_list = list(np.unique(subtable.getcol("SCAN_NUMBER")))
+    subtable = ms_index.query(state=amp_state_IDs)
+    amp_scan_list = subtable.scans
     amp_scan_select_string = ",".join(str(ii) for ii in amp_scan_list)
     task_logprint(f"Amplitude calibrator(s) scans are {amp_scan_select_string}")
-    amp_field_list = list(np.unique(subtable.getcol("FIELD_ID")))
-    subtable.close()
+    amp_field_list = subtable.fields
     amp_field_select_string = ",".join(str(ii) for ii in amp_field_list)
     task_logprint(f"Amplitude calibrator(s) are fields {amp_field_select_string}")
 
@@ -565,26 +529,33 @@ for state_ID in range(1, len(calibrator_state_IDs)):
     calibrator_state_select_string += ",%s" % calibrator_state_IDs[state_ID]
 
 calibrator_state_select_string += "]"
-subtable = tb.query(calibrator_state_select_string)
-calibrator_scan_list = list(np.unique(subtable.getcol("SCAN_NUMBER")))
+subtable = ms_index.query(state=calibrator_state_IDs)
+calibrator_scan_list = subtable.scans
 calibrator_scan_select_string = ",".join(str(ii) for ii in calibrator_scan_list)
-calibrator_field_list = list(np.unique(subtable.getcol("FIELD_ID")))
-subtable.close()
+calibrator_field_list = subtable.fields
 calibrator_field_select_string = ",".join(str(ii) for ii in calibrator_field_list)
 
-tb.close()
-
 
 # FIXME Additional date ranges likely need to be added here.
+# The opacities are collected after `buildscans` below, which the weather
+# plotting may run concurrently with.
 if ((startdate >= 55918.80) and (startdate <= 55938.98)) or \
     ((startdate >= 56253.6) and (startdate <= 56271.6)):
     task_logprint(
             "Weather station broken during this period, using 100% "
             "seasonal model for calculating the zenith opacity"
     )
-    tau = plotweather(vis=msname, seasonal_weight=1.0, doPlot=True)
+    seasonal_weight = 1.0
 else:
-    tau = plotweather(vis=msname, seasonal_weight=0.5, doPlot=True)
+    seasonal_weight = 0.5
+weather_task = scheduler.submit_casa_task(
+    "plotweather",
+    reads=("ms:meta",),
+    writes=("plot:plotweather.png",),
+    vis=msname,
+    seasonal_weight=seasonal_weight,
+    doPlot=True,
+)
 
 # If there are any pointing state IDs, subtract 2 from the number of
 # science spws -- needed for QA scores
@@ -593,11 +564,12 @@ if len(pointing_state_IDs) > 0:
 else:
     numSpws2 = numSpws
 
-task_logprint(f"Zenith opacities based on weather data are: {tau}")
-
 # Prep string listing of correlations from dictionary created by method buildscans
 # For now, only use the parallel hands.  Cross hands will be implemented later.
 scandict = buildscans(msname)
+
+tau = weather_task.result()
+task_logprint(f"Zenith opacities based on weather data are: {tau}")
 corrstring_list = scandict["DataDescription"][0]["corrdesc"]
 removal_list = ["RL", "LR", "XY", "YX"]
 corrstring_list = list(set(corrstring_list).difference(set(removal_list)))
@@ -734,7 +706,10 @@ except Exception:
 # Plot antenna locations
 task_logprint("Plotting antenna positions (linear)")
 os.system("rm -rf plotants.png")
-plotants(
+scheduler.submit_casa_task(
+        "plotants",
+        reads=("ms:meta",),
+        writes=("plot:plotants.png",),
         vis=msname,
         logpos=False,
         figfile="plotants.png",
@@ -743,7 +718,10 @@ task_logprint("Antenna positions plot (linear) plotants.png")
 
 task_logprint("Plotting antenna positions (logarithmic)")
 os.system("rm -rf plotantslog.png")
-plotants(
+scheduler.submit_casa_task(
+        "plotants",
+        reads=("ms:meta",),
+        writes=("plot:plotantslog.png",),
         vis=msname,
         logpos=True,
         figfile="plotantslog.png",
@@ -756,7 +734,11 @@ task_logprint("Antenna positions plot (logarithmic) plotantslog.png")
 # had WIDAR channel averaging applied.
 task_logprint("Plotting elevation vs. time for all fields")
 os.system("rm -rf el_vs_time.png")
-plotms(
+scheduler.submit_casa_task(
+        "plotms",
+        module="casaplotms",
+        reads=("ms:meta", "ms:FLAG"),
+        writes=("plot:el_vs_time.png",),
         vis=msname,
         xaxis="time",
         yaxis="elevation",
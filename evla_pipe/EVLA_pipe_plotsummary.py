@@ -2,9 +2,8 @@
 Make final *uv* plots on all sources.
 """
 
-from casaplotms import plotms
-
 from . import pipeline_save
+from .scheduler import plotms
 from .utils import logprint, runtiming
 
 
@@ -12,6 +11,11 @@ def task_logprint(msg):
     logprint(msg, logfileout="logs/filecollect.log")
 
 
+# The plots only read the calibrated MS, so they may run concurrently with one
+# another.
+PLOT_READS = ("ms:CORRECTED_DATA", "ms:MODEL_DATA", "ms:FLAG")
+
+
 task_logprint("*** Starting EVLA_pipe_plotsummary.py ***")
 time_list = runtiming("plotsummary", "start")
 QA2_plotsummary = "Pass"
@@ -19,6 +23,7 @@ QA2_plotsummary = "Pass"
 task_logprint("Making final UV plots.")
 
 plotms(
+    reads=PLOT_READS,
     vis=ms_active,
     xaxis="time",
     yaxis="phase",
@@ -47,6 +52,7 @@ plotms(
 )
 
 plotms(
+    reads=PLOT_READS,
     vis=ms_active,
     xaxis="time",
     yaxis="amp",
@@ -77,6 +83,7 @@ plotms(
 for ii in field_ids:
     print(f"-- Field ID {ii}")
     plotms(
+        reads=PLOT_READS,
         vis=ms_active,
         xaxis="uvwave",
         yaxis="amp",
@@ -121,6 +128,7 @@ if "#" in spw_names[0]:
             else:
                 print("-- ", band, bband, bbspw)
                 plotms(
+                    reads=PLOT_READS,
                     vis=ms_active,
                     xaxis="freq",
                     yaxis="amp",
@@ -155,6 +163,7 @@ else:
     )
     for ii in field_ids:
         plotms(
+            reads=PLOT_READS,
             vis=ms_active,
             xaxis="freq",
             yaxis="amp",
@@ -199,6 +208,7 @@ if "#" in spw_names[0]:
             else:
                 print("-- ", band, bband, bbspw)
                 plotms(
+                    reads=PLOT_READS,
                     vis=ms_active,
                     xaxis="freq",
                     yaxis="phase",
@@ -233,6 +243,7 @@ else:
     )
     for ii in field_ids:
         plotms(
+            reads=PLOT_READS,
             vis=ms_active,
             xaxis="freq",
             yaxis="phase",
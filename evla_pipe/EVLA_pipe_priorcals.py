@@ -5,13 +5,15 @@ This module calculates deterministic calibration steps such as gain curves,
 opacities, antenna position corrections, and requantizer gains.
 """
 
-import os
-
-from casatasks import gencal
-from casaplotms import plotms
-
 from . import pipeline_save
-from .utils import runtiming, logprint, correct_ant_posns
+from .calplot import page_files
+from .scheduler import get_scheduler
+from .utils import (
+        runtiming, logprint, correct_ant_posns, antpos_gains,
+        switched_power_gains,
+)
+
+scheduler = get_scheduler()
 
 
 def task_logprint(msg):
@@ -22,10 +24,16 @@ task_logprint("*** Starting EVLA_pipe_priorcals.py ***")
 time_list = runtiming("priorcals", "start")
 QA2_priorcals = "Pass"
 
-priorcals = []
+# Each `gencal` only reads the MS and writes its own table, so all of the
+# tables are made at once when there are worker processes available and are
+# collected below in the order of `priorcals`.
+gencal_tasks = []
 
 # Table for elevation gain curves
-gencal(
+gencal_tasks.append(("gain_curves.g", scheduler.submit_casa_task(
+    "gencal",
+    reads=("ms:meta",),
+    writes=("table:gain_curves.g",),
     vis=ms_active,
     caltable="gain_curves.g",
     caltype="gc",
@@ -33,11 +41,13 @@ gencal(
     antenna="",
     pol="",
     parameter=[],
-)
-priorcals.append("gain_curves.g")
+)))
 
 # Table for atmospheric opacities
-gencal(
+gencal_tasks.append(("opacities.g", scheduler.submit_casa_task(
+    "gencal",
+    reads=("ms:meta",),
+    writes=("table:opacities.g",),
     vis=ms_active,
     caltable="opacities.g",
     caltype="opac",
@@ -45,15 +55,17 @@ gencal(
     antenna="",
     pol="",
     parameter=tau,
-)
-priorcals.append("opacities.g")
+)))
 
 # Apply switched power calibration (when commissioned); for now, just
 # requantizer gains (needs casa4.1!), and only for data with sensible switched
 # power tables (Feb 24, 2011)
 feb_24_2011 = 55616.6  # mjd
 if startdate >= feb_24_2011:
-    gencal(
+    gencal_tasks.append(("requantizergains.g", scheduler.submit_casa_task(
+        "gencal",
+        reads=("ms:meta",),
+        writes=("table:requantizergains.g",),
         vis=ms_active,
         caltable="requantizergains.g",
         caltype="rq",
@@ -61,76 +73,58 @@ if startdate >= feb_24_2011:
         antenna="",
         pol="",
         parameter=[],
-    )
-    priorcals.append("requantizergains.g")
+    )))
 
 # Correct for antenna position errors, if known.
 # NB: for the realtime pipeline these will not be available yet, but all
 # SBs that do not have good antenna positions should be re-processed when
 # they are available
-try:
-    gencal(
-        vis=ms_active,
-        caltable="antposcal.p",
-        caltype="antpos",
-        spw="",
-        antenna="",
-        pol="",
-        parameter=[],
-    )
-    if os.path.exists("antposcal.p"):
-        priorcals.append("antposcal.p")
-        antenna_offsets = correct_ant_posns(ms_active)
-        task_logprint("Correcting for known antenna position errors")
-        task_logprint(str(antenna_offsets))
-    else:
-        task_logprint("No antenna position corrections found/needed")
-except:
-    task_logprint("No antenna position corrections found/needed")
+antpos_task = scheduler.submit(
+    "gencal antposcal.p",
+    antpos_gains,
+    args=(ms_active, "antposcal.p"),
+    reads=("ms:meta",),
+    writes=("table:antposcal.p",),
+)
 
 # Lastly, make switched power table.  This is not used in the pipeline, but may
 # be used for QA and for flagging, especially at S-band for fields near the
 # geostationary satellite belt.  Only relevant for data taken on 24-Feb-2011 or
-# later.
+# later. The switched power gain and system temperature are plotted,
+# paginated by antenna into sets of three sub-plots, by the same worker as
+# soon as the table is written; nothing else in this stage waits for it.
 if startdate >= feb_24_2011:
-    gencal(
-        vis=ms_active,
-        caltable="switched_power.g",
-        caltype="swpow",
-        spw="",
-        antenna="",
-        pol="",
-        parameter=[],
+    task_logprint("Making and plotting switched power table")
+    swpow_plots = [
+        dict(prefix="switched_power", xaxis="time", yaxis="spgain", correlation="R"),
+        dict(prefix="Tsys", xaxis="time", yaxis="tsys", correlation="R"),
+    ]
+    scheduler.submit(
+        "gencal switched_power.g",
+        switched_power_gains,
+        args=(ms_active, "switched_power.g", numAntenna, swpow_plots),
+        reads=("ms:meta",),
+        writes=("table:switched_power.g",) + tuple(
+            f"plot:{f}" for spec in swpow_plots
+            for f in page_files(spec["prefix"], numAntenna)
+        ),
     )
-    # Plot switched power gain and system temperature. The factors of 3 are for
-    # generating sets of 3x3 sub-plots paginated by antenna.
-    task_logprint("Plotting switched power table")
-    nplots = int(numAntenna / 3)
-    if (numAntenna % 3) > 0:
-        nplots += 1
-    for ii in range(nplots):
-        ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-        for plotfile, yaxis in (
-                (f"switched_power{ii}.png", "spgain"),
-                (f"Tsys{ii}.png", "tsys"),
-        ):
-            plotms(
-                vis="switched_power.g",
-                xaxis="time",
-                yaxis=yaxis,
-                correlation="R",
-                antenna=ant_select,
-                spw="",
-                timerange="",
-                gridrows=3,
-                coloraxis="spw",
-                iteraxis="antenna",
-                plotrange=[],
-                showgui=False,
-                plotfile=plotfile,
-                highres=True,
-                overwrite=True,
-            )
+
+scheduler.wait(writes=[f"table:{caltable}" for caltable, _ in gencal_tasks])
+priorcals = [caltable for caltable, _ in gencal_tasks]
+
+scheduler.wait(writes=("table:antposcal.p",))
+if antpos_task.result():
+    priorcals.append("antposcal.p")
+    try:
+        antenna_offsets = correct_ant_posns(ms_active)
+        task_logprint("Correcting for known antenna position errors")
+        task_logprint(str(antenna_offsets))
+    except Exception as e:
+        task_logprint(f"Antenna position offsets not retrieved: {e}")
+        task_logprint("No antenna position corrections found/needed")
+else:
+    task_logprint("No antenna position corrections found/needed")
 
 # Until we know what error messages to search for in priorcals,
 # leave QA2 score set to "Pass".
@@ -1,46 +1,21 @@
 """
 Facilitates the restart of the pipeline. The `pipeline_restore` function
-needs to be run before this script.
+needs to be run before this script. An interrupted stage is run again, and
+the sub-steps of it that were checkpointed with `pipeline_save(substep=...)`
+are skipped.
 """
 
-from . import exec_script
+from . import run_stages
+from .scheduler import PIPELINE_STAGES, default_nprocs, stage_index
 from .utils import logprint
 
 
-pipeline_scripts = [
-    "startup",
-    "import",
-    "hanning",
-    "msinfo",
-    "flagall",
-    "calprep",
-    "priorcals",
-    "testBPdcals",
-    "flag_baddeformatters",
-    "flag_baddeformattersphase",
-    "checkflag",
-    "semiFinalBPdcals1",
-    "checkflag_semiFinal",
-    "semiFinalBPdcals1",
-    "solint",
-    "testgains",
-    "fluxgains",
-    "fluxboot",
-    "finalcals",
-    "applycals",
-    "targetflag",
-    "statwt",
-    "plotsummary",
-    "filecollect",
-    "weblog",
-]
-
 # Last script that was started
 last_state = time_list[-1]["pipestate"]
 last_status = time_list[-1]["status"]
 
 # Find index where we need to pick up at
-script_index = [i for i, x in enumerate(pipeline_scripts) if last_state == x][0]
+script_index = stage_index(PIPELINE_STAGES, last_state)
 
 # If script ended successfully then start on next script
 if last_status == "end":
@@ -49,10 +24,14 @@ if last_status == "end":
 if last_status == "start":
     time_list.pop(-1)
 
-for script_name in pipeline_scripts[script_index:]:
-    try:
-        exec_script(f"EVLA_pipe_{script_name}", globals())
-    except Exception as e:
-        logprint(f"Exiting script: {e}")
-    except KeyboardInterrupt as e:
-        logprint(f"Keyboard Interrupt: {e}")
+remaining_stages = PIPELINE_STAGES[script_index:]
+try:
+    run_stages(
+            remaining_stages,
+            globals(),
+            nprocs=globals().get("nprocs", default_nprocs()),
+    )
+except Exception as e:
+    logprint(f"Exiting script: {e}")
+except KeyboardInterrupt as e:
+    logprint(f"Keyboard Interrupt: {e}")
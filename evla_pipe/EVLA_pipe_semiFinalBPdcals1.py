@@ -5,19 +5,22 @@ not yet determined the spectral index of the bandpass calibrator).
 
 import copy
 
-import numpy as np
-
 from casatasks import gaincal, bandpass, applycal
 from casatools import table
-from casaplotms import plotms
 
 from . import pipeline_save
+from .calplot import plot_caltable
+from .flagledger import track_flags
+from .scheduler import plotms
 from .utils import (
     logprint,
     runtiming,
     RefAntHeuristics,
     semiFinaldelays,
+    testdelays,
+    trial_refants,
     getCalFlaggedSoln,
+    getCalAmpPhaseMax,
 )
 
 tb = table()
@@ -98,36 +101,24 @@ task_logprint(
 )
 
 os.system("rm -rf testdelay.k")
-for ii in range(5):
-    refAnt = str(RefAntOutput[ii])
-    task_logprint(f"Testing referance antenna: {refAnt}")
-    flaggedSolnResult = testdelays(
-        ms_active,
-        "delay.k",
-        delay_field_select_string,
-        delay_scan_select_string,
-        refAnt,
-        minBL_for_cal,
-        priorcals,
-        cal3C84_d,
-        uvrange3C84,
-    )
-    task_logprint(
-        "Fraction of flagged solutions = " + str(flaggedSolnResult["all"]["fraction"])
-    )
-    task_logprint(
-        "Median fraction of flagged solutions per antenna = "
-        + str(flaggedSolnResult["antmedian"]["fraction"])
-    )
-    if flaggedSolnResult["all"]["total"] > 0:
-        fracFlaggedSolns = flaggedSolnResult["antmedian"]["fraction"]
-    else:
-        fracFlaggedSolns = 1.0
-    if fracFlaggedSolns < critfrac:
-        task_logprint(f"Using {refAnt} as referance antenna.")
-        break
+refAnt, flaggedSolnResult, refAntPassed = trial_refants(
+    testdelays,
+    "delay.k",
+    RefAntOutput,
+    critfrac,
+    logfunc=task_logprint,
+    tables=("testdelayinitialgain.g",),
+    calMs=ms_active,
+    calField=delay_field_select_string,
+    calScans=delay_scan_select_string,
+    minBL_for_cal=minBL_for_cal,
+    priorcals=priorcals,
+    do3C84=cal3C84_d,
+    UVrange3C84=uvrange3C84,
+)
+if refAntPassed:
+    task_logprint(f"Using {refAnt} as referance antenna.")
 else:
-    # loop terminated without hitting `break` on a good antenna
     task_logprint(
         "WARNING, tried several reference antennas, there might be something wrong with your data"
     )
@@ -135,28 +126,9 @@ else:
 task_logprint("Delay calibration complete")
 
 task_logprint("Plotting delays")
-nplots = int(numAntenna / 3)
-if (numAntenna % 3) > 0:
-    nplots = nplots + 1
-for ii in range(nplots):
-    plotfile = f"delay{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    plotms(
-        vis="delay.k",
-        xaxis="freq",
-        yaxis="delay",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
-        plotrange=[],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
+plot_caltable("delay.k", numAntenna, [
+    dict(prefix="delay", xaxis="freq", yaxis="delay"),
+])
 
 # Do initial gaincal on BP calibrator then semi-final BP calibration
 os.system("rm -rf BPdinitialgain.g")
@@ -193,26 +165,14 @@ task_logprint("Initial gain calibration on BP calibrator complete")
 
 
 task_logprint("Plotting initial phase gain calibration on BP calibrator")
-for ii in range(nplots):
-    plotfile = f"BPinitialgainphase{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    # create plot
-    plotms(
-        vis="BPdinitialgain.g",
+plot_caltable("BPdinitialgain.g", numAntenna, [
+    dict(
+        prefix="BPinitialgainphase",
         xaxis="time",
         yaxis="phase",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, -180, 180],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
+    ),
+])
 
 
 os.system("rm -rf BPcal.b")
@@ -256,76 +216,22 @@ logprint(
 
 
 logprint("Plotting bandpass solutions")
-try:
-    tb.open("BPcal.b")
-    dataVarCol = tb.getvarcol("CPARAM")
-    flagVarCol = tb.getvarcol("FLAG")
-finally:
-    tb.close()
-rowlist = dataVarCol.keys()
-nrows = len(rowlist)
-maxmaxamp = 0.0
-maxmaxphase = 0.0
-for rrow in rowlist:
-    dataArr = dataVarCol[rrow]
-    flagArr = flagVarCol[rrow]
-    amps = np.abs(dataArr)
-    phases = np.arctan2(np.imag(dataArr), np.real(dataArr))
-    good = np.logical_not(flagArr)
-    tmparr = amps[good]
-    if len(tmparr) > 0:
-        maxamp = np.max(amps[good])
-        if maxamp > maxmaxamp:
-            maxmaxamp = maxamp
-    tmparr = np.abs(phases[good])
-    if len(tmparr) > 0:
-        maxphase = np.max(np.abs(phases[good])) * 180.0 / np.pi
-        if maxphase > maxmaxphase:
-            maxmaxphase = maxphase
-ampplotmax = maxmaxamp
-phaseplotmax = maxmaxphase
-
-for ii in range(nplots):
-    plotfile = f"BPcal_amp{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    # create plot
-    plotms(
-        vis="BPcal.b",
+ampplotmax, phaseplotmax = getCalAmpPhaseMax("BPcal.b")
+
+plot_caltable("BPcal.b", numAntenna, [
+    dict(
+        prefix="BPcal_amp",
         xaxis="freq",
         yaxis="amp",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, 0, ampplotmax],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
-
-for ii in range(nplots):
-    plotfile = f"BPcal_phase{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    # create plot
-    plotms(
-        vis="BPcal.b",
+    ),
+    dict(
+        prefix="BPcal_phase",
         xaxis="freq",
         yaxis="phase",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, -phaseplotmax, phaseplotmax],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
+    ),
+])
 task_logprint("Plotting complete")
 
 
@@ -334,20 +240,21 @@ AllCalTables = copy.copy(priorcals)
 AllCalTables.append("delay.k")
 AllCalTables.append("BPcal.b")
 ntables = len(AllCalTables)
-applycal(
-    vis=ms_active,
-    field="",
-    spw="",
-    selectdata=True,
-    scan=calibrator_scan_select_string,
-    gaintable=AllCalTables,
-    interp=[""],
-    spwmap=[],
-    parang=False,
-    calwt=[False] * ntables,
-    applymode="calflagstrict",
-    flagbackup=False,
-)
+with track_flags(ms_active, scan=calibrator_scan_select_string):
+    applycal(
+        vis=ms_active,
+        field="",
+        spw="",
+        selectdata=True,
+        scan=calibrator_scan_select_string,
+        gaintable=AllCalTables,
+        interp=[""],
+        spwmap=[],
+        parang=False,
+        calwt=[False] * ntables,
+        applymode="calflagstrict",
+        flagbackup=False,
+    )
 
 
 # NB: have to find a way to get plotms to reload data to show
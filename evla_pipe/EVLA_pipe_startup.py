@@ -115,6 +115,13 @@ try:
 except NameError:
     pipelineDateString = 'Unknown'
 
+# Engine of the rflag stages: "flagdata" for `flagdata(mode="rflag")` or
+# "numpy" for the streaming NumPy flagger.
+try:
+    rflag_engine
+except NameError:
+    rflag_engine = 'flagdata'
+
 
 # For now, use same ms name for Hanning smoothed data, for speed.
 # However, we only want to smooth the data the first time around, we do
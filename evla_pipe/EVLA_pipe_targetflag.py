@@ -3,8 +3,9 @@ Check the flagging of all calibrated data, including target using the `rflag`
 mode of `flagdata`.
 """
 
-from casatasks import flagdata, flagmanager
-
+from .flagledger import get_flag_ledger
+from .flagversions import get_flag_versions
+from .rflag import run_rflag
 from .utils import logprint, runtiming
 
 
@@ -18,14 +19,15 @@ QA2_targetflag = "Pass"
 
 task_logprint("Checking RFI flagging of all targets")
 
-# Run on all calibrator scans
-flagdata(
-    vis=ms_active,
-    mode="rflag",
+# Run on all calibrator scans and then on all target scans. The spws are
+# flagged in parallel when the pipeline has worker processes.
+# Drop "*TARGET*" if science target has strong spectral lines.
+screened = run_rflag(
+    ms_active,
+    intents=("*CALIBRATE*", "*TARGET*"),
     field="",
     correlation="ABS_" + corrstring,
     scan="",
-    intent="*CALIBRATE*",
     ntime="scan",
     combinescans=False,
     datacolumn="corrected",
@@ -33,55 +35,27 @@ flagdata(
     timedevscale=4.0,
     freqdevscale=4.0,
     extendflags=False,
-    action="apply",
     display="",
     flagbackup=True,
     savepars=True,
+    prescreen=True,
+    engine=rflag_engine,
+    report="logs/targetflag_prescreen.txt",
 )
 
-# Run on all target scans
-# Comment out if science target has strong spectral lines
-# or set spw to exclude these strong science spectral lines
-flagdata(
-    vis=ms_active,
-    mode="rflag",
-    field="",
-    correlation="ABS_" + corrstring,
-    scan="",
-    intent="*TARGET*",
-    ntime="scan",
-    combinescans=False,
-    datacolumn="corrected",
-    winsize=3,
-    timedevscale=4.0,
-    freqdevscale=4.0,
-    extendflags=False,
-    action="apply",
-    display="",
-    flagbackup=True,
-    savepars=True,
+nskipped = sum(not entry["rflag"] for entry in screened)
+task_logprint(
+    f"rflag skipped on {nskipped} of {len(screened)} clean spw/scan selections"
 )
 
 # Save final version of flags
-flagmanager(
-    vis=ms_active,
-    mode="save",
-    versionname="finalflags",
-    comment="Final flags saved after calibrations and rflag",
-    merge="replace",
+get_flag_versions(ms_active).save(
+    "finalflags", comment="Final flags saved after calibrations and rflag",
 )
 task_logprint(f"Flag column saved to 'finalflags'")
 
 # Calculate final flag statistics
-final_flags = flagdata(
-    vis=ms_active,
-    mode="summary",
-    spwchan=True,
-    spwcorr=True,
-    basecnt=True,
-    action="calculate",
-    savepars=False,
-)
+final_flags = get_flag_ledger(ms_active).summary()
 
 frac_flagged_on_source2 = 1.0 - (
     (start_total - final_flags["flagged"]) / init_on_source_vis
@@ -5,20 +5,24 @@ Test bandpass and delay calibration.
 import os
 import copy
 
-import numpy as np
-
 from casatasks import gaincal, bandpass, applycal
 from casatools import table
-from casaplotms import plotms
 
 from . import pipeline_save
+from .calplot import plot_caltable
+from .flagledger import track_flags
+from .scheduler import plotms
+from .solintpredict import SolintPredictor, write_prediction_log
 from .utils import (
         runtiming,
         logprint,
         RefAntHeuristics,
         testdelays,
         testBPdgains,
+        trial_refants,
+        speculative_search,
         getCalFlaggedSoln,
+        getCalAmpPhaseMax,
 )
 
 tb = table()
@@ -87,65 +91,33 @@ task_logprint("Initial phase calibration on delay calibrator complete")
 # high fraction of flagged solutions.
 # NOTE For the future investigate multiband delay.
 os.system("rm -rf testdelay.k")
-for ii in range(5):
-    refAnt = str(RefAntOutput[ii])
-    task_logprint(f"Testing referance antenna: {refAnt}")
-    flaggedSolnResult = testdelays(
-        ms_active,
-        "testdelay.k",
-        delay_field_select_string,
-        delay_scan_select_string,
-        refAnt,
-        minBL_for_cal,
-        priorcals,
-        cal3C84_d,
-        uvrange3C84,
-    )
-    task_logprint(
-        "Fraction of flagged solutions = " + str(flaggedSolnResult["all"]["fraction"])
-    )
-    task_logprint(
-        "Median fraction of flagged solutions per antenna = "
-        + str(flaggedSolnResult["antmedian"]["fraction"])
-    )
-    if flaggedSolnResult["all"]["total"] > 0:
-        fracFlaggedSolns = flaggedSolnResult["antmedian"]["fraction"]
-    else:
-        fracFlaggedSolns = 1.0
-    if fracFlaggedSolns < critfrac:
-        task_logprint(f"Using {refAnt} as referance antenna.")
-        break
+refAnt, flaggedSolnResult, refAntPassed = trial_refants(
+    testdelays,
+    "testdelay.k",
+    RefAntOutput,
+    critfrac,
+    logfunc=task_logprint,
+    tables=("testdelayinitialgain.g",),
+    calMs=ms_active,
+    calField=delay_field_select_string,
+    calScans=delay_scan_select_string,
+    minBL_for_cal=minBL_for_cal,
+    priorcals=priorcals,
+    do3C84=cal3C84_d,
+    UVrange3C84=uvrange3C84,
+)
+if refAntPassed:
+    task_logprint(f"Using {refAnt} as referance antenna.")
 else:
-    # loop terminated without hitting `break` on a good antenna
     task_logprint(
         "WARNING, tried several reference antennas, there might be something wrong with your data"
     )
     QA2_testBPdcals = "Fail"
 
 task_logprint("Plotting test delays")
-nplots = int(numAntenna / 3)
-if (numAntenna % 3) > 0:
-    nplots = nplots + 1
-for ii in range(nplots):
-    plotfile = f"testdelay{ii}.png"
-    os.system(f"rm -rf {plotfile}")
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    plotms(
-        vis="testdelay.k",
-        xaxis="freq",
-        yaxis="delay",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
-        plotrange=[],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
+plot_caltable("testdelay.k", numAntenna, [
+    dict(prefix="testdelay", xaxis="freq", yaxis="delay"),
+])
 
 
 # Do initial amplitude and phase gain solutions on the BPcalibrator and delay
@@ -165,38 +137,79 @@ if delay_scan_select_string == bandpass_scan_select_string:
 else:
     testgainscans = bandpass_scan_select_string + "," + delay_scan_select_string
 flagging_threshold = 0.05
-for time_factor in (1.0, 3.0, 10.0):
-    soltime = time_factor * int_time
-    solint = f"{soltime}s"
-    os.system("rm -rf testBPdinitialgain.g")
-    flaggedSolnResult1 = testBPdgains(
-        ms_active,
-        "testBPdinitialgain.g",
-        tst_bpass_spw,
-        testgainscans,
-        solint,
-        refAnt,
-        minBL_for_cal,
-        priorcals,
-        cal3C84,
-        uvrange3C84,
+soltimes = [time_factor * int_time for time_factor in (1.0, 3.0, 10.0)]
+solints = [f"{soltime}s" for soltime in soltimes]
+
+
+# Predict the shortest solint with enough SNR and only solve for it, and for
+# the next longer one if it fails.
+testgainfields = sorted({
+    int(field)
+    for field in f"{bandpass_field_select_string},{delay_field_select_string}".split(",")
+})
+predictor = SolintPredictor(
+    ms_active,
+    testgainscans,
+    testgainfields,
+    field_names,
+    fluxscale_result=globals().get("fluxscale_result"),
+    spw=tst_bpass_spw,
+)
+solint_rounds, solint_prediction = predictor.search_rounds(
+    soltimes, minsnr=5.0, critfrac=flagging_threshold, logfunc=task_logprint,
+)
+if solint_prediction is not None:
+    task_logprint(
+        f"Predicted short solint = {solints[solint_prediction['index']]}"
     )
-    frac_flagged = flaggedSolnResult1["all"]["fraction"]
-    frac_flagged_med = flaggedSolnResult1["antmedian"]["fraction"]
-    frac_flagged_tot = flaggedSolnResult1["all"]["total"]
+
+
+def log_solint_trial(index, flaggedSolnResult):
+    frac_flagged = flaggedSolnResult["all"]["fraction"]
+    frac_flagged_med = flaggedSolnResult["antmedian"]["fraction"]
     task_logprint(
-        f"For solint = {solint} fraction of flagged solutions = {frac_flagged}"
+        f"For solint = {solints[solint_order[index]]} fraction of flagged solutions = {frac_flagged}"
     )
     task_logprint(
         f"Median fraction of flagged solutions per antenna = {frac_flagged_med}"
     )
-    if frac_flagged_tot > 0:
-        fracFlaggedSolns1 = frac_flagged_med
-    else:
-        fracFlaggedSolns1 = 1.0
-    if fracFlaggedSolns1 < flagging_threshold:
-        task_logprint(f"Using short solution interval: {solint}")
+
+
+# The trials of a round are solved at once when there are worker processes
+# available, but the first one in order that passes is always chosen.
+for solint_order in solint_rounds:
+    trial_index, flaggedSolnResult1, solint_passed = speculative_search(
+        testBPdgains,
+        "testBPdinitialgain.g",
+        [
+            dict(
+                calMs=ms_active,
+                calSpw=tst_bpass_spw,
+                calScans=testgainscans,
+                calSolint=solints[ii],
+                refAnt=refAnt,
+                minBL_for_cal=minBL_for_cal,
+                priorcals=priorcals,
+                do3C84=cal3C84,
+                UVrange3C84=uvrange3C84,
+            )
+            for ii in solint_order
+        ],
+        flagging_threshold,
+        log_trial=log_solint_trial,
+        tables=("testdelay.k",),
+    )
+    solint_index = solint_order[trial_index]
+    if solint_passed:
         break
+write_prediction_log(
+    "logs/solint_prediction.txt", "testBPdcals", soltimes, solint_prediction,
+    solint_index, solint_passed, flaggedSolnResult1,
+)
+soltime = soltimes[solint_index]
+solint = solints[solint_index]
+if solint_passed:
+    task_logprint(f"Using short solution interval: {solint}")
 else:
     task_logprint(
         "WARNING, large fraction of flagged solutions, there might be something wrong with your data."
@@ -210,50 +223,17 @@ task_logprint(
 )
 
 
-# Plot amplitude gain solutions
-for ii in range(nplots):
-    plotfile = f"testBPdinitialgainamp{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    # create plot
-    plotms(
-        vis="testBPdinitialgain.g",
-        xaxis="time",
-        yaxis="amp",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
-        plotrange=[],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
-
-# Plot phase gain solutions
-task_logprint("Plotting phase gain solutions")
-for ii in range(nplots):
-    plotfile = f"testBPdinitialgainphase{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    # create plot
-    plotms(
-        vis="testBPdinitialgain.g",
+# Plot amplitude and phase gain solutions
+task_logprint("Plotting amplitude and phase gain solutions")
+plot_caltable("testBPdinitialgain.g", numAntenna, [
+    dict(prefix="testBPdinitialgainamp", xaxis="time", yaxis="amp"),
+    dict(
+        prefix="testBPdinitialgainphase",
         xaxis="time",
         yaxis="phase",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, -180, 180],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
+    ),
+])
 
 
 # Now do test BPcal
@@ -303,77 +283,22 @@ task_logprint(
 )
 
 # Plot BP solutions and check for missing spws, antennas, etc.
-try:
-    tb.open("testBPcal.b")
-    dataVarCol = tb.getvarcol("CPARAM")
-    flagVarCol = tb.getvarcol("FLAG")
-finally:
-    tb.close()
-rowlist = dataVarCol.keys()
-nrows = len(rowlist)
-maxmaxamp = 0.0
-maxmaxphase = 0.0
-for rrow in rowlist:
-    dataArr = dataVarCol[rrow]
-    flagArr = flagVarCol[rrow]
-    amps = np.abs(dataArr)
-    phases = np.arctan2(np.imag(dataArr), np.real(dataArr))
-    good = np.logical_not(flagArr)
-    tmparr = amps[good]
-    if len(tmparr) > 0:
-        maxamp = np.max(amps[good])
-        if maxamp > maxmaxamp:
-            maxmaxamp = maxamp
-    tmparr = np.abs(phases[good])
-    if len(tmparr) > 0:
-        maxphase = np.max(np.abs(phases[good])) * 180.0 / np.pi
-        if maxphase > maxmaxphase:
-            maxmaxphase = maxphase
-
-ampplotmax = maxmaxamp
-phaseplotmax = maxmaxphase
-
-for ii in range(nplots):
-    plotfile = f"testBPcal_amp{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    # create plot
-    plotms(
-        vis="testBPcal.b",
+ampplotmax, phaseplotmax = getCalAmpPhaseMax("testBPcal.b")
+
+plot_caltable("testBPcal.b", numAntenna, [
+    dict(
+        prefix="testBPcal_amp",
         xaxis="freq",
         yaxis="amp",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, 0, ampplotmax],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
-
-for ii in range(nplots):
-    plotfile = f"testBPcal_phase{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    # create plot
-    plotms(
-        vis="testBPcal.b",
+    ),
+    dict(
+        prefix="testBPcal_phase",
         xaxis="freq",
         yaxis="phase",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, -phaseplotmax, phaseplotmax],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
+    ),
+])
 
 task_logprint("Plotting of test bandpass solutions complete")
 
@@ -417,23 +342,24 @@ AllCalTables.append("testBPdinitialgain.g")
 AllCalTables.append("testBPcal.b")
 ntables = len(AllCalTables)
 
-applycal(
-    vis=ms_active,
-    field="",
-    spw="",
-    intent="",
-    selectdata=True,
-    scan=testgainscans,
-    docallib=False,
-    gaintable=AllCalTables,
-    gainfield=[""],
-    interp=[""],
-    spwmap=[],
-    calwt=[False] * ntables,
-    parang=False,
-    applymode="calflagstrict",
-    flagbackup=False,
-)
+with track_flags(ms_active, scan=testgainscans):
+    applycal(
+        vis=ms_active,
+        field="",
+        spw="",
+        intent="",
+        selectdata=True,
+        scan=testgainscans,
+        docallib=False,
+        gaintable=AllCalTables,
+        gainfield=[""],
+        interp=[""],
+        spwmap=[],
+        calwt=[False] * ntables,
+        parang=False,
+        applymode="calflagstrict",
+        flagbackup=False,
+    )
 
 task_logprint("Plot calibrated bandpass and delay calibrators")
 os.system("rm -rf testcalibratedBPcal.png")
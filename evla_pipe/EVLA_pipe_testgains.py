@@ -9,12 +9,16 @@ testgaincal.g in the table cache unless it has been exited using
 the gui, so only plot the final versions.
 """
 
-from casatasks import rmtables
 from casatools import table
-from casaplotms import plotms
 
 from . import pipeline_save
-from .utils import (logprint, runtiming, RefAntHeuristics, testgains, getCalFlaggedSoln)
+from .calplot import plot_caltable
+from .calsubset import CalibratorSubset
+from .solintpredict import SolintPredictor, write_prediction_log
+from .utils import (
+        logprint, runtiming, RefAntHeuristics, testgains, getCalFlaggedSoln,
+        speculative_search,
+)
 
 tb = table()
 
@@ -27,6 +31,15 @@ task_logprint("*** Starting EVLA_pipe_testgains.py ***")
 time_list = runtiming("testgains", "start")
 QA2_testgains = "Pass"
 
+# Split out calibrators, dropping flagged data; note that it may be
+# important *not* to select on field ID, so that fields don't get
+# renumbered by split
+task_logprint("Splitting out calibrators into calibrators.ms")
+calibrator_subset = CalibratorSubset(
+    ms_active, calibrator_scan_select_string, int(max(channels)),
+)
+task_logprint(f"Calibrator MS {calibrator_subset.update(clear_models=True)}")
+
 print("\nFinding a reference antenna for gain calibrations\n")
 
 refantspw = ""
@@ -51,42 +64,83 @@ task_logprint("Doing test gain calibration")
 
 # Start with solint='int' -> 1 * int_time
 tst_gcal_spw = ""
+soltimes = []
+solints = []
+combtimes = []
 for time_factor in (1.0, 3.0, 10.0, "inf"):
     if isinstance(time_factor, float):
-        soltime = time_factor * int_time
-        solint = f"{soltime}s"
-        combtime = "scan"
+        soltimes.append(time_factor * int_time)
+        solints.append(f"{time_factor * int_time}s")
+        combtimes.append("scan")
     else:
-        soltime = longsolint
-        solint = time_factor
-        combtime = ""
-    rmtables("testgaincal.g")
-    flaggedSolnResult1 = testgains(
-        "calibrators.ms",
-        "testgaincal.g",
-        tst_gcal_spw,
-        calibrator_scan_select_string,
-        solint,
-        refAnt,
-        minBL_for_cal,
-        combtime,
+        soltimes.append(longsolint)
+        solints.append(time_factor)
+        combtimes.append("")
+
+
+# Predict the shortest solint with enough SNR and only solve for it, and for
+# the next longer one if it fails.
+predictor = SolintPredictor(
+    ms_active,
+    calibrator_scan_select_string,
+    calibrator_field_list,
+    field_names,
+    fluxscale_result=globals().get("fluxscale_result"),
+    calms="calibrators.ms",
+    spw=tst_gcal_spw,
+)
+solint_rounds, solint_prediction = predictor.search_rounds(
+    soltimes, minsnr=5.0, critfrac=flagging_threshold, logfunc=task_logprint,
+)
+if solint_prediction is not None:
+    task_logprint(
+        f"Predicted short solint = {solints[solint_prediction['index']]}"
     )
-    frac_flagged = flaggedSolnResult1["all"]["fraction"]
-    frac_flagged_med = flaggedSolnResult1["antmedian"]["fraction"]
-    frac_flagged_tot = flaggedSolnResult1["all"]["total"]
+
+
+def log_solint_trial(index, flaggedSolnResult):
+    frac_flagged = flaggedSolnResult["all"]["fraction"]
+    frac_flagged_med = flaggedSolnResult["antmedian"]["fraction"]
     task_logprint(
-        f"For solint = {solint}, fraction of flagged solutions = {frac_flagged}"
+        f"For solint = {solints[solint_order[index]]}, fraction of flagged solutions = {frac_flagged}"
     )
     task_logprint(
         f"Median fraction of flagged solutions per antenna = {frac_flagged_med}"
     )
-    if frac_flagged_tot > 0:
-        fracFlaggedSolns1 = frac_flagged_med
-    else:
-        fracFlaggedSolns1 = 1.0
-    if fracFlaggedSolns1 < flagging_threshold:
-        task_logprint(f"Using short solution interval: {solint}")
+
+
+# The trials of a round are solved at once when there are worker processes
+# available, but the first one in order that passes is always chosen.
+for solint_order in solint_rounds:
+    trial_index, flaggedSolnResult1, solint_passed = speculative_search(
+        testgains,
+        "testgaincal.g",
+        [
+            dict(
+                calMs="calibrators.ms",
+                calSpw=tst_gcal_spw,
+                calScans=calibrator_scan_select_string,
+                calSolint=solints[ii],
+                refAnt=refAnt,
+                minBL_for_cal=minBL_for_cal,
+                combtime=combtimes[ii],
+            )
+            for ii in solint_order
+        ],
+        flagging_threshold,
+        log_trial=log_solint_trial,
+    )
+    solint_index = solint_order[trial_index]
+    if solint_passed:
         break
+write_prediction_log(
+    "logs/solint_prediction.txt", "testgains", soltimes, solint_prediction,
+    solint_index, solint_passed, flaggedSolnResult1,
+)
+soltime = soltimes[solint_index]
+solint = solints[solint_index]
+if solint_passed:
+    task_logprint(f"Using short solution interval: {solint}")
 else:
     task_logprint(
             "WARNING, large fraction of flagged solutions, "
@@ -113,49 +167,22 @@ amps = np.abs(cpar)
 good = np.logical_not(flgs)
 maxamp = np.max(amps[good])
 
-# Plot time vs amplitude for gain solutions.
-task_logprint("Plotting amplitude gain solutions.")
-for ii in range(nplots):
-    plotfile = f"testgaincal_amp{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    # create plot
-    plotms(
-        vis="testgaincal.g",
+# Plot time vs amplitude and phase for gain solutions.
+task_logprint("Plotting amplitude and phase gain solutions.")
+plot_caltable("testgaincal.g", numAntenna, [
+    dict(
+        prefix="testgaincal_amp",
         xaxis="time",
         yaxis="amp",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, 0, maxamp],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
-task_logprint("Plotting phase gain solutions")
-for ii in range(nplots):
-    plotfile = f"testgaincal_phase{ii}.png"
-    ant_select = str(ii * 3) + "~" + str(ii * 3 + 2)
-    # create plot
-    plotms(
-        vis="testgaincal.g",
+    ),
+    dict(
+        prefix="testgaincal_phase",
         xaxis="time",
         yaxis="phase",
-        antenna=ant_select,
-        spw="",
-        timerange="",
-        gridrows=3,
-        coloraxis="spw",
-        iteraxis="antenna",
         plotrange=[0, 0, -180, 180],
-        showgui=False,
-        plotfile=plotfile,
-        highres=True,
-        overwrite=True,
-    )
+    ),
+])
 task_logprint("Plotting finished.")
 
 
@@ -31,7 +31,6 @@ for qa in (
     "QA2_priorcals",
     "QA2_testBPdcals",
     "QA2_flag_baddeformatters",
-    "QA2_flag_baddeformattersphase",
     "QA2_checkflag",
     "QA2_semiFinalBPdcals1",
     "QA2_checkflag_semiFinal",
@@ -58,7 +57,6 @@ all_QA2 = [
     QA2_priorcals,
     QA2_testBPdcals,
     QA2_flag_baddeformatters,
-    QA2_flag_baddeformattersphase,
     QA2_checkflag,
     QA2_semiFinalBPdcals1,
     QA2_checkflag_semiFinal,
@@ -89,7 +87,6 @@ with open("QA2_scores.txt", "w") as qalog:
     qalog.write("QA2_priorcals=" + QA2_priorcals + "\n")
     qalog.write("QA2_testBPdcals=" + QA2_testBPdcals + "\n")
     qalog.write("QA2_flag_baddeformatters=" + QA2_flag_baddeformatters + "\n")
-    qalog.write("QA2_flag_baddeformattersphase=" + QA2_flag_baddeformattersphase + "\n")
     qalog.write("QA2_checkflag=" + QA2_checkflag + "\n")
     qalog.write("QA2_semiFinalBPdcals1=" + QA2_semiFinalBPdcals1 + "\n")
     qalog.write("QA2_checkflag_semiFinal=" + QA2_checkflag_semiFinal + "\n")
@@ -562,7 +559,7 @@ wlog.write("</ul>\n")
 wlog.write("<br>\n")
 wlog.write("<hr>\n")
 wlog.write(
-    "<br>Identify basebands/spws with bad deformatters/RFI based on BP table amplitudes: \n"
+    "<br>Identify basebands/spws with bad deformatters/RFI based on BP table amplitudes and phases: \n"
 )
 wlog.write("<ul>\n")
 wlog.write("<li>Script: EVLA_pipe_flag_baddeformatters.py</li>\n")
@@ -573,24 +570,15 @@ wlog.write("<li>QA2 score: " + QA2_flag_baddeformatters + " </li>\n")
 wlog.write("</ul>\n")
 wlog.write("<br>\n")
 wlog.write("<hr>\n")
-wlog.write(
-    "<br>Identify basebands/spws with bad deformatters/RFI based on BP table phases: \n"
-)
-wlog.write("<ul>\n")
-wlog.write("<li>Script: EVLA_pipe_flag_baddeformattersphase.py</li>\n")
-wlog.write(
-    '<li>Log: <a href="./logs/flag_baddeformattersphase.log" type="text/plain" target="_blank">link</a></li>\n'
-)
-wlog.write("<li>QA2 score: " + QA2_flag_baddeformattersphase + " </li>\n")
-wlog.write("</ul>\n")
-wlog.write("<br>\n")
-wlog.write("<hr>\n")
 wlog.write("<br>RFLAG on calibrated BP/delay calibrators: \n")
 wlog.write("<ul>\n")
 wlog.write("<li>Script: EVLA_pipe_checkflag.py</li>\n")
 wlog.write(
     '<li>Log: <a href="./logs/checkflag.log" type="text/plain" target="_blank">link</a></li>\n'
 )
+wlog.write(
+    '<li>rflag pre-screen: <a href="./logs/checkflag_prescreen.txt" type="text/plain" target="_blank">link</a></li>\n'
+)
 wlog.write("<li>QA2 score: " + QA2_checkflag + " </li>\n")
 wlog.write("</ul>\n")
 wlog.write("<br>\n")
@@ -615,6 +603,9 @@ wlog.write("<li>Script: EVLA_pipe_checkflag_semiFinal.py</li>\n")
 wlog.write(
     '<li>Log: <a href="./logs/checkflag_semiFinal.log" type="text/plain" target="_blank">link</a></li>\n'
 )
+wlog.write(
+    '<li>rflag pre-screen: <a href="./logs/checkflag_semiFinal_prescreen.txt" type="text/plain" target="_blank">link</a></li>\n'
+)
 wlog.write("<li>QA2 score: " + QA2_checkflag_semiFinal + " </li>\n")
 wlog.write("</ul>\n")
 wlog.write("<br>\n")
@@ -713,6 +704,9 @@ wlog.write("<li>Script: EVLA_pipe_targetflag.py</li>\n")
 wlog.write(
     '<li>Log: <a href="./logs/targetflag.log" type="text/plain" target="_blank">link</a></li>\n'
 )
+wlog.write(
+    '<li>rflag pre-screen: <a href="./logs/targetflag_prescreen.txt" type="text/plain" target="_blank">link</a></li>\n'
+)
 wlog.write("<li>QA2 score: " + QA2_targetflag + " </li>\n")
 wlog.write("</ul>\n")
 wlog.write("<br>\n")
@@ -34,6 +34,11 @@ from pathlib import Path
 
 from casatasks import version
 
+from .checkpoint import get_checkpoint_store
+from .scheduler import (
+        PIPELINE_STAGES, TaskScheduler, default_nprocs, set_scheduler,
+)
+
 
 __version__ = (2, 0, 0)
 __version_str__ = ".".join(str(i) for i in __version__)
@@ -50,25 +55,67 @@ if casa_version[:-1] > (6, 1, 0):
 PIPE_PATH = Path(__file__).parent
 
 
-def pipeline_save(filen="pipeline_shelf.restore"):
-    with shelve.open(filen, "c") as shelf:
-        with open(PIPE_PATH / "EVLA_pipe_restore.list") as f:
-            lines = f.read().split("\n")
-        for key in lines:
-            if key == "":
-                continue
-            try:
-                shelf[key] = globals()[key]
-            except KeyError:
-                pass
-
-
-def pipeline_restore(filen="pipeline_shelf.restore"):
-    if not os.path.exists(filen):
-        raise ValueError(f"Restore point does not exist: {filen}")
-    else:
+CHECKPOINT_DIR = "pipeline_checkpoint"
+
+
+def _restore_keys():
+    with open(PIPE_PATH / "EVLA_pipe_restore.list") as f:
+        lines = f.read().split("\n")
+    return [key for key in lines if key != ""]
+
+
+def _current_stage(context):
+    time_list = context.get("time_list")
+    if not time_list:
+        return None
+    return time_list[-1]["pipestate"]
+
+
+def pipeline_save(filen=CHECKPOINT_DIR, substep=None):
+    """
+    Checkpoint the context keys listed in `EVLA_pipe_restore.list`. Only the
+    values that changed since the last checkpoint are written.
+
+    Parameters
+    ----------
+    filen : str
+        Checkpoint directory.
+    substep : str, None
+        Name of the sub-step of the running stage that finished. If unset,
+        record the end of the stage.
+    """
+    context = globals()
+    store = get_checkpoint_store(filen)
+    store.save(
+            context,
+            _restore_keys(),
+            stage=_current_stage(context),
+            substep=substep,
+    )
+
+
+def pipeline_restore(filen=CHECKPOINT_DIR):
+    if os.path.isdir(filen):
+        store = get_checkpoint_store(filen)
+        if not store.exists():
+            raise ValueError(f"Restore point does not exist: {filen}")
+        globals().update(store.load())
+    elif os.path.exists(filen):
+        # Restore point written by `shelve` in earlier versions
         with shelve.open(filen) as shelf:
             globals().update(shelf)
+    else:
+        raise ValueError(f"Restore point does not exist: {filen}")
+
+
+def substep_done(substep, filen=CHECKPOINT_DIR):
+    """
+    True if `substep` of the running stage was checkpointed by an earlier,
+    interrupted run of the stage. Scripts use this to skip the sub-steps
+    that were completed before a restart.
+    """
+    store = get_checkpoint_store(filen)
+    return store.completed(_current_stage(globals()), substep)
 
 
 def execfile(filepath, global_vars=None):
@@ -88,101 +135,55 @@ def exec_script(name, context):
     execfile(script_path, global_vars=context)
 
 
-def run_pipeline(context=None):
-    if context is None:
-        context = globals()
+def run_stages(stages, context, nprocs=1):
+    """
+    Execute pipeline stages on the shared context. Work submitted by the
+    scripts to the task scheduler runs concurrently in `nprocs` worker
+    processes and is synchronized against the resources declared by the
+    stages.
+
+    Parameters
+    ----------
+    stages : list of Stage
+    context : dict
+    nprocs : int
+    """
+    from .utils import MAINLOG
+    scheduler = TaskScheduler(nprocs=nprocs, logfile=MAINLOG)
+    set_scheduler(scheduler)
     try:
-        # The following script includes all the definitions and functions and
-        # prior inputs needed by a run of the pipeline.
-        exec_script("EVLA_pipe_startup", context)
-
-        # Import the data to CASA.
-        exec_script("EVLA_pipe_import", context)
-
-        # Hanning smooth.
-        # NOTE: This step is optional and likely unwanted for spectral line
-        # projects, but Hanning may be important if there is strong, narrowband RFI.
-        exec_script("EVLA_pipe_hanning", context)
-
-        # Get information from the MS that will be needed later, list the data, and
-        # write generic diagnostic plots.
-        exec_script("EVLA_pipe_msinfo", context)
-
-        # Deterministic flagging: (1) time-based for online flags, shadowed data,
-        # zeroes, pointing scans, quacking, and (2) channel-based for end 5% of
-        # channels of each SpW, 10 end channels at edges of basebands.
-        exec_script("EVLA_pipe_flagall", context)
-
-        # Prepare for calibrations. Fill model columns for primary calibrators.
-        exec_script("EVLA_pipe_calprep", context)
-
-        # Apply "prior" calibrations (gain curves, opacities, antenna position
-        # corrections, and requantizer gains). Plot switched power tables,
-        # although not currently used in calibration.
-        exec_script("EVLA_pipe_priorcals", context)
-
-        # Initial test calibrations using bandpass and delay calibrators.
-        exec_script("EVLA_pipe_testBPdcals", context)
-
-        # Identify and flag basebands with bad deformatters or RFI based on
-        # the bandpass table amplitudes and phases.
-        exec_script("EVLA_pipe_flag_baddeformatters", context)
-
-        # Flag possible RFI on the bandpass calibrator using `rflag`.
-        exec_script("EVLA_pipe_checkflag", context)
-
-        # Do semi-final delay and bandpass calibrations. This step is "semi-final"
-        # because we have not yet determined the spectral index of the bandpass
-        # calibrator.
-        exec_script("EVLA_pipe_semiFinalBPdcals1", context)
-
-        # Use flagdata again on calibrators
-        exec_script("EVLA_pipe_checkflag_semiFinal", context)
-
-        # Re-run semiFinalBPdcals following flagging with `rflag` above.
-        exec_script("EVLA_pipe_semiFinalBPdcals1", context)
-
-        # Determine solution interval (solint) for scan-average equivalent.
-        exec_script("EVLA_pipe_solint", context)
-
-        # Do test gain calibrations to establish short solution interval.
-        exec_script("EVLA_pipe_testgains", context)
-
-        # Make gain table for flux density bootstrapping. Create gain table with
-        # gain and opacity corrections for final amplitude calibration for flux
-        # density bootstrapping.
-        exec_script("EVLA_pipe_fluxgains", context)
-
-        # Flag gain table prior to flux density bootstrapping.
-        # NOTE: Break here to flag the gain table interatively, if desired; this
-        # step is not included in real-time pipeline otherwise.
-        #exec_script("EVLA_pipe_fluxflag", context)
-
-        # Perform the flux density bootstrapping. This fits spectral index of
-        # calibrators with a power-law and writes values into the model column.
-        exec_script("EVLA_pipe_fluxboot", context)
-
-        # Make final calibration tables.
-        exec_script("EVLA_pipe_finalcals", context)
-
-        # Apply all calibrations and check calibrated data.
-        exec_script("EVLA_pipe_applycals", context)
-
-        # Now run all calibrated data (including target) through `rflag`.
-        exec_script("EVLA_pipe_targetflag", context)
-
-        # Calculate data weights based on standard deviation within each SpW.
-        exec_script("EVLA_pipe_statwt", context)
-
-        # Make final uv plots.
-        exec_script("EVLA_pipe_plotsummary", context)
+        with scheduler:
+            for stage in stages:
+                scheduler.wait_for_stage(stage)
+                exec_script(stage.script, context)
+    finally:
+        set_scheduler(None)
+    return context
 
-        # Collect relevant plots and tables.
-        exec_script("EVLA_pipe_filecollect", context)
 
-        # Write weblog.
-        exec_script("EVLA_pipe_weblog", context)
+def run_pipeline(context=None, nprocs=None):
+    """
+    Run all stages of the pipeline.
+
+    Parameters
+    ----------
+    context : dict, None
+        Global namespace shared by the scripts. If unset, use the module
+        globals.
+    nprocs : int, None
+        Number of worker processes for the independent tasks, such as
+        plotting. If unset, use the value of `nprocs` in the context or a
+        default based on the number of CPUs. Set to 1 to run serially.
+    """
+    if context is None:
+        context = globals()
+    if nprocs is None:
+        nprocs = context.get("nprocs", default_nprocs())
+    context["nprocs"] = nprocs
+    # A new run starts from an empty checkpoint
+    get_checkpoint_store(CHECKPOINT_DIR).clear()
+    try:
+        run_stages(PIPELINE_STAGES, context, nprocs=nprocs)
     except KeyboardInterrupt as e:
         logprint(f"Keyboard Interrupt: {e}")
     return context
-
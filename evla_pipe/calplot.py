@@ -0,0 +1,255 @@
+"""
+Plots of calibration tables with NumPy and matplotlib.
+
+A calibration table is read once and every page of every requested plot is
+rendered from memory, instead of starting one `plotms` call per page. The
+pages follow the `plotms` layout used by the pipeline: three antennas per
+page, one panel per antenna, colored by spw, and written to
+``<prefix><page>.png``. If matplotlib is not installed then the pages are made
+with `plotms` as before.
+
+Example:
+
+```
+plot_caltable("testBPcal.b", numAntenna, [
+    dict(prefix="testBPcal_amp", xaxis="freq", yaxis="amp"),
+    dict(prefix="testBPcal_phase", xaxis="freq", yaxis="phase",
+         plotrange=[0, 0, -180, 180]),
+])
+```
+"""
+
+import numpy as np
+
+from casatools import table
+
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+except ImportError:
+    plt = None
+
+from .scheduler import get_scheduler
+
+
+ANTS_PER_PAGE = 3
+
+YAXIS_LABELS = {
+        "amp": "Gain Amplitude",
+        "phase": "Gain Phase (deg)",
+        "delay": "Delay (ns)",
+        "spgain": "SwPower Gain",
+        "tsys": "Tsys (K)",
+}
+
+XAXIS_LABELS = {
+        "time": "Time (hours UT)",
+        "freq": "Frequency (GHz)",
+}
+
+CORRELATION_INDEX = {"R": 0, "X": 0, "L": 1, "Y": 1}
+
+
+def page_count(nant):
+    return (nant + ANTS_PER_PAGE - 1) // ANTS_PER_PAGE
+
+
+def page_files(prefix, nant):
+    return [f"{prefix}{ii}.png" for ii in range(page_count(nant))]
+
+
+class CalTableData:
+    """
+    Contents of a calibration table, grouped by spw.
+
+    Parameters
+    ----------
+    caltable : str
+    """
+
+    def __init__(self, caltable):
+        self.caltable = caltable
+        self.spws = {}
+        self.chan_freq = {}
+        tb = table()
+        try:
+            tb.open(caltable)
+            parcol = "CPARAM" if "CPARAM" in tb.colnames() else "FPARAM"
+            spw_ids = np.unique(tb.getcol("SPECTRAL_WINDOW_ID"))
+            for spw in spw_ids:
+                subtb = tb.query(f"SPECTRAL_WINDOW_ID=={spw}")
+                try:
+                    self.spws[int(spw)] = {
+                            "time": subtb.getcol("TIME"),
+                            "antenna": subtb.getcol("ANTENNA1"),
+                            "param": subtb.getcol(parcol),
+                            "flag": subtb.getcol("FLAG"),
+                    }
+                finally:
+                    subtb.close()
+        finally:
+            tb.close()
+        try:
+            tb.open(f"{caltable}/SPECTRAL_WINDOW")
+            for spw in self.spws:
+                self.chan_freq[spw] = tb.getcell("CHAN_FREQ", spw)
+        finally:
+            tb.close()
+        try:
+            tb.open(f"{caltable}/ANTENNA")
+            self.antenna_names = list(tb.getcol("NAME"))
+        finally:
+            tb.close()
+        times = [d["time"] for d in self.spws.values() if len(d["time"]) > 0]
+        # Times are plotted in hours from the start of the first day.
+        self.day_start = (
+                np.floor(np.min(np.concatenate(times)) / 86400) * 86400
+                if times else 0.0
+        )
+
+    def values(self, spw, yaxis, correlation=""):
+        """
+        Plotted values and flags of `spw` with shape (npol, nchan, nrow).
+        """
+        data = self.spws[spw]
+        param, flag = data["param"], data["flag"]
+        if yaxis == "amp":
+            values = np.abs(param)
+        elif yaxis == "phase":
+            values = np.degrees(np.angle(param))
+        elif yaxis == "delay":
+            values = param.real
+        elif yaxis in ("spgain", "tsys"):
+            # Switched power tables interleave the gain and Tsys per
+            # polarization.
+            offset = 0 if yaxis == "spgain" else 1
+            values = param.real[offset::2]
+            flag = flag[offset::2]
+        else:
+            raise ValueError(f"Invalid yaxis: {yaxis}")
+        if correlation:
+            index = CORRELATION_INDEX[correlation]
+            values = values[index:index+1]
+            flag = flag[index:index+1]
+        return values, flag
+
+    def xvalues(self, spw, xaxis, shape):
+        """
+        Abscissa of `spw` broadcast to the `shape` of its values.
+        """
+        if xaxis == "time":
+            hours = (self.spws[spw]["time"] - self.day_start) / 3600
+            return np.broadcast_to(hours[None, None, :], shape)
+        if xaxis == "freq":
+            freq = self.chan_freq[spw] / 1e9
+            nchan = shape[1]
+            if len(freq) != nchan:
+                # One solution per spw is plotted at the spw center.
+                freq = np.full(nchan, freq.mean())
+            return np.broadcast_to(freq[None, :, None], shape)
+        raise ValueError(f"Invalid xaxis: {xaxis}")
+
+
+def _render_page(data, antennas, xaxis, yaxis, plotrange, correlation, plotfile):
+    fig, axes = plt.subplots(ANTS_PER_PAGE, 1, figsize=(8, 10), squeeze=False)
+    cmap = plt.get_cmap("tab20")
+    for ax, ant in zip(axes[:, 0], antennas):
+        for spw in data.spws:
+            values, flag = data.values(spw, yaxis, correlation)
+            xvalues = data.xvalues(spw, xaxis, values.shape)
+            good = ~flag & (data.spws[spw]["antenna"] == ant)[None, None, :]
+            if good.any():
+                ax.scatter(
+                        xvalues[good], values[good], s=2, color=cmap(spw % 20),
+                        linewidths=0,
+                )
+        ax.set_title(f"Antenna {data.antenna_names[ant]}", fontsize="small")
+        ax.set_xlabel(XAXIS_LABELS[xaxis])
+        ax.set_ylabel(YAXIS_LABELS[yaxis])
+        if plotrange and plotrange[0] != plotrange[1]:
+            ax.set_xlim(plotrange[0], plotrange[1])
+        if plotrange and plotrange[2] != plotrange[3]:
+            ax.set_ylim(plotrange[2], plotrange[3])
+    for ax in axes[len(antennas):, 0]:
+        ax.set_axis_off()
+    fig.tight_layout()
+    fig.savefig(plotfile, dpi=150)
+    plt.close(fig)
+
+
+def _plotms_pages(caltable, nant, spec):
+    from casaplotms import plotms
+    for ii, plotfile in enumerate(page_files(spec["prefix"], nant)):
+        plotms(
+            vis=caltable,
+            xaxis=spec["xaxis"],
+            yaxis=spec["yaxis"],
+            correlation=spec.get("correlation", ""),
+            antenna=f"{ii*ANTS_PER_PAGE}~{ii*ANTS_PER_PAGE+ANTS_PER_PAGE-1}",
+            spw="",
+            timerange="",
+            gridrows=ANTS_PER_PAGE,
+            coloraxis="spw",
+            iteraxis="antenna",
+            plotrange=spec.get("plotrange", []),
+            showgui=False,
+            plotfile=plotfile,
+            highres=True,
+            overwrite=True,
+        )
+
+
+def render_caltable_plots(caltable, nant, plots):
+    """
+    Render all pages of `plots` for the first `nant` antennas of `caltable`.
+
+    Parameters
+    ----------
+    caltable : str
+    nant : int
+    plots : list of dict
+        Plot specifications with the keys "prefix", "xaxis" ("time" or
+        "freq"), "yaxis" ("amp", "phase", "delay", "spgain", or "tsys"), and
+        optionally "plotrange" and "correlation" as for `plotms`.
+
+    Returns
+    -------
+    list of str
+        Names of the files written.
+    """
+    if plt is None:
+        for spec in plots:
+            _plotms_pages(caltable, nant, spec)
+        return [f for spec in plots for f in page_files(spec["prefix"], nant)]
+    data = CalTableData(caltable)
+    nant = min(nant, len(data.antenna_names))
+    plotfiles = []
+    for spec in plots:
+        for ii, plotfile in enumerate(page_files(spec["prefix"], nant)):
+            antennas = range(ii * ANTS_PER_PAGE, min(nant, (ii + 1) * ANTS_PER_PAGE))
+            _render_page(
+                    data, antennas, spec["xaxis"], spec["yaxis"],
+                    spec.get("plotrange", []), spec.get("correlation", ""),
+                    plotfile,
+            )
+            plotfiles.append(plotfile)
+    return plotfiles
+
+
+def plot_caltable(caltable, nant, plots):
+    """
+    Queue `render_caltable_plots` on the pipeline scheduler and return the
+    `Task`. The table is read once by the worker for all of the plots.
+    """
+    writes = tuple(
+            f"plot:{f}" for spec in plots
+            for f in page_files(spec["prefix"], nant)
+    )
+    return get_scheduler().submit(
+            f"plot_caltable {caltable}",
+            render_caltable_plots,
+            args=(caltable, nant, plots),
+            reads=(f"table:{caltable}",),
+            writes=writes,
+    )
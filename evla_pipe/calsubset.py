@@ -0,0 +1,312 @@
+"""
+Managed calibrator MS ("calibrators.ms").
+
+The calibrator MS holds the corrected data of the calibrator scans of the MS,
+averaged to one channel per spw, and is used for the gain solves of the
+solint, testgains, fluxgains, fluxboot and finalcals stages. It is made with
+`split` once. A sidecar (``calibrators.ms.subset.npz``) records the state of
+the MS it reflects: the row layout, the modification time of the
+CORRECTED_DATA column and the flag counts per (scan, spw) from the flag
+ledger. `CalibratorSubset.update` compares this state to the MS and only
+re-averages the (scan, spw) cells that changed, all of them if the corrected
+data were re-applied, writing the DATA and FLAG of the calibrator MS in
+place. The MS is split again only if its rows or the selection changed.
+
+The channel average follows `split`: unflagged channels are averaged, weighted
+by WEIGHT_SPECTRUM if present, and an output channel is flagged only if all
+of its input channels are flagged. The weight of an output channel is the sum
+of the weights of the averaged channels, from which WEIGHT, SIGMA and
+WEIGHT_SPECTRUM, if present, are rewritten. As with ``keepflags=False``, rows that
+were fully flagged when the subset was split are not in it; rows that become
+fully flagged later are kept and flagged.
+
+Example:
+
+```
+subset = CalibratorSubset(ms_active, calibrator_scan_select_string, width=64)
+subset.update()
+```
+"""
+
+import os
+
+import numpy as np
+
+from casatasks import delmod, rmtables, split
+from casatools import table
+
+from .flagledger import _parse_ids, column_mtime, get_flag_ledger
+from .msindex import get_msindex
+
+
+SUBSET_VERSION = 2
+
+
+def _state_filename(outputvis):
+    return outputvis.rstrip("/") + ".subset.npz"
+
+
+def _ddid_spws(msname):
+    tb = table()
+    try:
+        tb.open(f"{msname}/DATA_DESCRIPTION")
+        return tb.getcol("SPECTRAL_WINDOW_ID")
+    finally:
+        tb.close()
+
+
+def average_channels(data, flag, weight=None):
+    """
+    Average `data` with shape (ncorr, nchan, nrow) over channels as `split`
+    does. Returns the data and flags with shape (ncorr, 1, nrow).
+    """
+    good = ~flag
+    weight = good if weight is None else weight * good
+    wsum = weight.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        average = (data * weight).sum(axis=1) / wsum
+    # Fully flagged channels are averaged without weights.
+    empty = wsum == 0
+    average[empty] = data.mean(axis=1)[empty]
+    return average[:, None, :], ~good.any(axis=1)[:, None, :]
+
+
+def average_weights(flag, weight):
+    """
+    Weights with shape (ncorr, 1, nrow) of the channels averaged by
+    `average_channels` from the channel weights `weight` with the shape of
+    `flag`: the sum over the unflagged channels, or over all channels if all
+    of them are flagged.
+    """
+    good = ~flag
+    wsum = (weight * good).sum(axis=1)
+    empty = ~good.any(axis=1)
+    wsum[empty] = weight.sum(axis=1)[empty]
+    return wsum[:, None, :]
+
+
+class CalibratorSubset:
+    """
+    Channel averaged calibrator scans of a measurement set.
+
+    Parameters
+    ----------
+    msname : str
+        Source MS.
+    scan : str
+        CASA scan selection of the calibrator scans.
+    width : int
+        Number of channels to average; at least the largest number of
+        channels of a spw to average each spw to one channel.
+    outputvis : str
+    """
+
+    def __init__(self, msname, scan, width, outputvis="calibrators.ms"):
+        self.msname = msname
+        self.scan = scan
+        self.width = int(width)
+        self.outputvis = outputvis
+
+    def __repr__(self):
+        return f"CalibratorSubset({self.msname!r}, outputvis={self.outputvis!r})"
+
+    def _source_state(self):
+        ledger = get_flag_ledger(self.msname)
+        ledger.refresh()
+        scans = _parse_ids(self.scan)
+        selected = (
+                np.ones(len(ledger.scans), dtype=bool) if scans is None
+                else np.isin(ledger.scans, scans)
+        )
+        return {
+                "layout": ledger.signature[:2],
+                "corrected": np.int64(column_mtime(self.msname, "CORRECTED_DATA")),
+                "scans": ledger.scans[selected],
+                "flagged": ledger.chan_flagged[selected].sum(axis=2),
+                "total": ledger.chan_total[selected].sum(axis=2),
+        }
+
+    def _load_state(self):
+        filename = _state_filename(self.outputvis)
+        if not os.path.exists(filename) or not os.path.isdir(self.outputvis):
+            return None
+        try:
+            with np.load(filename) as data:
+                if int(data["version"]) != SUBSET_VERSION:
+                    return None
+                if (
+                        str(data["msname"]) != self.msname
+                        or str(data["scan"]) != self.scan
+                        or int(data["width"]) != self.width
+                ):
+                    return None
+                return {key: data[key] for key in data.files}
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _save_state(self, state):
+        np.savez(
+                _state_filename(self.outputvis),
+                version=SUBSET_VERSION,
+                msname=self.msname,
+                scan=self.scan,
+                width=self.width,
+                **state,
+        )
+
+    def build(self):
+        """Split the calibrator scans into the calibrator MS."""
+        rmtables(self.outputvis)
+        split(
+            vis=self.msname,
+            outputvis=self.outputvis,
+            datacolumn="corrected",
+            field="",
+            spw="",
+            width=self.width,
+            antenna="",
+            timebin="0s",
+            timerange="",
+            scan=self.scan,
+            intent="",
+            array="",
+            uvrange="",
+            correlation="",
+            observation="",
+            keepflags=False,
+        )
+
+    def update(self, clear_models=False):
+        """
+        Bring the calibrator MS up to date with the MS, splitting it if it
+        does not exist or no longer lines up with the MS.
+
+        Parameters
+        ----------
+        clear_models : bool
+            Delete the source models of the calibrator MS if it is not split
+            again, so that it starts without models as a new split does.
+
+        Returns
+        -------
+        str
+            "built", "refreshed", or "current".
+        """
+        state = self._source_state()
+        saved = self._load_state()
+        if (
+                saved is None
+                or not np.array_equal(saved["layout"], state["layout"])
+                or not np.array_equal(saved["scans"], state["scans"])
+        ):
+            self.build()
+            self._save_state(state)
+            return "built"
+        if saved["corrected"] != state["corrected"]:
+            changed = state["total"] > 0
+        else:
+            changed = saved["flagged"] != state["flagged"]
+        status = "current"
+        if changed.any():
+            cells = [
+                    (int(state["scans"][ii]), int(spw))
+                    for ii, spw in zip(*np.nonzero(changed))
+            ]
+            try:
+                self._rewrite(cells)
+            except ValueError:
+                # Rows that were fully flagged when the subset was split have
+                # been unflagged since.
+                self.build()
+                self._save_state(state)
+                return "built"
+            status = "refreshed"
+        if clear_models:
+            delmod(vis=self.outputvis, otf=True, scr=True)
+        self._save_state(state)
+        return status
+
+    def _rewrite(self, cells):
+        """
+        Re-average the (scan, spw) `cells` of the MS into the calibrator MS.
+        Raises ValueError if a row with unflagged data is missing from it.
+        """
+        src_spws = get_msindex(self.msname).ddid_spw
+        dst_spws = _ddid_spws(self.outputvis)
+        src = table()
+        dst = table()
+        try:
+            src.open(self.msname)
+            dst.open(self.outputvis, nomodify=False)
+            has_weight = "WEIGHT_SPECTRUM" in src.colnames()
+            dst_weight = "WEIGHT_SPECTRUM" in dst.colnames()
+            for scan, spw in cells:
+                src_ddids = np.flatnonzero(src_spws == spw).tolist()
+                dst_ddids = np.flatnonzero(dst_spws == spw).tolist()
+                src_sub = src.query(
+                        f"SCAN_NUMBER=={scan} && DATA_DESC_ID IN {src_ddids}"
+                )
+                dst_sub = dst.query(
+                        f"SCAN_NUMBER=={scan} && DATA_DESC_ID IN {dst_ddids}"
+                )
+                try:
+                    self._rewrite_rows(src_sub, dst_sub, has_weight, dst_weight)
+                finally:
+                    src_sub.close()
+                    dst_sub.close()
+        finally:
+            src.close()
+            dst.close()
+
+    @staticmethod
+    def _rewrite_rows(src_sub, dst_sub, has_weight, dst_weight):
+        if src_sub.nrows() == 0:
+            return
+        flag = src_sub.getcol("FLAG")
+        if has_weight:
+            weight = src_sub.getcol("WEIGHT_SPECTRUM")
+        else:
+            weight = np.broadcast_to(src_sub.getcol("WEIGHT")[:, None, :], flag.shape)
+        average, avg_flag = average_channels(
+                src_sub.getcol("CORRECTED_DATA"),
+                flag,
+                weight if has_weight else None,
+        )
+        avg_weight = average_weights(flag, weight)
+        src_rows = {
+                key: ii for ii, key in enumerate(zip(
+                    src_sub.getcol("TIME"),
+                    src_sub.getcol("ANTENNA1"),
+                    src_sub.getcol("ANTENNA2"),
+                ))
+        }
+        if dst_sub.nrows() > 0:
+            dst_keys = zip(
+                    dst_sub.getcol("TIME"),
+                    dst_sub.getcol("ANTENNA1"),
+                    dst_sub.getcol("ANTENNA2"),
+            )
+        else:
+            dst_keys = []
+        try:
+            index = np.array([src_rows[key] for key in dst_keys], dtype=int)
+        except KeyError:
+            raise ValueError("Calibrator MS rows do not match the MS")
+        missing = np.ones(len(src_rows), dtype=bool)
+        missing[index] = False
+        if (~flag[..., missing]).any():
+            raise ValueError("Unflagged rows are missing from the calibrator MS")
+        if len(index) == 0:
+            return
+        dst_flag = avg_flag[..., index]
+        dst_weight_spectrum = avg_weight[..., index]
+        row_weight = dst_weight_spectrum[:, 0, :]
+        with np.errstate(divide="ignore"):
+            row_sigma = np.where(row_weight > 0, 1 / np.sqrt(row_weight), 0.0)
+        dst_sub.putcol("DATA", average[..., index])
+        dst_sub.putcol("FLAG", dst_flag)
+        dst_sub.putcol("FLAG_ROW", dst_flag.all(axis=(0, 1)))
+        dst_sub.putcol("WEIGHT", row_weight)
+        dst_sub.putcol("SIGMA", row_sigma)
+        if dst_weight:
+            dst_sub.putcol("WEIGHT_SPECTRUM", dst_weight_spectrum)
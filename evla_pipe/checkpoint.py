@@ -0,0 +1,233 @@
+"""
+Incremental store of the pipeline context for restarts.
+
+Each key of the context listed in ``EVLA_pipe_restore.list`` is kept in its
+own file in the checkpoint directory: NumPy arrays as ``.npy`` blobs that are
+memory-mapped when restored, and any other value pickled. A small manifest
+records a digest of every stored value and the stages and sub-steps that have
+finished. Saving a checkpoint only writes the values whose digest changed
+since the previous checkpoint, so its cost does not grow with the values that
+stay the same from stage to stage (such as the scan and field tables).
+
+One store is kept per directory with `get_checkpoint_store`. It remembers the
+digest of each array by its data pointer, shape, strides and dtype, so an
+array that was not replaced since the previous checkpoint is not hashed
+again. Arrays of the context are therefore expected to be replaced, not
+modified in place, when they change.
+
+Example:
+
+```
+store = get_checkpoint_store("pipeline_checkpoint")
+store.save(context, keys, stage="flagall", substep="deterministic_flags")
+store.completed("flagall", "deterministic_flags")
+context.update(store.load())
+```
+"""
+
+import hashlib
+import os
+import pickle
+from pathlib import Path
+
+import numpy as np
+
+
+CHECKPOINT_VERSION = 1
+MANIFEST_NAME = "manifest.pkl"
+
+_store_cache = {}
+
+
+def _is_plain_array(value):
+    return isinstance(value, np.ndarray) and not value.dtype.hasobject
+
+
+def _digest_array(value):
+    value = np.ascontiguousarray(value)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{value.dtype.str}{value.shape}".encode())
+    digest.update(memoryview(value).cast("B"))
+    return digest.hexdigest()
+
+
+def _array_layout(value):
+    return (
+            value.__array_interface__["data"][0], value.shape, value.strides,
+            value.dtype.str,
+    )
+
+
+def _digest_bytes(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _atomic_write(filename, write):
+    """
+    Call `write` with a temporary file object and move the file to
+    `filename` when it succeeds, so that an interrupted checkpoint never
+    leaves a partially written value behind.
+    """
+    tmpname = filename.with_name(filename.name + ".tmp")
+    with open(tmpname, "wb") as f:
+        write(f)
+    os.replace(tmpname, filename)
+
+
+class CheckpointStore:
+    """
+    Directory of checkpointed context values.
+
+    Parameters
+    ----------
+    dirname : str, Path
+        Checkpoint directory, created on the first save.
+    """
+
+    def __init__(self, dirname="pipeline_checkpoint"):
+        self.path = Path(dirname)
+        self.entries = {}
+        self.steps = []
+        # Layout and digest of the arrays last saved or loaded, by key
+        self._array_digests = {}
+        manifest = self.path / MANIFEST_NAME
+        if manifest.exists():
+            with open(manifest, "rb") as f:
+                state = pickle.load(f)
+            if state.get("version") == CHECKPOINT_VERSION:
+                self.entries = state["entries"]
+                self.steps = state["steps"]
+
+    def __repr__(self):
+        return f"CheckpointStore({str(self.path)!r}, nkeys={len(self.entries)})"
+
+    def exists(self):
+        return (self.path / MANIFEST_NAME).exists()
+
+    @property
+    def last_step(self):
+        """(stage, substep) of the last checkpoint; None if there is none."""
+        return self.steps[-1] if self.steps else None
+
+    def completed(self, stage, substep=None):
+        """
+        True if the checkpoint for `substep` of `stage` has been saved, or
+        for the end of `stage` if `substep` is None.
+        """
+        return (stage, substep) in self.steps
+
+    def save(self, context, keys, stage=None, substep=None):
+        """
+        Write the values of `keys` in `context` that changed since the last
+        checkpoint and record that `substep` of `stage` finished. Keys that
+        are missing from the context are skipped.
+
+        Returns
+        -------
+        written : list
+            Keys whose values were written.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        written = []
+        for key in keys:
+            if key not in context:
+                continue
+            value = context[key]
+            if _is_plain_array(value):
+                kind = "npy"
+                layout = _array_layout(value)
+                cached = self._array_digests.get(key)
+                if cached is not None and cached[0] == layout:
+                    digest = cached[1]
+                else:
+                    digest = _digest_array(value)
+                    self._array_digests[key] = (layout, digest)
+                data = None
+            else:
+                kind = "pickle"
+                data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                digest = _digest_bytes(data)
+            entry = self.entries.get(key)
+            if entry is not None and entry["digest"] == digest:
+                continue
+            filename = f"{key}.npy" if kind == "npy" else f"{key}.pkl"
+            if kind == "npy":
+                _atomic_write(
+                        self.path / filename,
+                        lambda f: np.save(f, value, allow_pickle=False),
+                )
+            else:
+                _atomic_write(self.path / filename, lambda f: f.write(data))
+            if entry is not None and entry["file"] != filename:
+                (self.path / entry["file"]).unlink(missing_ok=True)
+            self.entries[key] = {
+                    "kind": kind, "file": filename, "digest": digest,
+                    "stage": stage, "substep": substep,
+            }
+            written.append(key)
+        step = (stage, substep)
+        if substep is None:
+            # The sub-steps of a finished stage are not skipped if the stage
+            # is run again.
+            self.steps = [s for s in self.steps if s[0] != stage]
+        elif step in self.steps:
+            self.steps.remove(step)
+        self.steps.append(step)
+        self._write_manifest()
+        return written
+
+    def clear(self):
+        """
+        Remove all stored values and recorded steps.
+        """
+        for entry in self.entries.values():
+            (self.path / entry["file"]).unlink(missing_ok=True)
+        self.entries = {}
+        self.steps = []
+        self._array_digests = {}
+        if self.exists():
+            self._write_manifest()
+
+    def _write_manifest(self):
+        state = {
+                "version": CHECKPOINT_VERSION,
+                "entries": self.entries,
+                "steps": self.steps,
+        }
+        _atomic_write(
+                self.path / MANIFEST_NAME,
+                lambda f: pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL),
+        )
+
+    def load(self, keys=None):
+        """
+        Read the stored values of `keys`, or all stored values if None.
+        Arrays are memory-mapped copy-on-write, so they are only read from
+        disk when used and changes to them are not written back.
+        """
+        if keys is None:
+            keys = self.entries.keys()
+        values = {}
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            filename = self.path / entry["file"]
+            if entry["kind"] == "npy":
+                value = np.load(filename, mmap_mode="c", allow_pickle=False)
+                self._array_digests[key] = (_array_layout(value), entry["digest"])
+                values[key] = value
+            else:
+                with open(filename, "rb") as f:
+                    values[key] = pickle.load(f)
+        return values
+
+
+def get_checkpoint_store(dirname="pipeline_checkpoint"):
+    """Return the checkpoint store of the directory `dirname`."""
+    key = str(dirname)
+    store = _store_cache.get(key)
+    if store is None or (store.entries and not store.exists()):
+        store = CheckpointStore(dirname)
+        _store_cache[key] = store
+    return store
@@ -0,0 +1,392 @@
+"""
+Merge and minimize `flagdata` list-mode commands.
+
+Each manual flag command selects the product of a set of antennas, a set of
+time intervals, and a set of channels per spw. Commands that differ in only
+one of these are combined into one command: time intervals of the same
+antennas are merged where they overlap or touch, antennas flagged over the
+same intervals are listed in one command, and channel ranges selected for the
+same antennas and times are merged per spw. Commands that cannot be parsed,
+or that are not ``mode='manual'``, are passed through unchanged and the
+commands on either side of them are not combined, so the result flags exactly
+the same data as the input.
+
+Example:
+
+```
+compile_commands([
+    "antenna='ea01&&*' timerange='2012/05/03/12:00:00.0~2012/05/03/12:00:05.0' reason='ANTENNA_NOT_ON_SOURCE'",
+    "antenna='ea01&&*' timerange='2012/05/03/12:00:04.0~2012/05/03/12:00:09.0' reason='ANTENNA_NOT_ON_SOURCE'",
+    "antenna='ea02&&*' timerange='2012/05/03/12:00:00.0~2012/05/03/12:00:09.0' reason='ANTENNA_NOT_ON_SOURCE'",
+])
+# ["mode='manual' antenna='ea01,ea02&&*' timerange='2012/05/03/12:00:00.0~2012/05/03/12:00:09.0' reason='ANTENNA_NOT_ON_SOURCE'"]
+```
+"""
+
+import re
+from datetime import datetime
+
+
+CMD_TOKEN = re.compile(r"""(\w+)=('[^']*'|"[^"]*"|\S+)""")
+SPW_ITEM = re.compile(r"^(\d+)(?:~(\d+))?(?::(.+))?$")
+CHAN_RANGE = re.compile(r"^(\d+)(?:~(\d+))?$")
+ANTENNA_NAME = re.compile(r"^\w+$")
+TIME_FORMATS = ("%Y/%m/%d/%H:%M:%S.%f", "%Y/%m/%d/%H:%M:%S")
+TIME_EPOCH = datetime(1858, 11, 17)
+
+# Fields of a manual command that the compiler merges.
+MERGE_FIELDS = ("antenna", "timerange", "spw")
+
+
+def _unquote(token):
+    if len(token) >= 2 and token[0] == token[-1] and token[0] in "'\"":
+        return token[1:-1]
+    return token
+
+
+def parse_command(line):
+    """
+    Fields of the flag command `line` as a dict of the raw value tokens, in
+    order, or None if the line is blank, a comment, or has other text.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    fields = {}
+    pos = 0
+    for match in CMD_TOKEN.finditer(line):
+        if line[pos:match.start()].strip():
+            return None
+        fields[match.group(1)] = match.group(2)
+        pos = match.end()
+    if line[pos:].strip() or not fields:
+        return None
+    return fields
+
+
+def parse_time(value):
+    """Seconds since the MJD epoch of a "YYYY/MM/DD/hh:mm:ss[.s]" time."""
+    for fmt in TIME_FORMATS:
+        try:
+            return (datetime.strptime(value, fmt) - TIME_EPOCH).total_seconds()
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid time: {value}")
+
+
+def parse_timerange(value):
+    """
+    Intervals ``(start, end, start_str, end_str)`` of a comma-separated
+    timerange selection, or None if any part is not a full date range.
+    """
+    intervals = []
+    for item in value.split(","):
+        parts = item.strip().split("~")
+        if len(parts) != 2:
+            return None
+        try:
+            start, end = parse_time(parts[0]), parse_time(parts[1])
+        except ValueError:
+            return None
+        intervals.append((start, end, parts[0], parts[1]))
+    return intervals
+
+
+def merge_intervals(intervals, gap=0.0):
+    """
+    Merge the time `intervals` that overlap or are separated by at most
+    `gap` seconds.
+    """
+    merged = []
+    for interval in sorted(intervals):
+        if merged and interval[0] - merged[-1][1] <= gap:
+            last = merged[-1]
+            if interval[1] > last[1]:
+                merged[-1] = (last[0], interval[1], last[2], interval[3])
+        else:
+            merged.append(interval)
+    return tuple(merged)
+
+
+def format_timerange(intervals):
+    return ",".join(f"{s0}~{s1}" for _, _, s0, s1 in intervals)
+
+
+def parse_spw(value):
+    """
+    Selected channels of each spw as ``{spw: ranges}`` where `ranges` is a
+    list of inclusive ``(lo, hi)`` channel ranges, or None for all channels.
+    Returns None if the selection uses anything other than spw and channel
+    numbers.
+    """
+    selection = {}
+    for item in value.split(","):
+        match = SPW_ITEM.match(item.strip())
+        if match is None:
+            return None
+        lo = int(match.group(1))
+        hi = int(match.group(2)) if match.group(2) else lo
+        chans = None
+        if match.group(3) is not None:
+            chans = []
+            for chan in match.group(3).split(";"):
+                cmatch = CHAN_RANGE.match(chan.strip())
+                if cmatch is None:
+                    return None
+                clo = int(cmatch.group(1))
+                chi = int(cmatch.group(2)) if cmatch.group(2) else clo
+                chans.append((clo, chi))
+        for spw in range(lo, hi + 1):
+            selection[spw] = _union_chans(selection.get(spw, []), chans)
+    return selection
+
+
+def merge_ranges(ranges):
+    """Merge inclusive integer ranges that overlap or are adjacent."""
+    merged = []
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(hi, merged[-1][1]))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def _union_chans(chans1, chans2):
+    if chans1 is None or chans2 is None:
+        return None
+    return merge_ranges(chans1 + chans2)
+
+
+def _range_str(lo, hi):
+    return str(lo) if lo == hi else f"{lo}~{hi}"
+
+
+def format_spw(selection):
+    whole = [spw for spw, chans in sorted(selection.items()) if chans is None]
+    items = [_range_str(lo, hi) for lo, hi in merge_ranges((s, s) for s in whole)]
+    for spw, chans in sorted(selection.items()):
+        if chans is not None:
+            items.append(f"{spw}:" + ";".join(_range_str(lo, hi) for lo, hi in chans))
+    return ",".join(items)
+
+
+def parse_antenna(value):
+    """
+    Antenna names and the baseline suffix (such as "&&*") of an antenna
+    selection, or None if it is not a plain list of names.
+    """
+    index = value.find("&")
+    names, suffix = (value, "") if index < 0 else (value[:index], value[index:])
+    # Only these select every baseline of each antenna, so that a list of
+    # antennas is the union of the selections of each one.
+    if suffix not in ("", "&*", "&&*"):
+        return None
+    names = [name.strip() for name in names.split(",")]
+    if not all(ANTENNA_NAME.match(name) for name in names):
+        return None
+    return suffix, frozenset(names)
+
+
+def format_antenna(suffix, names):
+    return ",".join(sorted(names)) + suffix
+
+
+class _Selection:
+    """
+    A manual command as its other fields, antennas, intervals, and channels.
+    None for any of the three means the command selects all of them.
+    """
+
+    def __init__(self, key, order, antenna, times, spw):
+        self.key = key
+        self.order = order
+        self.antenna = antenna
+        self.times = times
+        self.spw = spw
+
+    @classmethod
+    def from_fields(cls, fields):
+        if _unquote(fields.get("mode", "manual")) != "manual":
+            return None
+        antenna = times = spw = None
+        if "antenna" in fields:
+            antenna = parse_antenna(_unquote(fields["antenna"]))
+            if antenna is None:
+                return None
+        if "timerange" in fields:
+            times = parse_timerange(_unquote(fields["timerange"]))
+            if times is None:
+                return None
+            times = merge_intervals(times)
+        if "spw" in fields:
+            spw = parse_spw(_unquote(fields["spw"]))
+            if spw is None:
+                return None
+        key = tuple(
+                (name, value) for name, value in fields.items()
+                if name not in MERGE_FIELDS and name != "mode"
+        )
+        order = ("mode",) + tuple(fields)
+        return cls(key, order, antenna, times, spw)
+
+    def spw_key(self):
+        if self.spw is None:
+            return None
+        return tuple(
+                (spw, None if chans is None else tuple(chans))
+                for spw, chans in sorted(self.spw.items())
+        )
+
+    def to_command(self):
+        # Other fields keep their value tokens as given.
+        values = dict(self.key)
+        values["mode"] = "'manual'"
+        if self.antenna is not None:
+            values["antenna"] = f"'{format_antenna(*self.antenna)}'"
+        if self.times is not None:
+            values["timerange"] = f"'{format_timerange(self.times)}'"
+        if self.spw is not None:
+            values["spw"] = f"'{format_spw(self.spw)}'"
+        return " ".join(
+                f"{name}={values[name]}" for name in dict.fromkeys(self.order)
+                if name in values
+        )
+
+
+def _merge_times(selections, gap):
+    """Merge the intervals of selections with the same antennas and spws."""
+    groups = {}
+    for sel in selections:
+        group = groups.setdefault((sel.key, sel.antenna, sel.spw_key()), [])
+        group.append(sel)
+    merged = []
+    for group in groups.values():
+        first = group[0]
+        if any(sel.times is None for sel in group):
+            times = None
+        else:
+            times = merge_intervals([t for sel in group for t in sel.times], gap)
+        merged.append(_Selection(first.key, first.order, first.antenna, times, first.spw))
+    return merged
+
+
+def _merge_antennas(selections, gap):
+    """
+    Combine the antennas flagged over the same intervals and spws, then
+    list all intervals of the same set of antennas in one selection.
+    """
+    byInterval = {}
+    rest = []
+    for sel in selections:
+        if sel.antenna is None:
+            rest.append(sel)
+            continue
+        times = (None,) if sel.times is None else sel.times
+        for interval in times:
+            span = None if interval is None else interval[:2]
+            group = byInterval.setdefault(
+                    (sel.key, sel.antenna[0], sel.spw_key(), span),
+                    {"sel": sel, "interval": interval, "names": set()},
+            )
+            group["names"] |= sel.antenna[1]
+    byAntennas = {}
+    for (key, suffix, spwKey, _), group in byInterval.items():
+        antenna = (suffix, frozenset(group["names"]))
+        entry = byAntennas.setdefault(
+                (key, antenna, spwKey), {"sel": group["sel"], "times": []},
+        )
+        entry["times"].append(group["interval"])
+    merged = []
+    for (key, antenna, _), entry in byAntennas.items():
+        sel = entry["sel"]
+        times = entry["times"]
+        times = None if None in times else merge_intervals(times, gap)
+        merged.append(_Selection(key, sel.order, antenna, times, sel.spw))
+    return merged + rest
+
+
+def _merge_spws(selections):
+    """Merge the channels selected for the same antennas and intervals."""
+    groups = {}
+    for sel in selections:
+        timesKey = None if sel.times is None else tuple(t[:2] for t in sel.times)
+        group = groups.setdefault((sel.key, sel.antenna, timesKey), [])
+        group.append(sel)
+    merged = []
+    for group in groups.values():
+        first = group[0]
+        if any(sel.spw is None for sel in group):
+            spw = None
+        else:
+            spw = {}
+            for sel in group:
+                for ispw, chans in sel.spw.items():
+                    spw[ispw] = _union_chans(spw.get(ispw, []), chans)
+        merged.append(_Selection(first.key, first.order, first.antenna, first.times, spw))
+    return merged
+
+
+def _compile_run(selections, gap):
+    selections = _merge_times(selections, gap)
+    selections = _merge_spws(selections)
+    selections = _merge_antennas(selections, gap)
+    selections = _merge_spws(selections)
+    return [sel.to_command() for sel in selections]
+
+
+def compile_commands(lines, tbuff=0.0):
+    """
+    Minimized list of the flag commands `lines`.
+
+    Parameters
+    ----------
+    lines : iterable of str
+    tbuff : float
+        Time padding in seconds that `flagdata` will add to both ends of
+        every interval. Intervals closer than twice this are merged, which
+        selects the same data once padded.
+
+    Returns
+    -------
+    list of str
+    """
+    commands = []
+    run = []
+    for line in lines:
+        fields = parse_command(line)
+        if fields is None:
+            if line.strip() and not line.strip().startswith("#"):
+                commands.extend(_compile_run(run, 2 * tbuff))
+                run = []
+                commands.append(line.strip())
+            continue
+        sel = _Selection.from_fields(fields)
+        if sel is None:
+            # Order matters across other modes, such as unflag.
+            commands.extend(_compile_run(run, 2 * tbuff))
+            run = []
+            commands.append(line.strip())
+        else:
+            run.append(sel)
+    commands.extend(_compile_run(run, 2 * tbuff))
+    return commands
+
+
+def compile_flag_file(infile, outfile, tbuff=0.0):
+    """
+    Write the minimized commands of the file `infile` to `outfile`.
+
+    Returns
+    -------
+    (int, int)
+        Number of commands read and written.
+    """
+    with open(infile) as f:
+        lines = [line for line in f if parse_command(line) is not None or
+                 (line.strip() and not line.strip().startswith("#"))]
+    commands = compile_commands(lines, tbuff=tbuff)
+    with open(outfile, "w") as f:
+        for command in commands:
+            f.write(command + "\n")
+    return len(lines), len(commands)
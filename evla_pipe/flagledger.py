@@ -0,0 +1,444 @@
+"""
+Incremental accounting of the flags in a measurement set.
+
+The FLAG column of the main table is read once, in chunks, and reduced to
+counters of the flagged and total number of visibilities per (scan, spw,
+channel) and per (scan, spw, antenna). Flag operations whose selection is
+known are wrapped in `FlagLedger.track`, which marks only the (scan, spw)
+cells they can touch. A summary then re-reads just those cells instead of the
+whole FLAG column, as a `flagdata(mode="summary")` call would. The counters
+are written as a NumPy ``.npz`` sidecar next to the MS
+(``<msname>.flagledger.npz``) so that later stages and re-runs pick them up.
+
+Any change to the FLAG column that is not tracked (e.g., a task run outside
+of `track`) is detected from the modification time of the column's storage
+files, and the next summary falls back to a full re-read.
+
+Example:
+
+```
+ledger = get_flag_ledger("my.ms")
+ledger.summary()["flagged"]
+with ledger.track(scan="1,2,3"):
+    flagdata(vis="my.ms", mode="rflag", scan="1,2,3", ...)
+ledger.summary()["flagged"]
+```
+"""
+
+import glob
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+from casatools import table
+
+from .msindex import get_msindex
+
+
+LEDGER_VERSION = 2
+# Number of rows read from the main table at a time.
+CHUNK_ROWS = 1_000_000
+
+# Ledgers loaded in this process, keyed by MS name
+_ledger_cache = {}
+
+
+def _ledger_filename(msname):
+    return msname.rstrip("/") + ".flagledger.npz"
+
+
+def column_mtime(msname, column):
+    """
+    Latest modification time of the storage files of `column` in the main
+    table of `msname`.
+    """
+    tb = table()
+    try:
+        tb.open(msname)
+        dminfo = tb.getdminfo()
+    finally:
+        tb.close()
+    seqnr = [
+            dm["SEQNR"] for dm in dminfo.values()
+            if column in dm.get("COLUMNS", [])
+    ]
+    mtime = 0
+    for nr in seqnr:
+        filenames = glob.glob(os.path.join(msname, f"table.f{nr}"))
+        filenames += glob.glob(os.path.join(msname, f"table.f{nr}_*"))
+        for filename in filenames:
+            mtime = max(mtime, os.stat(filename).st_mtime_ns)
+    return mtime
+
+
+def _flag_signature(msname):
+    """
+    Modification time and size of the main table description, and the latest
+    modification time of the storage files of the FLAG column.
+    """
+    stat = os.stat(os.path.join(msname, "table.dat"))
+    flag_mtime = column_mtime(msname, "FLAG")
+    return np.array([stat.st_mtime_ns, stat.st_size, flag_mtime], dtype=np.int64)
+
+
+def _parse_ids(ids):
+    """
+    Convert a selection of IDs into a list of integers. Accepts None or an
+    empty string (no selection), an integer, a list of integers, or a CASA
+    style comma separated string of IDs and ``~`` ranges.
+    """
+    if ids is None:
+        return None
+    if isinstance(ids, str):
+        if ids.strip() == "":
+            return None
+        parsed = []
+        for item in ids.split(","):
+            if "~" in item:
+                start, end = item.split("~")
+                parsed.extend(range(int(start), int(end) + 1))
+            else:
+                parsed.append(int(item))
+        return parsed
+    return [int(ii) for ii in np.atleast_1d(ids)]
+
+
+class FlagLedger:
+    """
+    Flagged and total visibility counts of a measurement set.
+
+    Parameters
+    ----------
+    msname : str
+    scans : array
+        Scan numbers of the MS, indexing the first axis of the counters.
+    ddid_spw : array
+        Spectral window ID of each data description.
+    antenna_names : list
+        Antenna names, indexing the last axis of the antenna counters.
+    chan_flagged, chan_total : array, (nscan, nspw, nchan)
+        Counts per scan, spw, and channel summed over rows and correlations.
+        Spws with fewer channels than the largest are padded with zeros.
+    ant_flagged, ant_total : array, (nscan, nspw, nant)
+        Counts per scan, spw, and antenna summed over channels and
+        correlations. Each baseline is counted for both of its antennas and
+        each autocorrelation once.
+    dirty : array, (nscan, nspw) bool
+        Cells whose counts are out of date.
+    signature : array
+        FLAG column signature at which the counters and `dirty` were current.
+    """
+
+    def __init__(
+            self, msname, scans, ddid_spw, antenna_names, chan_flagged,
+            chan_total, ant_flagged, ant_total, dirty, signature,
+        ):
+        self.msname = msname
+        self.scans = np.asarray(scans)
+        self.ddid_spw = np.asarray(ddid_spw)
+        self.antenna_names = list(antenna_names)
+        self.chan_flagged = np.asarray(chan_flagged, dtype=np.int64)
+        self.chan_total = np.asarray(chan_total, dtype=np.int64)
+        self.ant_flagged = np.asarray(ant_flagged, dtype=np.int64)
+        self.ant_total = np.asarray(ant_total, dtype=np.int64)
+        self.dirty = np.asarray(dirty, dtype=bool)
+        self.signature = np.asarray(signature, dtype=np.int64)
+        self._versions = {}
+
+    def __repr__(self):
+        return (
+                f"FlagLedger({self.msname!r}, flagged={self.chan_flagged.sum()}, "
+                f"total={self.chan_total.sum()})"
+        )
+
+    @classmethod
+    def build(cls, msname):
+        """
+        Create the ledger for `msname` and count all of its flags.
+        """
+        tb = table()
+        try:
+            tb.open(f"{msname}/SPECTRAL_WINDOW")
+            nchan = tb.getcol("NUM_CHAN")
+        finally:
+            tb.close()
+        try:
+            tb.open(f"{msname}/ANTENNA")
+            antenna_names = list(tb.getcol("NAME"))
+        finally:
+            tb.close()
+        msindex = get_msindex(msname)
+        scans = np.array(msindex.scans, dtype=int)
+        nscan, nspw, nant = len(scans), len(nchan), len(antenna_names)
+        maxchan = int(nchan.max()) if nspw > 0 else 0
+        ledger = cls(
+                msname, scans, msindex.ddid_spw, antenna_names,
+                np.zeros((nscan, nspw, maxchan)),
+                np.zeros((nscan, nspw, maxchan)),
+                np.zeros((nscan, nspw, nant)),
+                np.zeros((nscan, nspw, nant)),
+                np.ones((nscan, nspw), dtype=bool),
+                np.zeros(3),
+        )
+        ledger.refresh()
+        return ledger
+
+    def _scan_index(self, scans):
+        return np.flatnonzero(np.isin(self.scans, scans))
+
+    def _mark(self, scan=None, spw=None):
+        scan_idx = (
+                np.arange(len(self.scans)) if scan is None
+                else self._scan_index(scan)
+        )
+        spw_idx = np.arange(self.dirty.shape[1]) if spw is None else np.asarray(spw)
+        self.dirty[np.ix_(scan_idx, spw_idx)] = True
+
+    def in_sync(self):
+        """
+        True if the FLAG column has not changed since the counters (and the
+        cells marked dirty) were last brought up to date.
+        """
+        return np.array_equal(self.signature, _flag_signature(self.msname))
+
+    def refresh(self, scan=None):
+        """
+        Re-read the FLAG column for the cells that are out of date. If the
+        FLAG column changed without being tracked, all cells are re-read.
+        With `scan`, only the cells of those scans are brought up to date and
+        the others stay marked as out of date.
+        """
+        signature = _flag_signature(self.msname)
+        if not np.array_equal(self.signature, signature):
+            self.dirty[:] = True
+        dirty = self.dirty.copy()
+        if scan is not None:
+            dirty[~np.isin(self.scans, scan)] = False
+        if dirty.any():
+            self._count(dirty)
+        self.signature = signature
+
+    def _count(self, dirty=None):
+        """
+        Recount the `dirty` cells, by default all cells marked dirty, from
+        the MS.
+        """
+        dirty = self.dirty.copy() if dirty is None else dirty
+        self.chan_flagged[dirty] = 0
+        self.chan_total[dirty] = 0
+        self.ant_flagged[dirty] = 0
+        self.ant_total[dirty] = 0
+        ddids = np.flatnonzero(np.isin(self.ddid_spw, np.flatnonzero(dirty.any(axis=0))))
+        tb = table()
+        try:
+            tb.open(self.msname)
+            for ddid in ddids:
+                spw = self.ddid_spw[ddid]
+                dirty_scans = self.scans[dirty[:, spw]]
+                scan_list = ",".join(str(s) for s in dirty_scans)
+                subtb = tb.query(
+                        f"DATA_DESC_ID=={ddid} && SCAN_NUMBER IN [{scan_list}]",
+                        columns="SCAN_NUMBER,ANTENNA1,ANTENNA2,FLAG",
+                )
+                try:
+                    nrows = subtb.nrows()
+                    for startrow in range(0, nrows, CHUNK_ROWS):
+                        nrow = min(CHUNK_ROWS, nrows - startrow)
+                        self._add_chunk(
+                                spw,
+                                subtb.getcol("SCAN_NUMBER", startrow, nrow),
+                                subtb.getcol("ANTENNA1", startrow, nrow),
+                                subtb.getcol("ANTENNA2", startrow, nrow),
+                                subtb.getcol("FLAG", startrow, nrow),
+                        )
+                finally:
+                    subtb.close()
+        finally:
+            tb.close()
+        self.dirty[dirty] = False
+
+    def _add_chunk(self, spw, scan, ant1, ant2, flag):
+        """
+        Add the counts of a chunk of rows of one spw. `flag` has the shape
+        (ncorr, nchan, nrow) of the FLAG column.
+        """
+        ncorr, nchan, _ = flag.shape
+        # Flagged correlations per channel and row, (nchan, nrow)
+        chan_row = flag.sum(axis=0, dtype=np.int64)
+        row_flagged = chan_row.sum(axis=0)
+        scan_idx = np.searchsorted(self.scans, scan)
+        for idx in np.unique(scan_idx):
+            in_scan = scan_idx == idx
+            self.chan_flagged[idx, spw, :nchan] += chan_row[:, in_scan].sum(axis=1)
+            self.chan_total[idx, spw, :nchan] += ncorr * np.count_nonzero(in_scan)
+        # Autocorrelations are counted once for their antenna.
+        cross = ant1 != ant2
+        for ant, rows in ((ant1, slice(None)), (ant2, cross)):
+            np.add.at(
+                    self.ant_flagged[:, spw, :],
+                    (scan_idx[rows], ant[rows]),
+                    row_flagged[rows],
+            )
+            np.add.at(
+                    self.ant_total[:, spw, :],
+                    (scan_idx[rows], ant[rows]),
+                    ncorr * nchan,
+            )
+
+    @contextmanager
+    def track(self, scan=None, spw=None):
+        """
+        Context manager for a flag operation that only touches the rows of
+        the selected scans and spws. Either may be None for all, an ID, a
+        list of IDs, or a CASA selection string of IDs. The selected cells
+        are recounted at the next summary.
+        """
+        in_sync = self.in_sync()
+        try:
+            yield self
+        finally:
+            if in_sync:
+                self._mark(scan=_parse_ids(scan), spw=_parse_ids(spw))
+                self.signature = _flag_signature(self.msname)
+            self._save()
+
+    def save_version(self, versionname):
+        """
+        Remember the current counters under `versionname`, mirroring a flag
+        version saved with `flagversions.FlagVersionStore.save`.
+        """
+        self.refresh()
+        self._versions[versionname] = (
+                self.chan_flagged.copy(), self.ant_flagged.copy(),
+        )
+
+    def restore_version(self, versionname):
+        """
+        Restore the counters saved under `versionname` after the flag version
+        of the same name is restored with `FlagVersionStore.restore`. Returns
+        False if the version is not known to the ledger, in which case the
+        next summary re-reads the MS.
+        """
+        if versionname not in self._versions:
+            return False
+        chan_flagged, ant_flagged = self._versions[versionname]
+        self.chan_flagged = chan_flagged.copy()
+        self.ant_flagged = ant_flagged.copy()
+        self.dirty[:] = False
+        self.signature = _flag_signature(self.msname)
+        self._save()
+        return True
+
+    def summary(self):
+        """
+        Flag counts in the layout of `flagdata(mode="summary")`: overall
+        "flagged" and "total", and the same per "scan", "spw", and "antenna".
+        """
+        self.refresh()
+        self._save()
+        per_scan = self.chan_flagged.sum(axis=2), self.chan_total.sum(axis=2)
+
+        def counts(flagged, total, keys):
+            return {
+                    str(key): {"flagged": float(f), "total": float(t)}
+                    for key, f, t in zip(keys, flagged, total)
+                    if t > 0
+            }
+
+        return {
+                "flagged": float(self.chan_flagged.sum()),
+                "total": float(self.chan_total.sum()),
+                "scan": counts(
+                        per_scan[0].sum(axis=1), per_scan[1].sum(axis=1),
+                        self.scans,
+                ),
+                "spw": counts(
+                        per_scan[0].sum(axis=0), per_scan[1].sum(axis=0),
+                        range(per_scan[0].shape[1]),
+                ),
+                "antenna": counts(
+                        self.ant_flagged.sum(axis=(0, 1)),
+                        self.ant_total.sum(axis=(0, 1)),
+                        self.antenna_names,
+                ),
+        }
+
+    def _save(self):
+        try:
+            self.save(_ledger_filename(self.msname))
+        except OSError:
+            # The directory of the MS may not be writable; only keep the
+            # ledger in memory.
+            pass
+
+    def save(self, filename):
+        np.savez(
+                filename,
+                version=LEDGER_VERSION,
+                scans=self.scans,
+                ddid_spw=self.ddid_spw,
+                antenna_names=np.array(self.antenna_names),
+                chan_flagged=self.chan_flagged,
+                chan_total=self.chan_total,
+                ant_flagged=self.ant_flagged,
+                ant_total=self.ant_total,
+                dirty=self.dirty,
+                signature=self.signature,
+        )
+
+    @classmethod
+    def load(cls, filename, msname):
+        """
+        Load a ledger from `filename`. Returns None if the file is of a
+        different version.
+        """
+        with np.load(filename) as data:
+            if int(data["version"]) != LEDGER_VERSION:
+                return None
+            return cls(
+                    msname, data["scans"], data["ddid_spw"],
+                    data["antenna_names"].tolist(), data["chan_flagged"],
+                    data["chan_total"], data["ant_flagged"],
+                    data["ant_total"], data["dirty"], data["signature"],
+            )
+
+
+def get_flag_ledger(msname, rebuild=False):
+    """
+    Return the flag ledger for `msname`, loading it from the sidecar file or
+    building it with a full read of the FLAG column. The ledger is rebuilt if
+    rows were added to or removed from the MS.
+    """
+    signature = _flag_signature(msname)
+    ledger = None if rebuild else _ledger_cache.get(msname)
+    filename = _ledger_filename(msname)
+    if ledger is None and not rebuild and os.path.exists(filename):
+        try:
+            ledger = FlagLedger.load(filename, msname)
+        except (OSError, KeyError, ValueError):
+            ledger = None
+    if ledger is not None and not np.array_equal(ledger.signature[:2], signature[:2]):
+        ledger = None
+    if ledger is None:
+        ledger = FlagLedger.build(msname)
+        ledger._save()
+    _ledger_cache[msname] = ledger
+    return ledger
+
+
+@contextmanager
+def track_flags(msname, scan=None, spw=None):
+    """
+    Track a flag operation on `msname` with `FlagLedger.track` if a ledger
+    for it exists; otherwise do nothing, as the ledger will count the flags
+    when it is built.
+    """
+    ledger = _ledger_cache.get(msname)
+    if ledger is None and os.path.exists(_ledger_filename(msname)):
+        ledger = get_flag_ledger(msname)
+    if ledger is None:
+        yield None
+    else:
+        with ledger.track(scan=scan, spw=spw):
+            yield ledger
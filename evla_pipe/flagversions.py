@@ -0,0 +1,364 @@
+"""
+Flag versions stored as differences between snapshots.
+
+`flagmanager(mode="save")` and the automatic backups of `flagdata` and
+`applycal` copy the whole FLAG column into ``<msname>.flagversions`` every
+time. A `FlagVersionStore` instead keeps, in ``<msname>.flagsnapshots``, the
+flags of the most recent version in full and, for each earlier version, only
+its difference to the version after it. The FLAG column is handled per data
+description in blocks of `BLOCK_ROWS` rows, each packed to a bitmap and zlib
+compressed. Blocks that did not change are neither written to the latest
+snapshot nor to the differences, so that saving a version after a flagging
+step that touched a few scans writes little more than those scans.
+
+A save first writes the difference of the previous version and stages the
+new head blocks in ``.pending`` files, then records them in the manifest and
+only then moves them over the head blocks. An interrupted save therefore
+leaves either the earlier versions untouched, with the staged blocks removed
+when the store is next opened, or a manifest whose staged blocks are moved
+into place when it is next opened.
+
+Restoring a version applies the differences in reverse, starting from the
+most recent version, and writes back only the blocks that differ from the
+current flags. Versions are named as with `flagmanager` (e.g., "flagdata_1",
+"allflags1" and "finalflags"), and saving under an existing name replaces
+that version.
+
+Example:
+
+```
+versions = get_flag_versions("my.ms")
+versions.save("allflags1", comment="Deterministic flags saved after application")
+versions.restore("allflags1")
+versions.list()
+```
+"""
+
+import os
+import pickle
+import shutil
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from casatasks import casalog
+from casatools import table
+
+from .checkpoint import _atomic_write
+from .msindex import get_msindex
+
+
+SNAPSHOT_VERSION = 1
+MANIFEST_NAME = "manifest.pkl"
+# Number of rows of one data description in a block
+BLOCK_ROWS = 100_000
+
+# Stores opened in this process, keyed by MS name
+_store_cache = {}
+
+
+def _snapshot_dirname(msname):
+    return msname.rstrip("/") + ".flagsnapshots"
+
+
+def _compress(packed):
+    return zlib.compress(packed.tobytes(), 1)
+
+
+def _decompress(data):
+    return np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+
+
+def _xor_diffs(first, second):
+    """XOR of two block differences, dropping the blocks that cancel."""
+    merged = dict(first)
+    for key, data in second.items():
+        if key in merged:
+            packed = _decompress(merged[key]) ^ _decompress(data)
+            if packed.any():
+                merged[key] = _compress(packed)
+            else:
+                del merged[key]
+        else:
+            merged[key] = data
+    return merged
+
+
+class FlagVersionStore:
+    """
+    Flag versions of a measurement set.
+
+    Parameters
+    ----------
+    msname : str
+    """
+
+    def __init__(self, msname):
+        self.msname = msname
+        self.path = Path(_snapshot_dirname(msname))
+        # Ordered list of dicts with the keys "name", "comment" and "diff",
+        # the file with the difference to the next version. The last version
+        # is held in full in the head blocks and has no difference file.
+        self.versions = []
+        self.layout = None
+        self.serial = 0
+        # Keys of the head blocks staged in pending files
+        self.pending = []
+        manifest = self.path / MANIFEST_NAME
+        if manifest.exists():
+            with open(manifest, "rb") as f:
+                state = pickle.load(f)
+            if state.get("version") == SNAPSHOT_VERSION:
+                self.versions = state["versions"]
+                self.layout = state["layout"]
+                self.serial = state["serial"]
+                self.pending = state.get("pending", [])
+        self._recover()
+
+    def __repr__(self):
+        return f"FlagVersionStore({self.msname!r}, versions={self.names})"
+
+    def __contains__(self, name):
+        return name in self.names
+
+    @property
+    def names(self):
+        return [v["name"] for v in self.versions]
+
+    def list(self):
+        """(name, comment) of each version, oldest first."""
+        return [(v["name"], v["comment"]) for v in self.versions]
+
+    def next_name(self, prefix="flagdata"):
+        """
+        First unused ``<prefix>_<n>`` version name, following the naming of
+        the automatic backups of `flagdata` and `applycal`.
+        """
+        number = 1
+        while f"{prefix}_{number}" in self:
+            number += 1
+        return f"{prefix}_{number}"
+
+    def _current_layout(self):
+        msindex = get_msindex(self.msname)
+        nrows = np.bincount(
+                msindex.ddid, weights=msindex.nrows,
+                minlength=len(msindex.ddid_spw),
+        )
+        return tuple(int(n) for n in nrows)
+
+    def _blocks(self, tb):
+        """
+        Yield the key, reference table, start row and number of rows of each
+        block of the FLAG column of the open main table `tb`.
+        """
+        for ddid, nrows in enumerate(self.layout):
+            if nrows == 0:
+                continue
+            subtb = tb.query(f"DATA_DESC_ID=={ddid}", columns="FLAG")
+            try:
+                for ii, start in enumerate(range(0, nrows, BLOCK_ROWS)):
+                    yield (ddid, ii), subtb, start, min(BLOCK_ROWS, nrows - start)
+            finally:
+                subtb.close()
+
+    def _head_file(self, key):
+        return self.path / "head" / f"{key[0]}_{key[1]}.bin"
+
+    def _read_head(self, key):
+        with open(self._head_file(key), "rb") as f:
+            return _decompress(f.read())
+
+    def _write_head(self, key, packed):
+        _atomic_write(self._head_file(key), lambda f: f.write(_compress(packed)))
+
+    def _pending_file(self, key):
+        return self._head_file(key).with_suffix(".pending")
+
+    def _stage_head(self, key, packed):
+        _atomic_write(self._pending_file(key), lambda f: f.write(_compress(packed)))
+        self.pending.append(key)
+
+    def _commit_pending(self):
+        """
+        Move the staged head blocks over the head blocks. Called once the
+        manifest records them, so that the move can be finished on recovery.
+        """
+        for key in self.pending:
+            pending_file = self._pending_file(key)
+            if pending_file.exists():
+                os.replace(pending_file, self._head_file(key))
+        self.pending = []
+        self._write_manifest()
+
+    def _recover(self):
+        """
+        Finish the move of the head blocks staged by an interrupted save,
+        and remove those staged without being recorded in the manifest.
+        """
+        if self.pending:
+            self._commit_pending()
+        head = self.path / "head"
+        if head.is_dir():
+            for pending_file in head.glob("*.pending"):
+                pending_file.unlink()
+
+    def _read_diff(self, entry):
+        with open(self.path / entry["diff"], "rb") as f:
+            return pickle.load(f)
+
+    def _write_diff(self, entry, diff):
+        """
+        Write the difference of `entry` to a new file. Returns the file it
+        replaces, to be removed once the manifest no longer refers to it.
+        """
+        self.serial += 1
+        filename = f"diff_{self.serial}.pkl"
+        _atomic_write(
+                self.path / filename,
+                lambda f: pickle.dump(diff, f, protocol=pickle.HIGHEST_PROTOCOL),
+        )
+        replaced = entry["diff"]
+        entry["diff"] = filename
+        return replaced
+
+    def _write_manifest(self):
+        state = {
+                "version": SNAPSHOT_VERSION,
+                "versions": self.versions,
+                "layout": self.layout,
+                "serial": self.serial,
+                "pending": self.pending,
+        }
+        _atomic_write(
+                self.path / MANIFEST_NAME,
+                lambda f: pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL),
+        )
+
+    def clear(self):
+        """Remove all versions."""
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.versions = []
+        self.layout = None
+        self.pending = []
+
+    def save(self, name, comment=""):
+        """
+        Save the current flags as version `name`, replacing any version of
+        the same name.
+        """
+        layout = self._current_layout()
+        if layout != self.layout:
+            # Rows were added to or removed from the MS, so the blocks of the
+            # earlier versions no longer line up with the FLAG column.
+            if self.versions:
+                casalog.post(
+                        f"Rows of {self.msname} changed; removing the flag "
+                        f"versions {self.names} that no longer match them",
+                        "WARN",
+                )
+            self.clear()
+            self.layout = layout
+        if name in self:
+            self.delete(name)
+        (self.path / "head").mkdir(parents=True, exist_ok=True)
+        previous = self.versions[-1] if self.versions else None
+        diff = {}
+        tb = table()
+        try:
+            tb.open(self.msname)
+            for key, subtb, start, nrow in self._blocks(tb):
+                packed = np.packbits(subtb.getcol("FLAG", start, nrow), axis=None)
+                if previous is None:
+                    self._write_head(key, packed)
+                    continue
+                head = self._read_head(key)
+                if not np.array_equal(head, packed):
+                    diff[key] = _compress(head ^ packed)
+                    self._stage_head(key, packed)
+        finally:
+            tb.close()
+        if previous is not None:
+            self._write_diff(previous, diff)
+        self.versions.append({"name": name, "comment": comment, "diff": None})
+        self._write_manifest()
+        self._commit_pending()
+
+    def delete(self, name):
+        """
+        Remove version `name`, merging its difference into the version
+        before it.
+        """
+        index = self.names.index(name)
+        entry = self.versions[index]
+        obsolete = []
+        if index > 0:
+            before = self.versions[index - 1]
+            if entry["diff"] is None:
+                # The latest version is removed, so the head goes back to the
+                # version before it.
+                for key, data in self._read_diff(before).items():
+                    self._stage_head(key, self._read_head(key) ^ _decompress(data))
+                obsolete.append(before["diff"])
+                before["diff"] = None
+            else:
+                merged = _xor_diffs(self._read_diff(before), self._read_diff(entry))
+                obsolete.append(self._write_diff(before, merged))
+        if entry["diff"] is not None:
+            obsolete.append(entry["diff"])
+        del self.versions[index]
+        if not self.versions:
+            self.clear()
+            return
+        self._write_manifest()
+        self._commit_pending()
+        for filename in obsolete:
+            (self.path / filename).unlink(missing_ok=True)
+
+    def restore(self, name):
+        """
+        Write the flags of version `name` to the FLAG column. Only the blocks
+        that differ from the current flags are written.
+
+        Returns
+        -------
+        int
+            Number of blocks written.
+        """
+        if name not in self:
+            raise ValueError(f"Flag version does not exist: {name}")
+        if self._current_layout() != self.layout:
+            raise ValueError(
+                    f"Flag versions of {self.msname} do not match its rows"
+            )
+        index = self.names.index(name)
+        diff = {}
+        for entry in self.versions[index:-1]:
+            diff = _xor_diffs(diff, self._read_diff(entry))
+        nwritten = 0
+        tb = table()
+        try:
+            tb.open(self.msname, nomodify=False)
+            for key, subtb, start, nrow in self._blocks(tb):
+                flag = subtb.getcol("FLAG", start, nrow)
+                target = self._read_head(key)
+                if key in diff:
+                    target = target ^ _decompress(diff[key])
+                if np.array_equal(target, np.packbits(flag, axis=None)):
+                    continue
+                flag = np.unpackbits(target, count=flag.size).astype(bool).reshape(flag.shape)
+                subtb.putcol("FLAG", flag, start, nrow)
+                nwritten += 1
+        finally:
+            tb.close()
+        return nwritten
+
+
+def get_flag_versions(msname):
+    """Return the flag version store of `msname`."""
+    store = _store_cache.get(msname)
+    if store is None or not os.path.exists(store.path / MANIFEST_NAME):
+        store = FlagVersionStore(msname)
+        _store_cache[msname] = store
+    return store
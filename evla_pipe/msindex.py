@@ -0,0 +1,339 @@
+"""
+Persistent index of the measurement set metadata.
+
+The main table of a measurement set is read once over the SCAN_NUMBER,
+FIELD_ID, STATE_ID, DATA_DESC_ID, TIME, ANTENNA1 and ANTENNA2 columns, and the
+rows are reduced to one record per unique (scan, field, state, data
+description) combination. Each record holds the number of rows, the time
+range, and the antennas present. The records are written as a NumPy ``.npz``
+sidecar next to the MS (``<msname>.index.npz``) so that later stages and
+re-runs answer scan, field, intent, and spw questions without re-scanning the
+main table. The sidecar is rebuilt when the main table of the MS changes.
+
+Example:
+
+```
+msindex = get_msindex("my.ms")
+msindex.query(field=0).scans
+msindex.query(state=[1, 2]).fields
+msindex.query(scan=4).time_range
+```
+"""
+
+import os
+
+import numpy as np
+
+from casatools import table
+
+
+INDEX_VERSION = 1
+# Number of rows read from the main table at a time.
+CHUNK_ROWS = 5_000_000
+
+# Indexes loaded in this process, keyed by MS name
+_msindex_cache = {}
+
+
+def _index_filename(msname):
+    return msname.rstrip("/") + ".index.npz"
+
+
+def _ms_signature(msname):
+    """
+    Modification time and size of the main table description of the MS. The
+    description is rewritten whenever rows are added to or removed from the
+    table.
+    """
+    stat = os.stat(os.path.join(msname, "table.dat"))
+    return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+
+class MSIndex:
+    """
+    Records of the unique (scan, field, state, data description) row
+    combinations of a measurement set.
+
+    Parameters
+    ----------
+    scan, field, state, ddid : array
+        Record keys.
+    nrows : array
+        Number of rows in the main table for each record.
+    time_min, time_max : array
+        Range of the TIME column for each record.
+    antennas : array, (nrecords, nant) bool
+        Antennas present in ANTENNA1 or ANTENNA2 for each record.
+    ddid_spw : array
+        Spectral window ID of each data description.
+    """
+
+    def __init__(
+            self, scan, field, state, ddid, nrows, time_min, time_max,
+            antennas, ddid_spw,
+        ):
+        self.scan = np.asarray(scan)
+        self.field = np.asarray(field)
+        self.state = np.asarray(state)
+        self.ddid = np.asarray(ddid)
+        self.nrows = np.asarray(nrows)
+        self.time_min = np.asarray(time_min)
+        self.time_max = np.asarray(time_max)
+        self.antennas = np.asarray(antennas, dtype=bool)
+        self.ddid_spw = np.asarray(ddid_spw)
+        self.spw = self.ddid_spw[self.ddid] if len(self.ddid) > 0 else self.ddid
+
+    def __len__(self):
+        return len(self.scan)
+
+    def __repr__(self):
+        return f"MSIndex(nrecords={len(self)}, nrows={self.nrows.sum()})"
+
+    @classmethod
+    def build(cls, msname, chunk_rows=CHUNK_ROWS):
+        """
+        Build the index with one pass over the main table of `msname`.
+        """
+        tb = table()
+        try:
+            tb.open(f"{msname}/DATA_DESCRIPTION")
+            ddid_spw = tb.getcol("SPECTRAL_WINDOW_ID")
+        finally:
+            tb.close()
+        try:
+            tb.open(f"{msname}/ANTENNA")
+            nant = tb.nrows()
+        finally:
+            tb.close()
+        parts = []
+        try:
+            tb.open(msname)
+            total_rows = tb.nrows()
+            for startrow in range(0, total_rows, chunk_rows):
+                nrow = min(chunk_rows, total_rows - startrow)
+                cols = {
+                        name: tb.getcol(name, startrow, nrow)
+                        for name in (
+                            "SCAN_NUMBER", "FIELD_ID", "STATE_ID",
+                            "DATA_DESC_ID", "TIME", "ANTENNA1", "ANTENNA2",
+                        )
+                }
+                parts.append(cls._reduce_chunk(cols, nant))
+        finally:
+            tb.close()
+        return cls._merge(parts, nant, ddid_spw)
+
+    @staticmethod
+    def _reduce_chunk(cols, nant):
+        keys = np.stack([
+                cols["SCAN_NUMBER"], cols["FIELD_ID"], cols["STATE_ID"],
+                cols["DATA_DESC_ID"],
+        ], axis=1)
+        ukeys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        nrec = len(ukeys)
+        nrows = np.bincount(inverse, minlength=nrec)
+        time_min = np.full(nrec, np.inf)
+        time_max = np.full(nrec, -np.inf)
+        np.minimum.at(time_min, inverse, cols["TIME"])
+        np.maximum.at(time_max, inverse, cols["TIME"])
+        antennas = np.zeros((nrec, nant), dtype=bool)
+        antennas[inverse, cols["ANTENNA1"]] = True
+        antennas[inverse, cols["ANTENNA2"]] = True
+        return ukeys, nrows, time_min, time_max, antennas
+
+    @classmethod
+    def _merge(cls, parts, nant, ddid_spw):
+        if len(parts) == 0:
+            empty = np.array([], dtype=int)
+            return cls(
+                    empty, empty, empty, empty, empty, np.array([]),
+                    np.array([]), np.zeros((0, nant), dtype=bool), ddid_spw,
+            )
+        keys = np.concatenate([p[0] for p in parts])
+        ukeys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        nrec = len(ukeys)
+        nrows = np.bincount(
+                inverse, weights=np.concatenate([p[1] for p in parts]),
+                minlength=nrec,
+        ).astype(np.int64)
+        time_min = np.full(nrec, np.inf)
+        time_max = np.full(nrec, -np.inf)
+        np.minimum.at(time_min, inverse, np.concatenate([p[2] for p in parts]))
+        np.maximum.at(time_max, inverse, np.concatenate([p[3] for p in parts]))
+        antennas = np.zeros((nrec, nant), dtype=bool)
+        np.logical_or.at(antennas, inverse, np.concatenate([p[4] for p in parts]))
+        return cls(
+                ukeys[:, 0], ukeys[:, 1], ukeys[:, 2], ukeys[:, 3], nrows,
+                time_min, time_max, antennas, ddid_spw,
+        )
+
+    def save(self, filename, signature=None):
+        np.savez(
+                filename,
+                version=INDEX_VERSION,
+                signature=np.zeros(2, dtype=np.int64) if signature is None else signature,
+                scan=self.scan,
+                field=self.field,
+                state=self.state,
+                ddid=self.ddid,
+                nrows=self.nrows,
+                time_min=self.time_min,
+                time_max=self.time_max,
+                antennas=self.antennas,
+                ddid_spw=self.ddid_spw,
+        )
+
+    @classmethod
+    def load(cls, filename, signature=None):
+        """
+        Load an index from `filename`. Returns None if the file is of a
+        different version or its signature does not match `signature`.
+        """
+        with np.load(filename) as data:
+            if int(data["version"]) != INDEX_VERSION:
+                return None
+            if signature is not None and not np.array_equal(data["signature"], signature):
+                return None
+            return cls(
+                    data["scan"], data["field"], data["state"], data["ddid"],
+                    data["nrows"], data["time_min"], data["time_max"],
+                    data["antennas"], data["ddid_spw"],
+            )
+
+    def _subset(self, mask):
+        return MSIndex(
+                self.scan[mask], self.field[mask], self.state[mask],
+                self.ddid[mask], self.nrows[mask], self.time_min[mask],
+                self.time_max[mask], self.antennas[mask], self.ddid_spw,
+        )
+
+    def query(self, scan=None, field=None, state=None, spw=None, ddid=None):
+        """
+        Select the records matching all of the given IDs. Each argument may
+        be a single ID or a list of IDs.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for values, ids in (
+                (self.scan, scan), (self.field, field), (self.state, state),
+                (self.spw, spw), (self.ddid, ddid),
+        ):
+            if ids is not None:
+                mask &= np.isin(values, np.atleast_1d(ids))
+        return self._subset(mask)
+
+    @property
+    def scans(self):
+        return list(np.unique(self.scan))
+
+    @property
+    def fields(self):
+        return list(np.unique(self.field))
+
+    @property
+    def states(self):
+        return list(np.unique(self.state))
+
+    @property
+    def spws(self):
+        return list(np.unique(self.spw))
+
+    @property
+    def antenna_ids(self):
+        return np.flatnonzero(self.antennas.any(axis=0)).tolist()
+
+    @property
+    def time_range(self):
+        """(start, end) of the TIME column in seconds; None if empty."""
+        if len(self) == 0:
+            return None
+        return float(self.time_min.min()), float(self.time_max.max())
+
+    def scan_time_ranges(self):
+        """Dictionary of scan number to (start, end) time in seconds."""
+        return {
+                int(scan): self.query(scan=scan).time_range
+                for scan in self.scans
+        }
+
+
+def get_msindex(msname, rebuild=False):
+    """
+    Return the index for `msname`, loading it from the sidecar file if it is
+    current and otherwise building and writing it.
+    """
+    signature = _ms_signature(msname)
+    cached = _msindex_cache.get(msname)
+    if not rebuild and cached is not None and np.array_equal(cached[0], signature):
+        return cached[1]
+    filename = _index_filename(msname)
+    msindex = None
+    if not rebuild and os.path.exists(filename):
+        try:
+            msindex = MSIndex.load(filename, signature=signature)
+        except (OSError, KeyError, ValueError):
+            msindex = None
+    if msindex is None:
+        msindex = MSIndex.build(msname)
+        try:
+            msindex.save(filename, signature=signature)
+        except OSError:
+            # The directory of the MS may not be writable; only keep the
+            # index in memory.
+            pass
+    _msindex_cache[msname] = (signature, msindex)
+    return msindex
+
+
+def unflagged_scan_summary(msname, scans):
+    """
+    Time range, field and spws of the rows of `scans` that hold unflagged
+    data, as `ms.getscansummary` reports them for the MS split with
+    ``keepflags=False``. The flags are reduced per row by TaQL, so only the
+    metadata columns of those rows are read.
+
+    Returns
+    -------
+    dict
+        Scan number to a dict with the keys "begin" and "end" (TIME in
+        seconds), "field" (FIELD_ID at the start of the scan), and "spws".
+        Fully flagged scans are left out.
+    """
+    scans = [int(s) for s in scans]
+    if not scans:
+        return {}
+    ddid_spw = get_msindex(msname).ddid_spw
+    tb = table()
+    try:
+        tb.open(msname)
+        subtb = tb.query(
+                f"SCAN_NUMBER IN {scans} && !ALL(FLAG)",
+                columns="SCAN_NUMBER,FIELD_ID,DATA_DESC_ID,TIME",
+        )
+        try:
+            if subtb.nrows() == 0:
+                return {}
+            scan = subtb.getcol("SCAN_NUMBER")
+            field = subtb.getcol("FIELD_ID")
+            spw = ddid_spw[subtb.getcol("DATA_DESC_ID")]
+            time = subtb.getcol("TIME")
+        finally:
+            subtb.close()
+    finally:
+        tb.close()
+    order = np.lexsort((time, scan))
+    scan, field, spw, time = scan[order], field[order], spw[order], time[order]
+    uscans, first, inverse = np.unique(scan, return_index=True, return_inverse=True)
+    last = np.r_[first[1:], len(scan)] - 1
+    spws = np.zeros((len(uscans), int(ddid_spw.max()) + 1), dtype=bool)
+    spws[inverse, spw] = True
+    return {
+            int(s): {
+                "begin": float(time[i0]),
+                "end": float(time[i1]),
+                "field": int(field[i0]),
+                "spws": np.flatnonzero(spws[ii]).tolist(),
+            }
+            for ii, (s, i0, i1) in enumerate(zip(uscans, first, last))
+    }
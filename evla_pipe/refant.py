@@ -0,0 +1,147 @@
+"""
+Cached scores of the reference antenna heuristics.
+
+`RefAntHeuristics` is run in most calibration stages. Its geometry score
+depends only on the antenna positions, so it is computed once per array
+configuration, from the geocentric positions of all of the antennas at once,
+and cached by the names and positions of the antennas. Its flagging score is
+taken from the per-antenna counts of the flag ledger of the MS instead of a
+`flagdata(mode="summary")` pass. The ledger only recounts the cells of the
+selected scans whose flags changed, and the score of a selection is cached
+until the FLAG column changes again.
+
+The ledger counts whole scans, so a flagging score selects the scans that
+contain the selected fields and intents. Selections the ledger cannot
+resolve, such as fields given by name, fall back to a summary.
+
+Example:
+
+```
+geometry_score("my.ms")
+flagging_score("calibrators.ms", field="0,1,3")
+```
+"""
+
+import numpy as np
+
+from casatasks import flagdata
+from casatools import table
+
+from .flagledger import _parse_ids, get_flag_ledger
+from .rflag import select_records
+
+
+# Scores keyed by the array configuration and by the flag selection
+_geometry_cache = {}
+_flagging_cache = {}
+
+
+def antenna_positions(vis):
+    """Names and ITRF positions, with shape (3, nant), of the antennas."""
+    tb = table()
+    try:
+        tb.open(f"{vis}/ANTENNA")
+        names = tb.getcol("NAME").tolist()
+        positions = tb.getcol("POSITION")
+    finally:
+        tb.close()
+    return names, positions
+
+
+def array_distances(positions):
+    """
+    Distances of the antennas from the median location of the array, from
+    their geocentric ITRF `positions` with shape (3, nant).
+    """
+    x, y, z = positions
+    rad = np.sqrt(x**2 + y**2 + z**2)
+    lon = np.arctan2(y, x)
+    lat = np.arcsin(z / rad)
+    lon -= np.median(lon)
+    east = lon * np.cos(lat) * rad
+    north = lat * rad
+    east -= np.median(east)
+    north -= np.median(north)
+    return np.hypot(east, north)
+
+
+def geometry_score(vis):
+    """
+    Geometry score of each antenna of `vis`: one minus its distance from the
+    array center normalized by the largest distance, times the number of
+    antennas. Cached per array configuration.
+    """
+    names, positions = antenna_positions(vis)
+    key = (tuple(names), positions.tobytes())
+    score = _geometry_cache.get(key)
+    if score is None:
+        far = array_distances(positions)
+        closeness = (1 - far / far.max()) * len(names)
+        score = {name: float(s) for name, s in zip(names, closeness)}
+        _geometry_cache[key] = score
+    return dict(score)
+
+
+def _summary_good(vis, field, spw, intent):
+    results = flagdata(
+            vis=vis,
+            mode="summary",
+            field=field,
+            spw=spw,
+            intent=intent,
+            display="",
+            flagbackup=False,
+            savepars=False,
+    )
+    return {
+            name: vals["total"] - vals["flagged"]
+            for name, vals in results["antenna"].items()
+    }
+
+
+def _ledger_good(vis, field, spw, intent):
+    """
+    Unflagged counts per antenna of the selection from the flag ledger, or
+    None if the ledger cannot resolve the selection.
+    """
+    try:
+        spws = _parse_ids(spw)
+        records = select_records(vis, field=field, intent=intent)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    ledger = get_flag_ledger(vis)
+    ledger.refresh(scan=records.scans)
+    key = (vis, str(field), str(spw), str(intent))
+    signature = tuple(ledger.signature.tolist())
+    cached = _flagging_cache.get(key)
+    if cached is not None and cached[0] == signature:
+        return dict(cached[1])
+    scans = np.isin(ledger.scans, records.scans)
+    spw_sel = np.ones(ledger.ant_total.shape[1], dtype=bool)
+    if spws is not None:
+        spw_sel[:] = False
+        spw_sel[[s for s in spws if s < len(spw_sel)]] = True
+    total = ledger.ant_total[scans][:, spw_sel].sum(axis=(0, 1))
+    flagged = ledger.ant_flagged[scans][:, spw_sel].sum(axis=(0, 1))
+    # As in the summary, antennas without data in the selection are absent.
+    good = {
+            name: float(t - f)
+            for name, t, f in zip(ledger.antenna_names, total, flagged)
+            if t > 0
+    }
+    _flagging_cache[key] = (signature, good)
+    return dict(good)
+
+
+def flagging_score(vis, field="", spw="", intent=""):
+    """
+    Flagging score of each antenna with data in the selection: its number of
+    unflagged visibilities normalized by the largest, times the number of
+    antennas.
+    """
+    good = _ledger_good(vis, field, spw, intent)
+    if good is None:
+        good = _summary_good(vis, field, spw, intent)
+    unflag = np.array(list(good.values()), float)
+    score = unflag / unflag.max() * len(unflag)
+    return {name: float(s) for name, s in zip(good.keys(), score)}
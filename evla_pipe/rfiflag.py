@@ -0,0 +1,289 @@
+"""
+Streaming RFI flagging with NumPy, an alternative engine to
+`flagdata(mode="rflag")`.
+
+The data of a selection are read from the MS in chunks of whole integrations
+of at most `chunk_rows` rows, so the memory use is set by the chunk size: the
+peak is about 100 bytes per row and channel with four correlations, mostly
+the float64 cubes of the statistics of one correlation, or about 0.3 GB for
+the default `CHUNK_ROWS` and 64 channels. The
+amplitudes of a chunk are arranged in a (correlation, channel, baseline,
+time) cube and tested with the two statistics of rflag:
+
+* time: the RMS of the amplitudes in a sliding window of `winsize`
+  integrations, per channel and baseline. Windows with an RMS larger than
+  ``timedevscale * (median + MAD)`` of all of the RMS values of the
+  correlation are flagged at their center.
+* frequency: the absolute deviation of the amplitudes from their running
+  median over ``2 * winsize + 1`` channels, per integration and baseline.
+  Points deviating by more than ``freqdevscale * (median + MAD)`` of all of
+  the deviations of the correlation are flagged.
+
+As with ``ntime="scan"``, chunks do not span scans and the thresholds are
+computed per chunk and correlation. Flags are only added to the selected
+correlations and are written back to the FLAG column chunk by chunk, with
+FLAG_ROW set for the rows that become fully flagged. The engine is run by
+`rflag.run_rflag` with one task per (spw, scan).
+"""
+
+import warnings
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from casatools import table
+
+
+# Number of rows read from the main table at a time
+CHUNK_ROWS = 50_000
+
+STOKES_NAMES = {
+        5: "RR", 6: "RL", 7: "LR", 8: "LL",
+        9: "XX", 10: "XY", 11: "YX", 12: "YY",
+}
+
+
+def parse_correlation(correlation):
+    """
+    Correlation names of a `flagdata` correlation selection, such as
+    "ABS_RR,LL". Returns None if all correlations are selected.
+    """
+    correlation = correlation.upper()
+    for prefix in ("ABS_", "ARG_", "REAL_", "IMAG_", "NORM_"):
+        if correlation.startswith(prefix):
+            correlation = correlation[len(prefix):]
+    names = [c.strip() for c in correlation.split(",") if c.strip()]
+    if not names or "ALL" in names:
+        return None
+    return names
+
+
+def correlation_names(msname, ddid):
+    """Names of the correlations of the data description `ddid`."""
+    tb = table()
+    try:
+        tb.open(f"{msname}/DATA_DESCRIPTION")
+        polid = tb.getcell("POLARIZATION_ID", ddid)
+        tb.close()
+        tb.open(f"{msname}/POLARIZATION")
+        corr_types = tb.getcell("CORR_TYPE", polid)
+    finally:
+        tb.close()
+    return [STOKES_NAMES.get(int(c), str(c)) for c in corr_types]
+
+
+def _robust_limit(values, scale):
+    """``scale * (median + MAD)`` of the finite `values`."""
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return np.inf
+    median = np.median(values)
+    return scale * (median + np.median(np.abs(values - median)))
+
+
+def _window_sum(values, halfwidth):
+    """
+    Sums over a window of ``2*halfwidth+1`` along the last axis, truncated at
+    the edges, from a cumulative sum.
+    """
+    n = values.shape[-1]
+    csum = np.zeros(values.shape[:-1] + (n + 1,))
+    np.cumsum(values, axis=-1, out=csum[..., 1:])
+    index = np.arange(n)
+    upper = np.minimum(index + halfwidth + 1, n)
+    lower = np.maximum(index - halfwidth, 0)
+    return csum[..., upper] - csum[..., lower]
+
+
+def time_rms(amp, good, winsize):
+    """
+    RMS of `amp` in a sliding window of `winsize` integrations along the
+    last axis. Windows with fewer than two unflagged points are NaN.
+    """
+    halfwidth = winsize // 2
+    amp = np.where(good, amp, 0.0)
+    count = _window_sum(good.astype(float), halfwidth)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = _window_sum(amp, halfwidth) / count
+        var = _window_sum(amp**2, halfwidth) / count - mean**2
+    rms = np.sqrt(np.maximum(var, 0.0))
+    rms[count < 2] = np.nan
+    return rms
+
+
+def freq_deviation(amp, good, halfwidth):
+    """
+    Absolute deviation of `amp`, with shape (nchan, ...), from its running
+    median over ``2*halfwidth+1`` channels. Flagged points are NaN.
+    """
+    amp = np.where(good, amp, np.nan)
+    padded = np.pad(
+            amp, [(halfwidth, halfwidth)] + [(0, 0)] * (amp.ndim - 1),
+            mode="edge",
+    )
+    width = 2 * halfwidth + 1
+    nchan = amp.shape[0]
+    # The median copies its windows, so it is taken over blocks of channels
+    # whose windows together are about the size of the cube.
+    block = max(1, nchan // width)
+    smooth = np.empty_like(amp)
+    with warnings.catch_warnings():
+        # All-NaN windows of fully flagged data
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for start in range(0, nchan, block):
+            stop = min(start + block, nchan)
+            windows = sliding_window_view(
+                    padded[start:stop + 2 * halfwidth], width, axis=0,
+            )
+            smooth[start:stop] = np.nanmedian(windows, axis=-1)
+    return np.abs(amp - smooth)
+
+
+def flag_cube(amp, good, winsize=3, timedevscale=5.0, freqdevscale=5.0):
+    """
+    New flags for an amplitude cube of one correlation with shape (nchan,
+    nbaseline, ntime) and its unflagged mask `good`.
+    """
+    new = np.zeros(amp.shape, dtype=bool)
+    if amp.shape[-1] >= 2:
+        rms = time_rms(amp, good, winsize)
+        with np.errstate(invalid="ignore"):
+            new |= rms > _robust_limit(rms, timedevscale)
+    if amp.shape[0] >= 2:
+        deviation = freq_deviation(amp, good, winsize)
+        with np.errstate(invalid="ignore"):
+            new |= deviation > _robust_limit(deviation, freqdevscale)
+    return new & good
+
+
+def flag_chunk(data, flag, ant1, ant2, times, corr_index, **kwargs):
+    """
+    Add the RFI flags of a chunk of rows to `flag` in place and return the
+    number of visibilities newly flagged.
+
+    Parameters
+    ----------
+    data : complex array
+        Visibilities with shape (ncorr, nchan, nrow).
+    flag : bool array
+        Flags of the same shape as `data`.
+    ant1, ant2, times : array
+        ANTENNA1, ANTENNA2 and TIME of the rows.
+    corr_index : list of int
+        Indices of the correlations to flag.
+    **kwargs
+        Parameters of `flag_cube`.
+    """
+    bl_values, bl_index = np.unique(ant1 * 1024 + ant2, return_inverse=True)
+    time_values, time_index = np.unique(times, return_inverse=True)
+    shape = (data.shape[1], len(bl_values), len(time_values))
+    nflagged = 0
+    for icorr in corr_index:
+        amp = np.zeros(shape)
+        good = np.zeros(shape, dtype=bool)
+        amp[:, bl_index, time_index] = np.abs(data[icorr])
+        good[:, bl_index, time_index] = ~flag[icorr]
+        new = flag_cube(amp, good, **kwargs)[:, bl_index, time_index]
+        nflagged += int(new.sum())
+        flag[icorr] |= new
+    return nflagged
+
+
+def _chunk_bounds(times, chunk_rows):
+    """Row ranges of at most `chunk_rows` rows that split on integrations."""
+    starts = np.flatnonzero(np.r_[True, times[1:] != times[:-1]])
+    ends = np.r_[starts[1:], len(times)]
+    bounds = []
+    start = 0
+    for first, end in zip(starts, ends):
+        # Close the chunk before an integration that does not fit.
+        if end - start > chunk_rows and first > start:
+            bounds.append((start, int(first)))
+            start = int(first)
+    bounds.append((start, len(times)))
+    return bounds
+
+
+def flag_rfi(
+        msname, ddids, scans, fields=None, states=None, correlation="",
+        datacolumn="corrected", winsize=3, timedevscale=5.0,
+        freqdevscale=5.0, chunk_rows=CHUNK_ROWS,
+    ):
+    """
+    Flag RFI in the selected rows of `msname` and write the flags back.
+
+    Parameters
+    ----------
+    msname : str
+    ddids : list of int
+        Data description IDs to flag.
+    scans : list of int
+    fields, states : list of int, None
+        FIELD_IDs and STATE_IDs to select; None selects all.
+    correlation : str
+        `flagdata` correlation selection, e.g., "ABS_RR,LL".
+    datacolumn : str
+        "corrected" or "data".
+    winsize, timedevscale, freqdevscale : number
+        As for `flagdata(mode="rflag")`.
+    chunk_rows : int
+        Maximum number of rows held in memory at a time, unless a single
+        integration is larger.
+
+    Returns
+    -------
+    dict
+        Number of visibilities "flagged" by this call and "total" selected.
+    """
+    column = "CORRECTED_DATA" if datacolumn.lower() == "corrected" else "DATA"
+    selected = parse_correlation(correlation)
+    nflagged = ntotal = 0
+    tb = table()
+    try:
+        tb.open(msname, nomodify=False)
+        for ddid in ddids:
+            names = correlation_names(msname, ddid)
+            corr_index = [
+                    ii for ii, name in enumerate(names)
+                    if selected is None or name in selected
+            ]
+            if not corr_index:
+                continue
+            for scan in scans:
+                query = f"SCAN_NUMBER=={scan} && DATA_DESC_ID=={ddid}"
+                if fields is not None:
+                    query += f" && FIELD_ID IN {list(fields)}"
+                if states is not None:
+                    query += f" && STATE_ID IN {list(states)}"
+                subtb = tb.query(query, sortlist="TIME")
+                try:
+                    if subtb.nrows() == 0:
+                        continue
+                    times = subtb.getcol("TIME")
+                    for start, end in _chunk_bounds(times, chunk_rows):
+                        nrow = end - start
+                        flag = subtb.getcol("FLAG", start, nrow)
+                        nflagged += flag_chunk(
+                                subtb.getcol(column, start, nrow),
+                                flag,
+                                subtb.getcol("ANTENNA1", start, nrow),
+                                subtb.getcol("ANTENNA2", start, nrow),
+                                times[start:end],
+                                corr_index,
+                                winsize=winsize,
+                                timedevscale=timedevscale,
+                                freqdevscale=freqdevscale,
+                        )
+                        ntotal += flag[corr_index].size
+                        subtb.putcol("FLAG", flag, start, nrow)
+                        # As flagdata, flag the rows that are now fully flagged.
+                        flag_row = subtb.getcol("FLAG_ROW", start, nrow)
+                        subtb.putcol(
+                                "FLAG_ROW", flag_row | flag.all(axis=(0, 1)),
+                                start, nrow,
+                        )
+                finally:
+                    subtb.close()
+    finally:
+        tb.close()
+    return {"flagged": nflagged, "total": ntotal}
@@ -0,0 +1,416 @@
+"""
+Partitioned execution of `flagdata(mode="rflag")`.
+
+The rflag statistics are computed per spw and, with ``ntime="scan"`` and
+``combinescans=False``, per scan, so running rflag separately on each spw of
+a selection flags exactly the same data as one call over all of them. The
+spw partitions are submitted to the pipeline scheduler with a write of
+``ms:FLAG:spw=<spw>`` each, so that different spws run concurrently in the
+worker processes while passes over the same spw (e.g., the calibrator and
+then the target intents of targetflag) keep their serial order. The workers
+only share the MS through casacore table locking, which serializes the
+writes of their disjoint FLAG rows. With a serial scheduler, and without the
+pre-screen below, the original single `flagdata` call is made per pass.
+
+Optionally, each (spw, scan) is first pre-screened with robust statistics of
+its amplitudes: the time averaged spectrum is tested for channels deviating
+from its running median, and the channel averaged amplitude of each row,
+normalized by the mean of its baseline, for outliers in time. rflag is then
+only run on the selections with outliers, and the scores and decisions are
+written to a report.
+
+The flagging itself is done either by `flagdata` or, with
+``engine="numpy"``, by the streaming NumPy flagger of `rfiflag` with one
+task per (spw, scan).
+
+Example:
+
+```
+run_rflag(
+    ms_active, intents=("*CALIBRATE*", "*TARGET*"), flagbackup=True,
+    correlation="ABS_RR,LL", ntime="scan", combinescans=False, ...,
+    prescreen=True, report="logs/targetflag_prescreen.txt",
+)
+```
+"""
+
+from fnmatch import fnmatchcase
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from casatasks import flagdata
+from casatools import table
+
+from .flagledger import _parse_ids
+from .flagversions import get_flag_versions
+from .msindex import get_msindex
+from .rfiflag import flag_rfi
+from .scheduler import get_scheduler
+
+
+# Outlier scores, in units of the normalized median absolute deviation, above
+# which a (spw, scan) is passed on to rflag by the pre-screen. The averaged
+# amplitudes are far less noisy than the data rflag sees, so these are
+# deliberately low.
+SCREEN_SPECTRAL_LIMIT = 5.0
+SCREEN_TEMPORAL_LIMIT = 6.0
+# Half width in channels of the running median removed from the spectrum
+SCREEN_HALFWIDTH = 4
+# Number of rows read from the main table at a time
+SCREEN_CHUNK_ROWS = 50_000
+MAD_TO_SIGMA = 1.4826
+
+
+def intent_state_ids(msname, intent):
+    """
+    STATE_IDs of `msname` with an OBS_MODE matching the intent selection
+    `intent`, a comma separated list of patterns with ``*`` wildcards as for
+    `flagdata`. Returns None for an empty selection.
+    """
+    if not intent:
+        return None
+    tb = table()
+    try:
+        tb.open(f"{msname}/STATE")
+        obs_modes = list(tb.getcol("OBS_MODE"))
+    finally:
+        tb.close()
+    patterns = [p.strip() for p in intent.split(",") if p.strip()]
+    return [
+            ii for ii, mode in enumerate(obs_modes)
+            if any(fnmatchcase(mode, p) for p in patterns)
+    ]
+
+
+def select_records(msname, scan="", field="", intent=""):
+    """
+    Records of the MS index of `msname` in the `scan`, `field` and `intent`
+    selection. Scans and fields are selected by ID.
+    """
+    return get_msindex(msname).query(
+            scan=_parse_ids(scan),
+            field=_parse_ids(field),
+            state=intent_state_ids(msname, intent),
+    )
+
+
+def robust_score(values):
+    """
+    Largest absolute deviation of `values` from their median in units of
+    the normalized median absolute deviation. NaNs are ignored.
+    """
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return 0.0
+    deviation = np.abs(values - np.median(values))
+    sigma = MAD_TO_SIGMA * np.median(deviation)
+    if sigma == 0:
+        return 0.0 if deviation.max() == 0 else np.inf
+    return float(deviation.max() / sigma)
+
+
+def spectral_score(spectrum, halfwidth=SCREEN_HALFWIDTH):
+    """
+    Outlier score of the channels of a time averaged `spectrum` about its
+    running median over ``2*halfwidth+1`` channels. Flagged channels are NaN.
+    """
+    spectrum = spectrum[np.isfinite(spectrum)]
+    if spectrum.size < 2 * halfwidth + 1:
+        return 0.0
+    padded = np.pad(spectrum, halfwidth, mode="edge")
+    smooth = np.median(sliding_window_view(padded, 2 * halfwidth + 1), axis=-1)
+    return robust_score(spectrum - smooth)
+
+
+def temporal_score(amplitude, baseline):
+    """
+    Outlier score of the channel averaged `amplitude` of each row after
+    dividing out the mean of its `baseline`. Flagged rows are NaN.
+    """
+    good = np.isfinite(amplitude)
+    if not good.any():
+        return 0.0
+    _, inverse = np.unique(baseline[good], return_inverse=True)
+    amplitude = amplitude[good]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.bincount(inverse, amplitude) / np.bincount(inverse)
+        return robust_score(amplitude / means[inverse])
+
+
+def _screen_rows(subtb, column):
+    nrow = subtb.nrows()
+    spec_sum = spec_count = None
+    row_amplitude, row_baseline = [], []
+    for start in range(0, nrow, SCREEN_CHUNK_ROWS):
+        count = min(SCREEN_CHUNK_ROWS, nrow - start)
+        good = ~subtb.getcol("FLAG", start, count)
+        amplitude = np.where(good, np.abs(subtb.getcol(column, start, count)), 0)
+        if spec_sum is None:
+            spec_sum = np.zeros(amplitude.shape[:2])
+            spec_count = np.zeros(amplitude.shape[:2])
+        spec_sum += amplitude.sum(axis=2)
+        spec_count += good.sum(axis=2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            row_amplitude.append(amplitude.sum(axis=1) / good.sum(axis=1))
+        row_baseline.append(
+                subtb.getcol("ANTENNA1", start, count) * 1024
+                + subtb.getcol("ANTENNA2", start, count)
+        )
+    if spec_sum is None:
+        return 0.0, 0.0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        spectrum = spec_sum / spec_count
+    row_amplitude = np.concatenate(row_amplitude, axis=1)
+    row_baseline = np.concatenate(row_baseline)
+    npol = spectrum.shape[0]
+    return (
+            max(spectral_score(spectrum[ii]) for ii in range(npol)),
+            max(temporal_score(row_amplitude[ii], row_baseline) for ii in range(npol)),
+    )
+
+
+def screen_spw(msname, ddids, scans, fields=None, states=None, column="CORRECTED_DATA"):
+    """
+    Spectral and temporal outlier scores of each scan of one spw.
+
+    Parameters
+    ----------
+    msname : str
+    ddids : list of int
+        Data description IDs of the spw.
+    scans : list of int
+    fields, states : list of int, None
+        FIELD_IDs and STATE_IDs to select; None selects all.
+    column : str
+        Data column to screen.
+
+    Returns
+    -------
+    dict
+        Scan number to (spectral, temporal) score.
+    """
+    scores = {}
+    tb = table()
+    try:
+        tb.open(msname)
+        for scan in scans:
+            scan_scores = [(0.0, 0.0)]
+            # Data descriptions of one spw may differ in their correlations
+            # and so in the shape of the data.
+            for ddid in ddids:
+                query = f"SCAN_NUMBER=={scan} && DATA_DESC_ID=={ddid}"
+                if fields is not None:
+                    query += f" && FIELD_ID IN {list(fields)}"
+                if states is not None:
+                    query += f" && STATE_ID IN {list(states)}"
+                subtb = tb.query(
+                        query, columns=f"ANTENNA1,ANTENNA2,FLAG,{column}",
+                )
+                try:
+                    scan_scores.append(_screen_rows(subtb, column))
+                finally:
+                    subtb.close()
+            scores[int(scan)] = tuple(max(s) for s in zip(*scan_scores))
+    finally:
+        tb.close()
+    return scores
+
+
+def prescreen_partitions(msname, records, intent="", field="", datacolumn="corrected"):
+    """
+    Screen each (spw, scan) of the MS index `records` for outliers on the
+    pipeline scheduler.
+
+    Returns
+    -------
+    partitions : dict
+        Spw to the list of scans that need rflag.
+    screened : list of dict
+        One entry per (spw, scan) with the keys "intent", "spw", "scan",
+        "spectral", "temporal" and "rflag".
+    """
+    sched = get_scheduler()
+    column = "CORRECTED_DATA" if datacolumn.lower() == "corrected" else "DATA"
+    fields = _parse_ids(field)
+    states = intent_state_ids(msname, intent)
+    tasks = {}
+    for spw in records.spws:
+        subset = records.query(spw=spw)
+        tasks[int(spw)] = sched.submit(
+                f"rflag prescreen spw {spw}",
+                screen_spw,
+                args=(
+                    msname, [int(d) for d in np.unique(subset.ddid)],
+                    [int(s) for s in subset.scans], fields, states, column,
+                ),
+                reads=(f"ms:{column}", f"ms:FLAG:spw={spw}"),
+        )
+    partitions, screened = {}, []
+    for spw, task in tasks.items():
+        for scan, (spectral, temporal) in sorted(task.result().items()):
+            dirty = (
+                    spectral > SCREEN_SPECTRAL_LIMIT
+                    or temporal > SCREEN_TEMPORAL_LIMIT
+            )
+            if dirty:
+                partitions.setdefault(spw, []).append(scan)
+            screened.append({
+                    "intent": intent, "spw": spw, "scan": scan,
+                    "spectral": spectral, "temporal": temporal,
+                    "rflag": dirty,
+            })
+    return partitions, screened
+
+
+def write_screen_report(filename, screened):
+    """
+    Write the outlier scores of `prescreen_partitions` and whether rflag was
+    run or skipped on each (intent, spw, scan).
+    """
+    with open(filename, "w") as f:
+        f.write(
+                f"# rflag pre-screen; limits: spectral {SCREEN_SPECTRAL_LIMIT}, "
+                f"temporal {SCREEN_TEMPORAL_LIMIT}\n"
+        )
+        f.write("# intent spw scan spectral temporal action\n")
+        for entry in screened:
+            f.write(
+                    f"{entry['intent'] or '*'} {entry['spw']} {entry['scan']} "
+                    f"{entry['spectral']:.2f} {entry['temporal']:.2f} "
+                    f"{'rflag' if entry['rflag'] else 'skipped'}\n"
+            )
+
+
+def _submit_numpy_rflag(vis, spw, records, scans, fields, states, kwargs):
+    sched = get_scheduler()
+    datacolumn = kwargs.get("datacolumn", "corrected")
+    column = "CORRECTED_DATA" if datacolumn.lower() == "corrected" else "DATA"
+    subset = records.query(spw=spw)
+    ddids = [int(d) for d in np.unique(subset.ddid)]
+    if scans is None:
+        scans = [int(s) for s in subset.scans]
+    for scan in scans:
+        sched.submit(
+                f"rfiflag spw {spw} scan {scan}",
+                flag_rfi,
+                args=(vis, ddids, [scan], fields, states),
+                kwargs={
+                    "correlation": kwargs.get("correlation", ""),
+                    "datacolumn": datacolumn,
+                    "winsize": kwargs.get("winsize", 3),
+                    "timedevscale": kwargs.get("timedevscale", 5.0),
+                    "freqdevscale": kwargs.get("freqdevscale", 5.0),
+                },
+                reads=(f"ms:{column}",),
+                writes=(f"ms:FLAG:spw={spw}:scan={scan}",),
+        )
+
+
+def run_rflag(
+        vis, intents=("",), flagbackup=False, prescreen=False, report=None,
+        engine="flagdata", **kwargs,
+    ):
+    """
+    Run `flagdata(mode="rflag", action="apply")` on `vis` once for each
+    intent selection in `intents`, partitioned by spw when the pipeline
+    scheduler has worker processes or when pre-screening.
+
+    Parameters
+    ----------
+    vis : str
+    intents : iterable of str
+        Intent selections run in order; "" selects all intents.
+    flagbackup : bool
+        Save a flag version before each pass with `flagversions`.
+    prescreen : bool
+        Only run rflag on the (spw, scan) selections with outliers in their
+        channel and time averaged amplitudes.
+    report : str, None
+        File to write the pre-screen scores and decisions to.
+    engine : str
+        "flagdata" to run `flagdata(mode="rflag")`, or "numpy" to run
+        `rfiflag.flag_rfi` on each (spw, scan). The numpy engine uses the
+        selection and the `correlation`, `datacolumn`, `winsize`,
+        `timedevscale` and `freqdevscale` parameters; the other parameters
+        only apply to `flagdata`, and no flag commands are saved.
+    **kwargs
+        Other `flagdata` parameters. A `spw` selection is not supported.
+        With `savepars=True` the partitions do not write to FLAG_CMD
+        concurrently; the command of each partition that was run, with its
+        spw and scans, is saved after they finish.
+
+    Returns
+    -------
+    list of dict
+        The pre-screen entries of `prescreen_partitions`, if any.
+    """
+    if "spw" in kwargs:
+        raise ValueError("run_rflag partitions by spw; spw cannot be selected")
+    if engine not in ("flagdata", "numpy"):
+        raise ValueError(f"Invalid rflag engine: {engine}")
+    savepars = kwargs.pop("savepars", False)
+    sched = get_scheduler()
+    screened = []
+    partition_commands = []
+    for intent in intents:
+        if flagbackup:
+            # Earlier passes must finish before their flags are saved.
+            sched.wait(writes=("ms:FLAG",))
+            flag_versions = get_flag_versions(vis)
+            flag_versions.save(
+                    flag_versions.next_name("flagdata"),
+                    comment=f"Flags autosave before rflag on intent '{intent}'",
+            )
+        if sched.serial and not prescreen and engine == "flagdata":
+            flagdata(
+                    vis=vis, mode="rflag", intent=intent, action="apply",
+                    flagbackup=False, savepars=savepars, **kwargs,
+            )
+            continue
+        records = select_records(
+                vis, kwargs.get("scan", ""), kwargs.get("field", ""), intent,
+        )
+        if prescreen:
+            partitions, intent_screened = prescreen_partitions(
+                    vis, records, intent, kwargs.get("field", ""),
+                    kwargs.get("datacolumn", "corrected"),
+            )
+            screened.extend(intent_screened)
+        else:
+            partitions = {int(spw): None for spw in records.spws}
+        if engine == "numpy":
+            fields = _parse_ids(kwargs.get("field", ""))
+            states = intent_state_ids(vis, intent)
+            for spw, scans in partitions.items():
+                _submit_numpy_rflag(
+                        vis, spw, records, scans, fields, states, kwargs,
+                )
+            continue
+        for spw, scans in partitions.items():
+            task_kwargs = dict(kwargs, spw=str(spw), intent=intent)
+            if scans is not None:
+                task_kwargs["scan"] = ",".join(str(s) for s in scans)
+            sched.submit_casa_task(
+                    "flagdata",
+                    reads=("ms:CORRECTED_DATA",),
+                    writes=(f"ms:FLAG:spw={spw}",),
+                    vis=vis,
+                    mode="rflag",
+                    action="apply",
+                    flagbackup=False,
+                    savepars=False,
+                    **task_kwargs,
+            )
+            partition_commands.append(task_kwargs)
+    sched.wait(writes=("ms:FLAG",))
+    if savepars:
+        # Only save the commands; the partitions have applied the flags.
+        for task_kwargs in partition_commands:
+            flagdata(
+                    vis=vis, mode="rflag", action="", flagbackup=False,
+                    savepars=True, **task_kwargs,
+            )
+    if report is not None and prescreen:
+        write_screen_report(report, screened)
+    return screened
@@ -0,0 +1,514 @@
+"""
+Dependency-aware execution of the pipeline stages.
+
+Each `EVLA_pipe_*.py` script is described by a `Stage` that declares the
+resources it reads and writes. Resources are plain strings with a kind prefix:
+
+    ms:<column>    column or sub-table of the active MS, e.g. "ms:FLAG"
+    calms          the split calibrator MS, "calibrators.ms"
+    table:<name>   calibration table on disk, e.g. "table:testdelay.k"
+    plot:<file>    PNG file written to the working directory, by file name
+    file:<name>    any other file or directory
+
+A resource overlaps with itself and with every resource nested below it, so
+"ms" conflicts with "ms:FLAG" and "plot" conflicts with every plot.
+
+The scripts share one global namespace and so are executed one at a time in
+the reference serial order of `PIPELINE_STAGES` in the main process; the
+variables they pass on to one another are therefore not declared.
+Independent work inside of a stage (such as plotting or listing) is submitted
+to the `TaskScheduler` worker pool as a task with its own read/write
+declarations. Tasks keep running across stage
+boundaries until a later stage touches a resource that conflicts with them, so
+the calibration itself is never changed by running work concurrently.
+"""
+
+import os
+import importlib
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+
+def overlaps(res_a, res_b):
+    """
+    Test if two resource names refer to overlapping data.
+    """
+    return (
+            res_a == res_b
+            or res_a.startswith(res_b + ":")
+            or res_b.startswith(res_a + ":")
+    )
+
+
+def any_overlap(resources_a, resources_b):
+    return any(overlaps(a, b) for a in resources_a for b in resources_b)
+
+
+class Stage:
+    """
+    A single pipeline script and the resources it reads and writes.
+
+    Parameters
+    ----------
+    name : str
+        Script name without the "EVLA_pipe_" prefix, e.g. "msinfo".
+    reads : iterable of str
+        Resources required by the stage.
+    writes : iterable of str
+        Resources created or modified by the stage.
+    """
+
+    def __init__(self, name, reads=(), writes=()):
+        self.name = name
+        self.reads = frozenset(reads)
+        self.writes = frozenset(writes)
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+    @property
+    def script(self):
+        return f"EVLA_pipe_{self.name}"
+
+    @property
+    def resources(self):
+        return self.reads | self.writes
+
+
+def stage_index(stages, name):
+    """
+    Index of the first stage with the given name.
+    """
+    for ii, stage in enumerate(stages):
+        if stage.name == name:
+            return ii
+    raise ValueError(f"No stage named: {name}")
+
+
+def _run_callable(module_name, func_name, args, kwargs):
+    module = importlib.import_module(module_name)
+    func = getattr(module, func_name)
+    return func(*args, **kwargs)
+
+
+def _init_worker(logfile):
+    # Share the main CASA log file so task messages end up in one place.
+    from casatasks import casalog
+    if logfile is not None:
+        casalog.setlogfile(logfile)
+    # Import plotms up front; the plotms session it starts on the first plot
+    # is then reused by all of the plots rendered in this worker.
+    try:
+        import casaplotms  # noqa: F401 imported for its side effect only
+    except ImportError:
+        pass
+
+
+class Task:
+    """
+    Handle for a unit of work submitted to the `TaskScheduler`.
+    """
+
+    def __init__(self, name, future, reads=(), writes=()):
+        self.name = name
+        self.future = future
+        self.reads = frozenset(reads)
+        self.writes = frozenset(writes)
+
+    def __repr__(self):
+        return f"Task({self.name!r})"
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        return self.future.result()
+
+    def conflicts_with(self, reads=(), writes=()):
+        """
+        Test if the task must finish before work with the given resource
+        access may start.
+        """
+        return (
+                any_overlap(self.writes, reads)
+                or any_overlap(self.writes, writes)
+                or any_overlap(self.reads, writes)
+        )
+
+
+class TaskScheduler:
+    """
+    Run independent pipeline work in a pool of worker processes.
+
+    The work is specified by the module and function name so that the CASA
+    tasks and tools are imported and initialized in the worker processes,
+    which are kept alive for the lifetime of the scheduler.
+
+    Parameters
+    ----------
+    nprocs : int
+        Number of worker processes. If one or fewer then all work is executed
+        immediately in the calling process, which reproduces the behavior of
+        a purely serial pipeline.
+    logfile : str, None
+        CASA log file for the workers to write to.
+    """
+
+    def __init__(self, nprocs=1, logfile=None):
+        self.nprocs = 1 if nprocs is None else max(1, int(nprocs))
+        self.logfile = logfile
+        self.tasks = []
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=exc_type is None)
+
+    @property
+    def serial(self):
+        return self.nprocs <= 1
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            # CASA is not fork-safe, so always start fresh interpreters.
+            self._executor = ProcessPoolExecutor(
+                    max_workers=self.nprocs,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.logfile,),
+            )
+        return self._executor
+
+    def submit(self, name, func, args=(), kwargs=None, reads=(), writes=()):
+        """
+        Submit a function for execution once all conflicting tasks finish.
+
+        Parameters
+        ----------
+        name : str
+            Label used in log messages.
+        func : callable
+            Module-level function; it is looked up by name in the workers.
+        args : tuple
+            Positional arguments to `func`.
+        kwargs : dict, None
+            Keyword arguments to `func`.
+        reads, writes : iterable of str
+            Resources accessed by the task.
+
+        Returns
+        -------
+        Task
+        """
+        # Tasks submitted earlier with conflicting access must finish first
+        # in order to preserve the serial ordering semantics.
+        self.wait(reads=reads, writes=writes)
+        call = (func.__module__, func.__name__, args, kwargs or {})
+        if self.serial:
+            # Run in-line so that exceptions are raised at the call site.
+            future = Future()
+            future.set_result(_run_callable(*call))
+        else:
+            future = self.executor.submit(_run_callable, *call)
+        task = Task(name, future, reads=reads, writes=writes)
+        self.tasks.append(task)
+        return task
+
+    def submit_casa_task(self, task_name, reads=(), writes=(), module="casatasks", **kwargs):
+        """
+        Submit a CASA task, such as `plotms` or `listobs`, by name.
+        """
+        return self.submit(
+                task_name,
+                run_casa_task,
+                args=(module, task_name, kwargs),
+                reads=reads,
+                writes=writes,
+        )
+
+    def wait(self, reads=None, writes=None):
+        """
+        Block until the tasks conflicting with the given resource access
+        finish. If no resources are given, then wait for all tasks. Exceptions
+        raised in a task are re-raised here.
+        """
+        if reads is None and writes is None:
+            pending = list(self.tasks)
+        else:
+            reads = () if reads is None else reads
+            writes = () if writes is None else writes
+            pending = [t for t in self.tasks if t.conflicts_with(reads, writes)]
+        for task in pending:
+            self.tasks.remove(task)
+        for task in pending:
+            task.result()
+
+    def wait_for_stage(self, stage):
+        self.wait(reads=stage.reads, writes=stage.writes)
+
+    def shutdown(self, wait=True):
+        if wait:
+            self.wait()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+def run_casa_task(module_name, task_name, kwargs):
+    module = importlib.import_module(module_name)
+    return getattr(module, task_name)(**kwargs)
+
+
+# The scheduler used by the pipeline scripts. A serial scheduler is used if
+# the scripts are executed outside of `run_pipeline`.
+_scheduler = None
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = TaskScheduler(nprocs=1)
+    return _scheduler
+
+
+def set_scheduler(scheduler):
+    global _scheduler
+    _scheduler = scheduler
+
+
+def vis_resource(vis):
+    """
+    Resource name of the data read from `vis`: the calibrator MS, a
+    measurement set, or a calibration table.
+    """
+    vis = vis.rstrip("/")
+    if vis == "calibrators.ms":
+        return "calms"
+    if vis.endswith(".ms"):
+        return "ms"
+    return f"table:{vis}"
+
+
+def plotms(reads=None, **kwargs):
+    """
+    Queue a `plotms` call on the pipeline scheduler and return the `Task`.
+    The plot is rendered by a worker process while the calling script carries
+    on, and the stages reading the plots wait for it to finish.
+
+    Parameters
+    ----------
+    reads : iterable of str, None
+        Resources read by the plot. If unset, the whole of `vis` is assumed
+        to be read.
+    **kwargs
+        Parameters of `casaplotms.plotms`.
+    """
+    if reads is None:
+        reads = (vis_resource(kwargs["vis"]),)
+    plotfile = kwargs.get("plotfile", "")
+    writes = (f"plot:{plotfile}",) if plotfile else ()
+    return get_scheduler().submit_casa_task(
+            "plotms",
+            module="casaplotms",
+            reads=reads,
+            writes=writes,
+            **kwargs,
+    )
+
+
+def default_nprocs():
+    return max(1, min(8, os.cpu_count() or 1))
+
+
+# Stage declarations in the reference serial order. The stages are run one at
+# a time, so only the data on disk that a stage shares with the tasks still
+# running from earlier stages is declared; plots are declared by file name.
+PIPELINE_STAGES = [
+    # The following script includes all the definitions and functions and
+    # prior inputs needed by a run of the pipeline.
+    Stage("startup"),
+    # Import the data to CASA.
+    Stage(
+        "import",
+        writes=("ms",),
+    ),
+    # Hanning smooth.
+    # NOTE: This step is optional and likely unwanted for spectral line
+    # projects, but Hanning may be important if there is strong, narrowband RFI.
+    Stage(
+        "hanning",
+        writes=("ms",),
+    ),
+    # Get information from the MS that will be needed later, list the data, and
+    # write generic diagnostic plots.
+    Stage(
+        "msinfo",
+        reads=("ms:meta",),
+        writes=(
+            "file:listobs", "plot:onlineFlags.png",
+            "plot:plotants.png", "plot:plotantslog.png", "plot:el_vs_time.png",
+            "plot:plotweather.png",
+        ),
+    ),
+    # Deterministic flagging: (1) time-based for online flags, shadowed data,
+    # zeroes, pointing scans, quacking, and (2) channel-based for end 5% of
+    # channels of each SpW, 10 end channels at edges of basebands.
+    Stage(
+        "flagall",
+        writes=("ms:FLAG",),
+    ),
+    # Prepare for calibrations. Fill model columns for primary calibrators.
+    Stage(
+        "calprep",
+        writes=("ms:MODEL_DATA",),
+    ),
+    # Apply "prior" calibrations (gain curves, opacities, antenna position
+    # corrections, and requantizer gains). Plot switched power tables,
+    # although not currently used in calibration.
+    Stage(
+        "priorcals",
+        reads=("ms:meta",),
+        writes=(
+            "table:gain_curves.g", "table:opacities.g",
+            "table:requantizergains.g", "table:antposcal.p",
+            "table:switched_power.g",
+        ),
+    ),
+    # Initial test calibrations using bandpass and delay calibrators.
+    Stage(
+        "testBPdcals",
+        reads=(
+            "ms:DATA", "ms:FLAG", "ms:MODEL_DATA", "table:gain_curves.g",
+            "table:opacities.g", "table:requantizergains.g",
+            "table:antposcal.p",
+        ),
+        writes=(
+            "ms:CORRECTED_DATA", "ms:FLAG", "table:testdelayinitialgain.g",
+            "table:testdelay.k", "table:testBPdinitialgain.g",
+            "table:testBPcal.b",
+        ),
+    ),
+    # Identify and flag basebands with bad deformatters or RFI based on
+    # the bandpass table amplitudes and phases.
+    Stage(
+        "flag_baddeformatters",
+        reads=("table:testBPcal.b",),
+        writes=("ms:FLAG",),
+    ),
+    # Flag possible RFI on the bandpass calibrator using `rflag`.
+    Stage(
+        "checkflag",
+        reads=("ms:CORRECTED_DATA",),
+        writes=("ms:FLAG",),
+    ),
+    # Do semi-final delay and bandpass calibrations. This step is "semi-final"
+    # because we have not yet determined the spectral index of the bandpass
+    # calibrator.
+    Stage(
+        "semiFinalBPdcals1",
+        reads=("ms:DATA", "ms:FLAG", "ms:MODEL_DATA"),
+        writes=(
+            "ms:CORRECTED_DATA", "ms:FLAG", "table:semiFinaldelayinitialgain.g",
+            "table:delay.k", "table:testdelay.k", "table:BPdinitialgain.g",
+            "table:BPcal.b", "plot:semifinalcalibratedcals1.png",
+        ),
+    ),
+    # Use flagdata again on calibrators
+    Stage(
+        "checkflag_semiFinal",
+        reads=("ms:CORRECTED_DATA",),
+        writes=("ms:FLAG",),
+    ),
+    # Re-run semiFinalBPdcals following flagging with `rflag` above.
+    Stage(
+        "semiFinalBPdcals1",
+        reads=("ms:DATA", "ms:FLAG", "ms:MODEL_DATA"),
+        writes=(
+            "ms:CORRECTED_DATA", "ms:FLAG", "table:semiFinaldelayinitialgain.g",
+            "table:delay.k", "table:testdelay.k", "table:BPdinitialgain.g",
+            "table:BPcal.b", "plot:semifinalcalibratedcals1.png",
+        ),
+    ),
+    # Determine solution interval (solint) for scan-average equivalent.
+    Stage(
+        "solint",
+        reads=("ms:FLAG",),
+    ),
+    # Do test gain calibrations to establish short solution interval.
+    Stage(
+        "testgains",
+        reads=("ms:CORRECTED_DATA", "ms:FLAG"),
+        writes=("calms", "table:testgaincal.g"),
+    ),
+    # Make gain table for flux density bootstrapping. Create gain table with
+    # gain and opacity corrections for final amplitude calibration for flux
+    # density bootstrapping.
+    Stage(
+        "fluxgains",
+        writes=("calms", "table:fluxphaseshortgaincal.g", "table:fluxgaincal.g"),
+    ),
+    # Flag gain table prior to flux density bootstrapping.
+    # NOTE: Break here to flag the gain table interatively, if desired; this
+    # step is not included in real-time pipeline otherwise.
+    #Stage("fluxflag", reads=("table:fluxgaincal.g",), writes=("table:fluxgaincal.g",)),
+    # Perform the flux density bootstrapping. This fits spectral index of
+    # calibrators with a power-law and writes values into the model column.
+    Stage(
+        "fluxboot",
+        reads=("table:fluxgaincal.g",),
+        writes=(
+            "calms", "table:fluxgaincalFcal.g",
+            "plot:bootstrappedFluxDensities.png",
+        ),
+    ),
+    # Make final calibration tables.
+    Stage(
+        "finalcals",
+        reads=("ms:DATA", "ms:FLAG", "ms:MODEL_DATA"),
+        writes=(
+            "ms:CORRECTED_DATA", "ms:FLAG", "calms",
+            "table:finaldelayinitialgain.g", "table:finaldelay.k",
+            "table:finalBPinitialgain.g", "table:finalBPcal.b",
+            "table:averagephasegain.g", "table:phaseshortgaincal.g",
+            "table:finalampgaincal.g", "table:finalphasegaincal.g",
+        ),
+    ),
+    # Apply all calibrations and check calibrated data.
+    Stage(
+        "applycals",
+        reads=(
+            "table:finaldelay.k", "table:finalBPcal.b",
+            "table:averagephasegain.g", "table:finalampgaincal.g",
+            "table:finalphasegaincal.g",
+        ),
+        writes=("ms:CORRECTED_DATA", "ms:FLAG"),
+    ),
+    # Now run all calibrated data (including target) through `rflag`.
+    Stage(
+        "targetflag",
+        reads=("ms:CORRECTED_DATA",),
+        writes=("ms:FLAG",),
+    ),
+    # Calculate data weights based on standard deviation within each SpW.
+    Stage(
+        "statwt",
+        reads=("ms:CORRECTED_DATA",),
+        writes=("ms:WEIGHT", "ms:FLAG"),
+    ),
+    # Make final uv plots.
+    Stage(
+        "plotsummary",
+        reads=("ms:CORRECTED_DATA", "ms:MODEL_DATA", "ms:FLAG", "ms:WEIGHT"),
+    ),
+    # Collect relevant plots and tables.
+    Stage(
+        "filecollect",
+        reads=("plot", "table", "file:listobs"),
+        writes=("plot", "table"),
+    ),
+    # Write weblog.
+    Stage("weblog"),
+]
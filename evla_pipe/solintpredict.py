@@ -0,0 +1,412 @@
+"""
+Prediction of the short gain solution interval from the expected SNR.
+
+The testBPdcals and testgains stages look for the shortest solution interval
+(1, 3 or 10 integrations, or a scan) for which few gain solutions are flagged
+for low SNR. Rather than solving for every candidate, the SNR of the antenna
+based solutions is predicted per spw from the radiometer equation,
+
+    SNR = S / SEFD * eta * sqrt(2 * bandwidth * solint * nbaselines),
+
+with the flux density `S` of the weakest calibrator, the typical SEFD of the
+band, the bandwidth of the channels of the spw selection of the solve that
+are not fully flagged, and the median number of unflagged baselines per
+antenna from the flag ledger. The flux density is taken from the `fluxscale`
+results when a previous run has them, from the Perley-Butler models in
+``data/`` for the standard calibrators, or, for the other calibrators of the
+calibrator MS, from the ratio of their amplitudes to those of a standard
+calibrator.
+
+The predicted interval is the shortest for which the fraction of spws with an
+SNR below ``margin * minsnr`` does not exceed the flagging threshold. It is
+solved on its own, and the next longer interval, the only fallback, is solved
+only if too many of its solutions are flagged. Each
+prediction and its outcome are appended to ``logs/solint_prediction.txt`` for
+tuning the margin and the SEFDs.
+
+Example:
+
+```
+predictor = SolintPredictor(ms_active, testgainscans, fields, field_names)
+rounds, prediction = predictor.search_rounds([6.0, 18.0, 60.0], minsnr=5.0, critfrac=0.05)
+```
+"""
+
+import re
+
+import numpy as np
+
+from casatools import table
+
+from . import PIPE_PATH
+from .flagledger import _parse_ids, get_flag_ledger
+from .utils import _frac_flagged, find_EVLA_band
+
+
+# Typical system equivalent flux densities (Jy) of the VLA antennas per band.
+BAND_SEFD = {
+        "4": 15000.0,
+        "P": 3000.0,
+        "L": 420.0,
+        "S": 370.0,
+        "C": 310.0,
+        "X": 250.0,
+        "U": 280.0,
+        "K": 450.0,
+        "A": 590.0,
+        "Q": 1060.0,
+}
+# Correlator efficiency of the WIDAR correlator
+CORRELATOR_EFFICIENCY = 0.93
+# Factor on the `minsnr` of gaincal that the predicted SNR has to reach, for
+# decorrelation, pointing and elevation losses not in the SEFDs.
+SNR_MARGIN = 2.0
+
+MODEL_DIR = PIPE_PATH.parent / "data"
+# Perley-Butler 2019 model of each standard calibrator and the B1950 and
+# J2000 names its field may be given.
+STANDARD_SOURCES = {
+        "3C48": ("3C48_2019.txt", ("0137+331", "J0137+3309")),
+        "3C138": ("3C138_2019.txt", ("0521+166", "J0521+1638")),
+        "3C147": ("3C147_2019.txt", ("0542+498", "J0542+4951")),
+        "3C196": ("3C196_2019.txt", ("0813+482", "J0813+4813")),
+        "3C286": ("3C286_2019.txt", ("1331+305", "J1331+3030")),
+        "3C295": ("3C295_2019.txt", ("1411+522", "J1411+5212")),
+}
+
+_model_cache = {}
+
+
+def parse_spw_channels(spw, nchans):
+    """
+    Channel masks of a CASA spw selection such as "0:21~43,1", by spw, for
+    spws with `nchans` channels. Returns None if all channels are selected.
+    Only spw IDs and channel ranges by index are supported.
+    """
+    if spw.strip() == "":
+        return None
+    masks = {}
+    for item in spw.split(","):
+        ids, _, chans = item.partition(":")
+        for ispw in _parse_ids(ids):
+            mask = masks.setdefault(ispw, np.zeros(nchans[ispw], dtype=bool))
+            if not chans:
+                mask[:] = True
+                continue
+            for chan_range in chans.split(";"):
+                start, _, end = chan_range.partition("~")
+                mask[int(start):int(end or start) + 1] = True
+    return masks
+
+
+def standard_source(field_name):
+    """Name of the standard calibrator `field_name` refers to, or None."""
+    field_name = str(field_name).upper()
+    for source, (_, aliases) in STANDARD_SOURCES.items():
+        for name in (source,) + aliases:
+            if re.search(rf"(?<![0-9]){re.escape(name)}(?![0-9])", field_name):
+                return source
+    return None
+
+
+def model_flux(source, frequency):
+    """
+    Stokes I flux density (Jy) of the standard calibrator `source` at
+    `frequency` (Hz), interpolated in log-log from its Perley-Butler model and
+    held constant beyond the ends of the model.
+    """
+    model = _model_cache.get(source)
+    if model is None:
+        filename, _ = STANDARD_SOURCES[source]
+        model = np.loadtxt(MODEL_DIR / filename, comments="#", usecols=(0, 1))
+        _model_cache[source] = model
+    freq_ghz, flux = model.T
+    return float(np.exp(np.interp(
+            np.log(frequency / 1e9), np.log(freq_ghz), np.log(flux),
+    )))
+
+
+def fluxscale_flux(fluxscale_result, field, spw):
+    """
+    Stokes I flux density of `field` in `spw` from the results of
+    `fluxscale`, or None if it was not determined.
+    """
+    if not fluxscale_result:
+        return None
+    try:
+        fluxd = fluxscale_result[str(field)][str(spw)]["fluxd"][0]
+    except (KeyError, IndexError, TypeError):
+        return None
+    if fluxd == -1 or fluxd <= 0:
+        return None
+    return float(fluxd)
+
+
+def median_amplitudes(calms):
+    """
+    Median unflagged amplitude per (field, spw) of the DATA column of the
+    channel averaged calibrator MS.
+    """
+    tb = table()
+    try:
+        tb.open(f"{calms}/DATA_DESCRIPTION")
+        ddid_spw = tb.getcol("SPECTRAL_WINDOW_ID")
+        tb.close()
+        tb.open(calms)
+        field = tb.getcol("FIELD_ID")
+        spw = ddid_spw[tb.getcol("DATA_DESC_ID")]
+        amp = np.abs(tb.getcol("DATA"))
+        good = ~tb.getcol("FLAG")
+    finally:
+        tb.close()
+    # Average the correlations of each row; the data have one channel.
+    nvalid = good.sum(axis=(0, 1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        row_amp = (amp * good).sum(axis=(0, 1)) / nvalid
+    amplitudes = {}
+    valid = nvalid > 0
+    for key in set(zip(field[valid].tolist(), spw[valid].tolist())):
+        rows = valid & (field == key[0]) & (spw == key[1])
+        amplitudes[key] = float(np.median(row_amp[rows]))
+    return amplitudes
+
+
+class SolintPredictor:
+    """
+    SNR of the gain solutions of calibrator scans per candidate solint.
+
+    Parameters
+    ----------
+    msname : str
+        MS whose flag ledger and spectral windows are used.
+    scan : str
+        CASA scan selection of the calibrator scans to solve on.
+    fields : list of int
+        Calibrator fields in the scans.
+    field_names : list of str
+        Names of all of the fields of the MS.
+    fluxscale_result : dict, None
+        Results of `fluxscale` from an earlier run, if any.
+    calms : str, None
+        Channel averaged calibrator MS used to scale the flux densities of the
+        calibrators without a model to those of the standard calibrators.
+    spw : str
+        Spw and channel selection of the solve, see `parse_spw_channels`.
+    """
+
+    def __init__(
+            self, msname, scan, fields, field_names, fluxscale_result=None,
+            calms=None, spw="",
+        ):
+        self.msname = msname
+        self.scan = scan
+        self.fields = [int(f) for f in fields]
+        self.field_names = list(field_names)
+        self.fluxscale_result = fluxscale_result
+        self.calms = calms
+        tb = table()
+        try:
+            tb.open(f"{msname}/SPECTRAL_WINDOW")
+            bandwidths = tb.getcol("TOTAL_BANDWIDTH")
+            reference = tb.getcol("REF_FREQUENCY")
+            self.chan_widths = [
+                    np.abs(tb.getcell("CHAN_WIDTH", ii)) for ii in range(tb.nrows())
+            ]
+        finally:
+            tb.close()
+        self.bandwidths = bandwidths
+        self.center_frequencies = reference + bandwidths / 2
+        self.channels = parse_spw_channels(
+                spw, [len(widths) for widths in self.chan_widths],
+        )
+
+    def __repr__(self):
+        return f"SolintPredictor({self.msname!r}, scan={self.scan!r})"
+
+    def flag_state(self):
+        """
+        Unflagged bandwidth (Hz) of the selected channels and median number of
+        unflagged baselines per antenna of each spw of the scans, from the
+        flag ledger. Spws without data in the scans or not selected are NaN.
+        """
+        ledger = get_flag_ledger(self.msname)
+        ledger.refresh()
+        scans = _parse_ids(self.scan)
+        selected = (
+                np.ones(len(ledger.scans), dtype=bool) if scans is None
+                else np.isin(ledger.scans, scans)
+        )
+        chan_flagged = ledger.chan_flagged[selected].sum(axis=0)
+        chan_total = ledger.chan_total[selected].sum(axis=0)
+        ant_flagged = ledger.ant_flagged[selected].sum(axis=0)
+        ant_total = ledger.ant_total[selected].sum(axis=0)
+        nspw = chan_total.shape[0]
+        bandwidth = np.full(nspw, np.nan)
+        nbaselines = np.full(nspw, np.nan)
+        for spw in range(nspw):
+            if self.channels is not None and spw not in self.channels:
+                continue
+            observed = chan_total[spw] > 0
+            present = ant_total[spw] > 0
+            if not observed.any() or present.sum() < 2:
+                continue
+            unflagged_chans = observed & (chan_flagged[spw] < chan_total[spw])
+            usable = unflagged_chans[observed].mean()
+            widths = self.chan_widths[spw]
+            solved = unflagged_chans[:len(widths)]
+            if self.channels is not None:
+                solved = solved & self.channels[spw]
+            bandwidth[spw] = widths[solved].sum()
+            if usable == 0:
+                nbaselines[spw] = 0.0
+                continue
+            # Fully flagged channels are already taken out of the bandwidth.
+            unflagged = 1 - ant_flagged[spw, present] / ant_total[spw, present]
+            unflagged = np.minimum(unflagged / usable, 1.0)
+            nbaselines[spw] = np.median(unflagged) * (present.sum() - 1)
+        return bandwidth, nbaselines
+
+    def _bootstrap_fluxes(self, known):
+        """
+        Flux densities of the fields without one in `known`, a dict of
+        (field, spw) to flux density, from their amplitudes relative to the
+        known fields in the calibrator MS.
+        """
+        if self.calms is None:
+            return {}
+        amplitudes = median_amplitudes(self.calms)
+        scaled = {}
+        for (field, spw), amp in amplitudes.items():
+            if field not in self.fields or (field, spw) in known:
+                continue
+            ratios = [
+                    known[(ref, spw)] / amplitudes[(ref, spw)]
+                    for ref in self.fields
+                    if (ref, spw) in known and amplitudes.get((ref, spw), 0) > 0
+            ]
+            if ratios:
+                scaled[(field, spw)] = amp * float(np.median(ratios))
+        return scaled
+
+    def fluxes(self, spws):
+        """
+        Flux density of the weakest calibrator field in each of `spws`, or
+        None where that of a field is unknown.
+        """
+        known = {}
+        for field in self.fields:
+            source = standard_source(self.field_names[field])
+            for spw in spws:
+                flux = fluxscale_flux(self.fluxscale_result, field, spw)
+                if flux is None and source is not None:
+                    flux = model_flux(source, self.center_frequencies[spw])
+                if flux is not None:
+                    known[(field, spw)] = flux
+        if len(known) < len(self.fields) * len(spws):
+            known.update(self._bootstrap_fluxes(known))
+        weakest = {}
+        for spw in spws:
+            values = [known.get((field, spw)) for field in self.fields]
+            weakest[spw] = None if None in values else min(values)
+        return weakest
+
+    def predict(self, soltimes):
+        """
+        Predicted SNR per candidate solint in seconds and spw with data.
+
+        Returns
+        -------
+        (spws, snr)
+            The spws and the SNR with shape (nsoltime, nspw), or None if the
+            flux density of a calibrator is unknown.
+        """
+        bandwidth, nbaselines = self.flag_state()
+        spws = np.flatnonzero(np.isfinite(bandwidth))
+        if len(spws) == 0:
+            return None
+        fluxes = self.fluxes(spws)
+        if any(flux is None for flux in fluxes.values()):
+            return None
+        flux = np.array([fluxes[spw] for spw in spws])
+        sefd = np.array([
+                BAND_SEFD[find_EVLA_band(self.center_frequencies[spw])]
+                for spw in spws
+        ])
+        soltimes = np.asarray(soltimes, dtype=float)[:, None]
+        snr = (
+                flux / sefd * CORRELATOR_EFFICIENCY
+                * np.sqrt(2 * bandwidth[spws] * soltimes * nbaselines[spws])
+        )
+        return spws, snr
+
+    def search_rounds(
+            self, soltimes, minsnr, critfrac, margin=SNR_MARGIN, logfunc=None,
+        ):
+        """
+        Candidate indices to solve, in rounds that are each searched only if
+        the previous ones fail: the predicted solint, then the next longer
+        one. All of the candidates are searched in a single round if no
+        prediction can be made.
+
+        Parameters
+        ----------
+        soltimes : list of float
+            Candidate solints in seconds, shortest first.
+        minsnr : float
+            `minsnr` of the gain solutions.
+        critfrac : float
+            Critical fraction of flagged solutions.
+        margin : float
+        logfunc : callable, None
+            Called with a message for each candidate.
+
+        Returns
+        -------
+        (rounds, prediction)
+            The rounds are lists of candidate indices. The prediction is None or a dict with the "index" of the predicted
+            solint and the "snr" of each candidate and spw.
+        """
+        if logfunc is None:
+            logfunc = lambda msg: None
+        predicted = self.predict(soltimes)
+        if predicted is None:
+            logfunc(
+                    "Solint not predicted, the flux density of a calibrator "
+                    "is unknown; trying all candidates"
+            )
+            return [list(range(len(soltimes)))], None
+        spws, snr = predicted
+        low_frac = (snr < margin * minsnr).mean(axis=1)
+        for soltime, spw_snr, frac in zip(soltimes, snr, low_frac):
+            logfunc(
+                    f"Predicted SNR for solint = {soltime}s: median "
+                    f"{np.median(spw_snr):.1f}, minimum {spw_snr.min():.1f}, "
+                    f"fraction of spws below {margin * minsnr:.1f} = {frac:.2f}"
+            )
+        passing = np.flatnonzero(low_frac <= critfrac)
+        index = int(passing[0]) if len(passing) > 0 else len(soltimes) - 1
+        rounds = [[index]] + ([[index + 1]] if index + 1 < len(soltimes) else [])
+        return rounds, {"index": index, "spws": spws, "snr": snr}
+
+
+def write_prediction_log(
+        filename, stage, soltimes, prediction, chosen, passed,
+        flaggedSolnResult,
+    ):
+    """
+    Append the predicted and chosen solint of a stage, and the median fraction
+    of flagged solutions per antenna of the chosen one, to `filename` for
+    tuning `SNR_MARGIN` and `BAND_SEFD`.
+    """
+    if prediction is None:
+        predicted = "none"
+        median_snr = "nan"
+    else:
+        predicted = f"{soltimes[prediction['index']]}"
+        median_snr = f"{np.median(prediction['snr'][prediction['index']]):.2f}"
+    with open(filename, "a") as f:
+        f.write(
+                f"{stage}\tpredicted={predicted}\tmedian_snr={median_snr}\t"
+                f"chosen={soltimes[chosen]}\tpassed={passed}\t"
+                f"frac_flagged={_frac_flagged(flaggedSolnResult):.4f}\n"
+        )
@@ -1,16 +1,20 @@
 import os
 import copy
 import time
+import shutil
 import math
 import urllib
 import datetime
 from pathlib import Path
+from collections import OrderedDict
+from collections.abc import Mapping
+from threading import Lock
 
 import numpy as np
 # NOTE `np` is aliased in `getBCalStatistics` so use `numpy` directly there.
 import numpy
 
-from casatasks import gaincal
+from casatasks import gaincal, gencal
 from casatools import ms as mstool
 from casatools import (table, measures, quanta, msmetadata)
 tb = table()
@@ -19,10 +23,13 @@ qa = quanta()
 msmd = msmetadata()
 
 from . import PIPE_PATH
+from .calplot import render_caltable_plots
 from .compat import running_within_casa
+from .refant import flagging_score, geometry_score
+from .scheduler import get_scheduler, vis_resource
 
 if not running_within_casa:
-    from casatasks import (flagdata, casalog)
+    from casatasks import casalog
 
 
 log_dir = "logs"
@@ -324,6 +331,47 @@ def correct_ant_posns(vis_name, print_offsets=False):
     return [0, ant_string, parms]
 
 
+def antpos_gains(vis, caltable):
+    """
+    Make the antenna position correction table with `gencal`. Returns False
+    if no corrections were found or the position service could not be
+    reached, in which case no table is written and the error is logged.
+    """
+    try:
+        gencal(
+                vis=vis,
+                caltable=caltable,
+                caltype="antpos",
+                spw="",
+                antenna="",
+                pol="",
+                parameter=[],
+        )
+    except (RuntimeError, OSError) as e:
+        logprint(
+                f"gencal antpos failed: {e}", logfileout='logs/priorcals.log'
+        )
+        return False
+    return os.path.exists(caltable)
+
+
+def switched_power_gains(vis, caltable, nant, plots):
+    """
+    Make the switched power table with `gencal` and render its `plots` as
+    soon as it is written, as `calplot.plot_caltable` would.
+    """
+    gencal(
+            vis=vis,
+            caltable=caltable,
+            caltype="swpow",
+            spw="",
+            antenna="",
+            pol="",
+            parameter=[],
+    )
+    return render_caltable_plots(caltable, nant, plots)
+
+
 # Classes
 # -------
 # RefAntHeuristics - Chooses the reference antenna heuristics.
@@ -463,6 +511,8 @@ class RefAntGeometry:
       distance.  The best antennas have the highest score.
     * Sort according to score.
 
+    The scores are cached per array configuration by `refant.geometry_score`.
+
     Attributes
     ----------
     vis - MS name.
@@ -473,17 +523,6 @@ class RefAntGeometry:
                       RefAntGeometry() class.
     calc_score      - This public member function calculates the geometry score for
                       each antenna.
-    _get_info       - This private member function gets the information from the
-                      antenna table of the MS.
-    _get_measures   - This private member function gets the measures from the
-                      antenna table of the MS.
-    _get_latlongrad - This private member function gets the latitude, longitude
-                      and radius (from the center of the earth) for each antenna.
-    _calc_distance  - This private member function calculates the antenna
-                      distances from the array reference from the radii,
-                      longitudes, and latitudes.
-    _calc_score     - This private member function calculates the geometry score
-                      for each antenna.
     """
 
     def __init__(self, vis):
@@ -502,171 +541,7 @@ class RefAntGeometry:
         -------
         Dictionary containing the score for each antenna.
         """
-        # Get the antenna information, measures, and locations
-        info = self._get_info()
-        measures = self._get_measures(info)
-        radii, longs, lats = self._get_latlongrad(info, measures)
-        # Calculate the antenna distances and scores
-        distance = self._calc_distance(radii, longs, lats)
-        score = self._calc_score(distance)
-        return score
-
-    def _get_info(self):
-        """
-        Get the information from the antenna table of the MS.
-
-        Returns
-        -------
-        Dictionary containing the antenna information, with format:
-
-            'position'          - Array of antenna positions.
-            'flag_row'          - Array of flag row booleans.
-                                  NB: This element is of limited use now and
-                                      may be eliminated.
-            'name'              - Array antenna name strings.
-            'position_keywords' - Antenna information dictionary.
-        """
-        info = dict()
-        try:
-            tb.open( self.vis+'/ANTENNA' )
-            # Get the antenna information from the antenna table
-            info['position'] = tb.getcol('POSITION')
-            info['flag_row'] = tb.getcol('FLAG_ROW')
-            info['name'] = tb.getcol('NAME')
-            info['position_keywords'] = tb.getcolkeywords('POSITION')
-        finally:
-            tb.close()
-        return info
-
-    def _get_measures(self, info):
-        """
-        Get the measures from the antenna table of the MS.
-
-        Parameters
-        ----------
-        info - Dictionary of the antenna information from private
-               member function `_get_info()`.
-
-        Returns
-        -------
-        Dictionary containing the antenna measures with format:
-        '<antenna name>' - antenna measures
-        """
-        # Initialize the measures dictionary and the position and
-        # position_keywords variables
-        measures = dict()
-        position = info['position']
-        position_keywords = info['position_keywords']
-        rf = position_keywords['MEASINFO']['Ref']
-        for row, ant in enumerate(info['name']):
-            if not info['flag_row'][row]:
-                p = position[0, row]
-                pk = position_keywords['QuantumUnits'][0]
-                v0 = qa.quantity(p, pk)
-                #
-                p = position[1, row]
-                pk = position_keywords['QuantumUnits'][1]
-                v1 = qa.quantity(p, pk)
-                #
-                p = position[2, row]
-                pk = position_keywords['QuantumUnits'][2]
-                v2 = qa.quantity(p, pk)
-                measures[ant] = me.position(rf=rf, v0=v0, v1=v1, v2=v2)
-        return measures
-
-    def _get_latlongrad(self, info, measures):
-        """
-        Get the latitude, longitude and radius (from the center of the earth)
-        for each antenna.
-
-        Parameters
-        ----------
-        info     - Dictionary of the antenna information from private member
-                   function _get_info().
-        measures - Dictionary of the antenna measures from private member
-                   function _get_measures().
-
-        Returns
-        -------
-        Tuple containing containing radius, longitude, and latitude dictionaries.
-        """
-        # The `measures` dictionary follows:
-        #   {"ea01": {"m0": {"value": 1, "unit": "m"} ...}}
-        # The values from `qa.getvalue` are returned as a single-element numpy
-        # arrays so must be indexed to return a scalar value.
-        def get_measures_value(ant, ax, as_unit):
-            quantity = qa.convert(measures[ant][ax], as_unit)
-            return qa.getvalue(quantity)[0]
-        ant_names = info["name"]
-        radii = {a: get_measures_value(a, "m2", "m")   for a in ant_names}
-        lons  = {a: get_measures_value(a, "m0", "rad") for a in ant_names}
-        lats  = {a: get_measures_value(a, "m1", "rad") for a in ant_names}
-        return radii, lons, lats
-
-    def _calc_distance(self, radii, lons, lats):
-        """
-        Calculate the antenna distances from the array reference from the
-        radii, longitudes, and latitudes.
-
-        NB: The array reference is the median location.
-
-        Parameters
-        ----------
-        radii - Radius (from the center of the earth) dictionary for each antenna.
-        lons  - Longitude dictionary for each antenna.
-        lats  - Latitude dictionary for each antenna.
-
-        Results
-        -------
-        Dictionary containing the antenna distances from the array reference.
-        """
-        # Convert the dictionaries to numpy float arrays.
-        rad = np.array(list(radii.values()))
-        lon = np.array(list(lons.values()))
-        lat = np.array(list(lats.values()))
-        lon -= np.median(lon)
-        # Calculate the "x" and "y" antenna locations and subtract medians.
-        x = lon * np.cos(lat) * rad
-        y = lat * rad
-        x -= np.median(x)
-        y -= np.median(y)
-        # Calculate the antenna distances from the array reference
-        distance = {
-                ant_name: np.sqrt(x[i]**2 + y[i]**2)
-                for i, ant_name in enumerate(radii.keys())
-        }
-        return distance
-
-    def _calc_score(self, distance):
-        """
-        Calculate the geometry score for each antenna.
-
-        Algorithm
-        ---------
-        * Calculate the antenna distances from the array center.
-        * Normalize the distances by the maximum distance.
-        * Calculate the score for each antenna, which is one minus the normalized
-          distance.  The best antennas have the highest score.
-        * Sort according to score.
-
-        Parameters
-        ----------
-        distance - Dictionary of the antenna distances from the array
-                   reference.  They are calculated in private member
-                   function `_calc_distance()`.
-
-        Results
-        -------
-        Dictionary containing the score for each antenna.
-        """
-        far = np.array(list(distance.values()), float)
-        n = far.shape[0]
-        closeness_score = (1 - far / far.max()) * n
-        score = {
-                name: closeness_score[i]
-                for i, name in enumerate(distance.keys())
-        }
-        return score
+        return geometry_score(self.vis)
 
 
 class RefAntFlagging:
@@ -681,6 +556,9 @@ class RefAntFlagging:
       number of good data.  The best antennas have the highest score.
     * Sort according to score.
 
+    The number of unflagged data are taken from the flag ledger of the MS by
+    `refant.flagging_score`.
+
     Attributes
     ----------
     vis    - This python string contains the MS name.
@@ -695,8 +573,6 @@ class RefAntFlagging:
     -------
     __init__    - Initialize an instance of the class.
     calc_score  - Calculate the flagging score for each antenna.
-    _get_good   - Get the number of unflagged (good) data from the MS.
-    _calc_score - Calculates the flagging score for each antenna.
     """
     def __init__(self, vis, field, spw, intent):
         """
@@ -725,63 +601,7 @@ class RefAntFlagging:
         -------
         Dictionary containing the score for each antenna.
         """
-        good = self._get_good()
-        return self._calc_score(good)
-
-    def _get_good(self):
-        """
-        Gets the number of unflagged (good) data from the MS.
-
-        Returns
-        -------
-        Dictionary containing the number of unflagged (good) data from the MS.
-        """
-        results = flagdata(
-                vis=self.vis,
-                mode="summary",
-                field=self.field,
-                spw=self.spw,
-                intent=self.intent,
-                display="",
-                flagbackup=False,
-                savepars=False,
-        )
-        # Calculate the good data total for each antenna.
-        good = {
-                name: vals["total"] - vals["flagged"]
-                for name, vals in results["antenna"].items()
-        }
-        return good
-
-    def _calc_score(self, good):
-        """
-        Calculate the flagging score for each antenna.
-
-        Algorithm
-        ---------
-        * Get the number of unflagged (good) data for each antenna.
-        * Normalize the good data by the maximum good data.
-        * Calculate the score for each antenna, which is one minus the normalized
-          number of good data.  The best antennas have the highest score.
-        * Sort according to score.
-
-        Parameters
-        ----------
-        good - Dictionary of unflagged (good) data from the MS. They are
-               obtained in private member function _get_good().
-
-        Returns
-        -------
-        Dictionary containing the score for each antenna.
-        """
-        unflag = np.array(list(good.values()), float)
-        n = unflag.shape[0]
-        unflagged_score = unflag / unflag.max() * n
-        score = {
-                name: unflagged_score[i]
-                for i, name in enumerate(good.keys())
-        }
-        return score
+        return flagging_score(self.vis, self.field, self.spw, self.intent)
 
 
 def testBPdgains(
@@ -982,6 +802,169 @@ def semiFinaldelays(
     return getCalFlaggedSoln(calTable)
 
 
+def _solve_trial(solver, calTable, trial_kwargs):
+    # Module-level so that it may be called by name in the worker processes.
+    return solver(calTable=calTable, **trial_kwargs)
+
+
+def _frac_flagged(flaggedSolnResult):
+    if flaggedSolnResult["all"]["total"] > 0:
+        return flaggedSolnResult["antmedian"]["fraction"]
+    else:
+        return 1.0
+
+
+def _trial_reads(trial_kwargs, tables):
+    """
+    Resources read by a trial: the data of `calMs`, its `priorcals`, and the
+    other calibration `tables` applied by the solver.
+    """
+    reads = []
+    if "calMs" in trial_kwargs:
+        reads.append(vis_resource(trial_kwargs["calMs"]))
+    tables = list(trial_kwargs.get("priorcals", [])) + list(tables)
+    reads.extend(f"table:{t}" for t in tables)
+    return tuple(reads)
+
+
+def speculative_search(
+        solver, calTable, trials, critfrac, log_trial=None, tables=(),
+    ):
+    """
+    Solve for `calTable` with each set of trial parameters in turn and stop
+    at the first one for which the median fraction of flagged solutions per
+    antenna is less than `critfrac`.
+
+    When the pipeline scheduler has worker processes, all of the trials are
+    solved concurrently into temporary tables and the first trial in order
+    that passes is chosen, so the result is the same as the serial search.
+    The trials only declare reads of `calMs` and of the tables they apply, so
+    that they do not wait on one another.
+    The chosen (or, if none pass, the last) solution is moved to `calTable`
+    and the other temporary tables are removed.
+
+    Parameters
+    ----------
+    solver : callable
+        Module-level function such as `testdelays` or `testgains` that returns
+        the result of `getCalFlaggedSoln`; called with the keyword argument
+        `calTable` and the keyword arguments of the trial.
+    calTable : str
+        Name of the output calibration table.
+    trials : list of dict
+        Keyword arguments to `solver` for each trial in order of preference.
+    critfrac : float
+        Critical median fraction of flagged solutions.
+    log_trial : callable, None
+        Called as ``log_trial(index, flaggedSolnResult)`` for each trial up to
+        and including the chosen one.
+    tables : iterable of str
+        Calibration tables applied by `solver` in addition to the `priorcals`
+        of the trials, such as "testdelay.k" for `testBPdgains`.
+
+    Returns
+    -------
+    (index, flaggedSolnResult, passed)
+    """
+    if log_trial is None:
+        log_trial = lambda index, result: None
+    scheduler = get_scheduler()
+    if scheduler.serial:
+        for ii, trial_kwargs in enumerate(trials):
+            if os.path.exists(calTable):
+                shutil.rmtree(calTable)
+            result = solver(calTable=calTable, **trial_kwargs)
+            log_trial(ii, result)
+            if _frac_flagged(result) < critfrac:
+                return ii, result, True
+        return ii, result, False
+    # Solve every trial at once, each into its own table.
+    root, ext = os.path.splitext(calTable)
+    trialTables = [f"{root}_trial{ii}{ext}" for ii in range(len(trials))]
+    tasks = []
+    for trialTable, trial_kwargs in zip(trialTables, trials):
+        if os.path.exists(trialTable):
+            shutil.rmtree(trialTable)
+        tasks.append(scheduler.submit(
+                f"{solver.__name__} {trialTable}",
+                _solve_trial,
+                args=(solver, trialTable, trial_kwargs),
+                reads=_trial_reads(trial_kwargs, tables),
+                writes=(f"table:{trialTable}",),
+        ))
+    scheduler.wait(writes=[f"table:{t}" for t in trialTables])
+    for ii, task in enumerate(tasks):
+        result = task.result()
+        log_trial(ii, result)
+        passed = _frac_flagged(result) < critfrac
+        if passed:
+            break
+    if os.path.exists(calTable):
+        shutil.rmtree(calTable)
+    os.rename(trialTables[ii], calTable)
+    for trialTable in trialTables:
+        if os.path.exists(trialTable):
+            shutil.rmtree(trialTable)
+    return ii, result, passed
+
+
+def trial_refants(
+        delayfunc,
+        calTable,
+        refants,
+        critfrac,
+        ntrials=5,
+        logfunc=logprint,
+        tables=(),
+        **solve_kwargs,
+    ):
+    """
+    Solve for delays with each of the first `ntrials` candidate reference
+    antennas in turn and use the first one for which the median fraction of
+    flagged solutions per antenna is less than `critfrac`.  The candidates
+    are solved concurrently when possible, see `speculative_search`.
+
+    Parameters
+    ----------
+    delayfunc : callable
+        Solver such as `testdelays` or `semiFinaldelays`; called with the
+        keyword arguments `calTable`, `refAnt`, and `solve_kwargs`.
+    calTable : str
+        Name of the output calibration table.
+    refants : list
+        Candidate reference antennas in order of rank.
+    critfrac : float
+        Critical median fraction of flagged solutions.
+    ntrials : int
+        Maximum number of candidates to try.
+    logfunc : callable
+        Function used to log the results of each trial.
+    tables : iterable of str
+        Calibration tables applied by `delayfunc` in addition to the
+        `priorcals`, see `speculative_search`.
+
+    Returns
+    -------
+    (refAnt, flaggedSolnResult, passed)
+    """
+    candidates = [str(ant) for ant in refants[:ntrials]]
+
+    def log_trial(index, result):
+        logfunc(f"Testing referance antenna: {candidates[index]}")
+        logfunc("Fraction of flagged solutions = " + str(result["all"]["fraction"]))
+        logfunc(
+                "Median fraction of flagged solutions per antenna = "
+                + str(result["antmedian"]["fraction"])
+        )
+
+    trials = [dict(solve_kwargs, refAnt=refAnt) for refAnt in candidates]
+    index, result, passed = speculative_search(
+            delayfunc, calTable, trials, critfrac, log_trial=log_trial,
+            tables=tables,
+    )
+    return candidates[index], result, passed
+
+
 def find_3C84(positions):
     MAX_SEPARATION = 60*2.0e-5
     position_3C84 = me.direction('j2000', '3h19m48.160', '41d30m42.106')
@@ -1006,6 +989,396 @@ def checkblankplot(plotfile, maincasalog):
     return blankplot
 
 
+def _read_cols_by_shape(mytb, colnames):
+    """
+    Read the variable-shape array columns `colnames` from the open table
+    `mytb`, one array per group of rows sharing a cell shape (all columns are
+    assumed to share the cell shape of the first).  Returns a list of
+    ``(rows, {colname: array})`` where the arrays have the row axis last.
+    """
+    shapeGroups = {}
+    for idx, shape in enumerate(mytb.getcolshapestring(colnames[0])):
+        shapeGroups.setdefault(shape, []).append(idx)
+    groups = []
+    for rows in shapeGroups.values():
+        if len(shapeGroups) == 1:
+            arrays = {col: mytb.getcol(col) for col in colnames}
+        else:
+            subtb = mytb.selectrows(rows)
+            arrays = {col: subtb.getcol(col) for col in colnames}
+            subtb.close()
+        groups.append((numpy.array(rows), arrays))
+    return groups
+
+
+def _first_seen(values):
+    """Unique values of an array in order of first appearance."""
+    _, first = numpy.unique(values, return_index=True)
+    return values[numpy.sort(first)]
+
+
+def _dense_index(ids, values):
+    """Position in the array of unique `ids` of each element of `values`."""
+    order = numpy.argsort(ids)
+    return order[numpy.searchsorted(ids, values, sorter=order)]
+
+
+def _solution_slots(cells, times):
+    """
+    Rank in time of each row among the rows of the same cell, such as an
+    (antenna, spw) pair. Rows with the same time get consecutive slots.
+    """
+    order = numpy.lexsort((times, cells))
+    sortedCells = cells[order]
+    starts = numpy.flatnonzero(numpy.r_[True, sortedCells[1:] != sortedCells[:-1]])
+    counts = numpy.diff(numpy.r_[starts, len(order)])
+    slots = numpy.empty(len(order), dtype=int)
+    slots[order] = numpy.arange(len(order)) - numpy.repeat(starts, counts)
+    return slots
+
+
+def _binned_stats(values, bins, nbins):
+    """
+    Number, minimum, maximum, mean, and (population) variance of `values`
+    within each of `nbins` bins.  Statistics of empty bins are zero.
+    """
+    number = numpy.bincount(bins, minlength=nbins)
+    stats = {val: numpy.zeros(nbins) for val in ('min', 'max', 'mean', 'var')}
+    if len(values) == 0:
+        return number, stats
+    order = numpy.argsort(bins, kind='stable')
+    sbins = bins[order]
+    svals = values[order]
+    starts = numpy.flatnonzero(numpy.r_[True, sbins[1:] != sbins[:-1]])
+    filled = sbins[starts]
+    stats['min'][filled] = numpy.minimum.reduceat(svals, starts)
+    stats['max'][filled] = numpy.maximum.reduceat(svals, starts)
+    stats['mean'][filled] = numpy.add.reduceat(svals, starts) / number[filled]
+    dev = svals - stats['mean'][sbins]
+    stats['var'][filled] = numpy.add.reduceat(dev * dev, starts) / number[filled]
+    return number, stats
+
+
+CALTABLE_CACHE_BYTES = 2 * 1024**3
+
+
+class CalSolutionCube:
+    """
+    Solutions of a calibration table on a dense grid with the labelled axes
+    ``AXES``, stored in single precision with a flag mask of the same shape.
+    The rows of each antenna and spw are placed along the slot axis in order
+    of time, so the axis is as long as the largest number of solutions of an
+    antenna and spw, however the solution times differ between spws or
+    antennas. Cells that are not in the table, such as the channels past the
+    end of a narrower spw or the slots past the last solution of an antenna,
+    are flagged and left out of every reduction.
+
+    Attributes
+    ----------
+    antennas, spws : numpy.ndarray
+        ANTENNA1 and SPECTRAL_WINDOW_ID of each index along the antenna and
+        spw axes, in order of first appearance in the table.
+    times : numpy.ndarray
+        (nant, nspw, nslot) solution time of each slot, NaN if empty.
+    nchan, npol : numpy.ndarray
+        Number of channels and polarizations of each spw.
+    data : numpy.ndarray
+        complex64 (from CPARAM) or float32 (from FPARAM) solutions with shape
+        (nant, nspw, npol, nchan, nslot).
+    flag : numpy.ndarray
+        Flags with the shape of `data`.
+    present : numpy.ndarray
+        (nant, nspw, nslot) mask of the rows in the table.
+    """
+    AXES = ('antenna', 'spw', 'pol', 'chan', 'slot')
+
+    def __init__(self, antennas, spws, times, nchan, npol, data, flag, present):
+        self.antennas = antennas
+        self.spws = spws
+        self.times = times
+        self.nchan = nchan
+        self.npol = npol
+        self.data = data
+        self.flag = flag
+        self.present = present
+
+    def __repr__(self):
+        shape = ', '.join(f'{a}={n}' for a, n in zip(self.AXES, self.shape))
+        return f'CalSolutionCube({shape})'
+
+    @classmethod
+    def from_columns(cls, antCol, spwCol, timeCol, groups, parcol):
+        """
+        Build the cube from the per-row columns and the shape-grouped
+        solution and FLAG arrays of `_read_cols_by_shape`.
+        """
+        antennas = _first_seen(antCol)
+        spws = _first_seen(spwCol)
+        antIndex = _dense_index(antennas, antCol)
+        spwIndex = _dense_index(spws, spwCol)
+        slotIndex = _solution_slots(antIndex * len(spws) + spwIndex, timeCol)
+        nslot = slotIndex.max(initial=-1) + 1
+        times = numpy.full((len(antennas), len(spws), nslot), numpy.nan)
+        times[antIndex, spwIndex, slotIndex] = timeCol
+        nchan = numpy.zeros(len(spws), dtype=int)
+        npol = numpy.zeros(len(spws), dtype=int)
+        for rows, arrays in groups:
+            (npl, nc, _) = arrays[parcol].shape
+            nchan[spwIndex[rows]] = nc
+            npol[spwIndex[rows]] = npl
+        shape = (
+                len(antennas), len(spws), npol.max(initial=0),
+                nchan.max(initial=0), nslot,
+        )
+        dtype = numpy.complex64 if parcol == 'CPARAM' else numpy.float32
+        data = numpy.zeros(shape, dtype=dtype)
+        flag = numpy.ones(shape, dtype=bool)
+        present = numpy.zeros((shape[0], shape[1], shape[4]), dtype=bool)
+        for rows, arrays in groups:
+            (npl, nc, _) = arrays[parcol].shape
+            ia, js, it = antIndex[rows], spwIndex[rows], slotIndex[rows]
+            # Row axis last in the table and first in the indexed cube cells
+            data[ia, js, :npl, :nc, it] = arrays[parcol].transpose(2, 0, 1)
+            flag[ia, js, :npl, :nc, it] = arrays['FLAG'].transpose(2, 0, 1)
+            present[ia, js, it] = True
+        return cls(antennas, spws, times, nchan, npol, data, flag, present)
+
+    @classmethod
+    def from_caltable(cls, calTable):
+        """Cube of `calTable` through the shared `CalTableCache`."""
+        return read_caltable(calTable).cube
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.flag.nbytes + self.present.nbytes
+
+    def axis(self, name):
+        return self.AXES.index(name)
+
+    @property
+    def good(self):
+        """Mask of the unflagged solutions in the table."""
+        return ~self.flag
+
+    def solutions(self):
+        """
+        (nant, nspw, npol, nslot) mask of the solutions in the table, each
+        covering all channels of its spw.
+        """
+        polIdx = numpy.arange(self.shape[2])
+        inPol = polIdx[None, :] < self.npol[:, None]
+        return self.present[:, :, None, :] & inPol[None, :, :, None]
+
+    def amp(self):
+        return numpy.abs(self.data)
+
+    def phase(self, deg=True):
+        return numpy.angle(self.data, deg=deg)
+
+    def max_amp(self):
+        """Largest amplitude (or absolute value) of the unflagged solutions."""
+        return float(numpy.max(self.amp(), where=self.good, initial=0.0))
+
+    def max_abs_phase(self, deg=True):
+        """Largest absolute phase of the unflagged solutions."""
+        phase = numpy.abs(self.phase(deg=deg))
+        return float(numpy.max(phase, where=self.good, initial=0.0))
+
+    def inner_channels(self, innerbuff=0.1):
+        """
+        (nspw, nchan) mask of the channels of each spw that are more than a
+        fraction `innerbuff` of its bandwidth away from either edge.
+        """
+        chanIdx = numpy.arange(self.shape[3])
+        fc = chanIdx[None, :] / numpy.maximum(self.nchan, 1)[:, None]
+        inSpw = chanIdx[None, :] < self.nchan[:, None]
+        return inSpw & (fc >= innerbuff) & (fc < 1.0 - innerbuff)
+
+    def flagged_solutions(self, keep=('antenna', 'spw', 'pol')):
+        """
+        Number of solutions and of flagged solutions summed over the axes
+        not in `keep`. A solution is one antenna, spw, polarization, and slot,
+        and counts as flagged in proportion to its flagged channels.
+
+        Returns
+        -------
+        total : numpy.ndarray
+        flagged : numpy.ndarray
+        """
+        solutions = self.solutions()
+        padding = self.shape[3] - self.nchan
+        nflagged = self.flag.sum(axis=3) - padding[None, :, None, None]
+        fraction = nflagged / numpy.maximum(self.nchan, 1)[None, :, None, None]
+        fraction = numpy.where(solutions, fraction, 0.0)
+        solnAxes = ('antenna', 'spw', 'pol', 'slot')
+        axes = tuple(i for i, name in enumerate(solnAxes) if name not in keep)
+        return solutions.sum(axis=axes), fraction.sum(axis=axes)
+
+    def flagged_fraction(self, keep=()):
+        """Fraction of flagged solutions over the axes not in `keep`."""
+        total, flagged = self.flagged_solutions(keep)
+        return numpy.divide(
+                flagged, total, out=numpy.zeros(numpy.shape(flagged)), where=total > 0,
+        )
+
+    def stats(self, values, keep=('antenna', 'spw', 'pol'), channels=None):
+        """
+        Number, minimum, maximum, mean, and variance of the unflagged
+        `values` (an array with the shape of the cube, such as `amp()`) within
+        each cell of the axes in `keep`, optionally only over the (nspw,
+        nchan) mask of `channels` (such as `inner_channels()`).
+
+        Returns
+        -------
+        number : numpy.ndarray
+        stats : dict
+            Arrays for 'min', 'max', 'mean', and 'var'. Empty cells are zero.
+        """
+        good = self.good
+        if channels is not None:
+            good = good & channels[None, :, None, :, None]
+        index = numpy.nonzero(good)
+        keepAxes = [self.axis(name) for name in keep]
+        shape = tuple(self.shape[a] for a in keepAxes)
+        bins = numpy.ravel_multi_index([index[a] for a in keepAxes], shape)
+        number, stats = _binned_stats(
+                values[good].astype(float), bins, int(numpy.prod(shape)),
+        )
+        return number.reshape(shape), {k: v.reshape(shape) for k, v in stats.items()}
+
+
+class CalTableColumns:
+    """
+    Decoded columns of a calibration table, as returned by `read_caltable`.
+
+    Attributes
+    ----------
+    viscal : str
+        Value of the "VisCal" table keyword, e.g. "B Jones".
+    parcol : str
+        Name of the solution column, "CPARAM" or "FPARAM".
+    ANTENNA1, SPECTRAL_WINDOW_ID, TIME : numpy.ndarray
+        Per-row columns.
+    cube : CalSolutionCube
+        The solution column and FLAG.
+    """
+
+    def __init__(self, calTable):
+        mytb = table()
+        mytb.open(calTable)
+        try:
+            self.viscal = mytb.getkeyword('VisCal')
+            self.parcol = 'CPARAM' if 'CPARAM' in mytb.colnames() else 'FPARAM'
+            self.ANTENNA1 = mytb.getcol('ANTENNA1')
+            self.SPECTRAL_WINDOW_ID = mytb.getcol('SPECTRAL_WINDOW_ID')
+            self.TIME = mytb.getcol('TIME')
+            groups = _read_cols_by_shape(mytb, [self.parcol, 'FLAG'])
+        finally:
+            mytb.close()
+        self.cube = CalSolutionCube.from_columns(
+                self.ANTENNA1, self.SPECTRAL_WINDOW_ID, self.TIME, groups,
+                self.parcol,
+        )
+        # The arrays are shared by every caller of `read_caltable`.
+        for arr in (self.ANTENNA1, self.SPECTRAL_WINDOW_ID, self.TIME,
+                self.cube.data, self.cube.flag, self.cube.present):
+            arr.setflags(write=False)
+
+    @property
+    def nbytes(self):
+        return (
+                self.ANTENNA1.nbytes + self.SPECTRAL_WINDOW_ID.nbytes
+                + self.TIME.nbytes + self.cube.nbytes
+        )
+
+
+class CalTableCache:
+    """
+    Process-wide cache of decoded calibration table columns, keyed by the
+    table path. An entry is read again when the modification time or size of
+    any of the table's files changes, and the least recently used entries are
+    evicted when the cached arrays exceed `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=CALTABLE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = Lock()
+
+    def __repr__(self):
+        return f"CalTableCache(ntables={len(self._entries)}, nbytes={self._nbytes})"
+
+    @staticmethod
+    def signature(calTable):
+        mtime, size = 0, 0
+        with os.scandir(calTable) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    mtime = max(mtime, stat.st_mtime_ns)
+                    size += stat.st_size
+        return (mtime, size)
+
+    def get(self, calTable):
+        path = os.path.abspath(calTable)
+        signature = self.signature(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(path)
+                return entry[1]
+        columns = CalTableColumns(path)
+        with self._lock:
+            self._discard(path)
+            self._entries[path] = (signature, columns)
+            self._nbytes += columns.nbytes
+            # Always keep the table just read, even if it alone exceeds the cap.
+            while self._nbytes > self.max_bytes and len(self._entries) > 1:
+                self._discard(next(iter(self._entries)))
+        return columns
+
+    def _discard(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._nbytes -= entry[1].nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+
+_caltable_cache = CalTableCache()
+
+
+def read_caltable(calTable):
+    """
+    Columns of the calibration table `calTable` through the shared
+    `CalTableCache`, so the QA helpers and plotting steps that look at the
+    same table read it from disk only once.
+
+    Returns
+    -------
+    CalTableColumns
+        The cached arrays are shared and must not be modified in place.
+    """
+    return _caltable_cache.get(calTable)
+
+
+def getCalAmpPhaseMax(calTable):
+    """
+    Largest amplitude and absolute phase (in degrees) of the unflagged
+    solutions in `calTable`, or zero if all solutions are flagged.
+    """
+    cube = CalSolutionCube.from_caltable(calTable)
+    return cube.max_amp(), cube.max_abs_phase()
+
+
 def getCalFlaggedSoln(calTable):
     """
     This method will look at the specified calibration table and return the
@@ -1102,22 +1475,10 @@ def getCalFlaggedSoln(calTable):
     2012-09-12 v1.2 STM median over ant revised
     2012-11-13 v2.0 STM casa 4.0 version with new call mechanism
     2013-01-11 v2.1 STM use getvarcol
+    2026-10-17 v3.0 whole-column reads per FLAG shape with NumPy reductions
+    2026-10-17 v3.1 reductions over the shared CalSolutionCube
     """
-    mytb = table()
-
-    mytb.open(calTable)
-    antCol = mytb.getcol('ANTENNA1')
-    spwCol = mytb.getcol('SPECTRAL_WINDOW_ID')
-    fldCol = mytb.getcol('FIELD_ID')
-    #flagCol = mytb.getcol('FLAG')
-    flagVarCol = mytb.getvarcol('FLAG')
-    mytb.close()
-
-    # Initialize a list to hold the results
-    # Get shape of FLAG
-    #(np,nc,ni) = flagCol.shape
-    rowlist = flagVarCol.keys()
-    nrows = len(rowlist)
+    cube = CalSolutionCube.from_caltable(calTable)
 
     # Create the output dictionary
     outDict = {}
@@ -1127,75 +1488,15 @@ def getCalFlaggedSoln(calTable):
     outDict['spw'] = {}
     outDict['antmedian'] = {}
 
-    # Ok now go through and for each row and possibly channel compile flags
-    ntotal = 0
-    nflagged = 0
-    # Lists for median calc
-    medDict = {}
-    medDict['total'] = []
-    medDict['flagged'] = []
-    medDict['fraction'] = []
-
-    for rrow in rowlist:
-        rown = rrow.strip('r')
-        idx = int(rown)-1
-        antIdx = antCol[idx]
-        spwIdx = spwCol[idx]
-        #
-        flagArr = flagVarCol[rrow]
-        # Get the shape of this data row
-        (np,nc,ni) = flagArr.shape
-        # ni should be 1 for this
-        iid = 0
-        #
-        # Set up dictionaries if needed
-        if antIdx in outDict['antspw']:
-            if spwIdx not in outDict['antspw'][antIdx]:
-                outDict['antspw'][antIdx][spwIdx] = {}
-                for poln in range(np):
-                    outDict['antspw'][antIdx][spwIdx][poln] = {}
-                    outDict['antspw'][antIdx][spwIdx][poln]['total'] = 0
-                    outDict['antspw'][antIdx][spwIdx][poln]['flagged'] = 0
-        else:
-            outDict['ant'][antIdx] = {}
-            outDict['antspw'][antIdx] = {}
-            outDict['antspw'][antIdx][spwIdx] = {}
-            for poln in range(np):
-                outDict['ant'][antIdx][poln] = {}
-                outDict['ant'][antIdx][poln]['total'] = 0
-                outDict['ant'][antIdx][poln]['flagged'] = 0.0
-                outDict['antspw'][antIdx][spwIdx][poln] = {}
-                outDict['antspw'][antIdx][spwIdx][poln]['total'] = 0
-                outDict['antspw'][antIdx][spwIdx][poln]['flagged'] = 0.0
-        if spwIdx not in outDict['spw']:
-            outDict['spw'][spwIdx] = {}
-            for poln in range(np):
-                outDict['spw'][spwIdx][poln] = {}
-                outDict['spw'][spwIdx][poln]['total'] = 0
-                outDict['spw'][spwIdx][poln]['flagged'] = 0.0
-        #
-        # Sum up the in-row (per pol per chan) flags for this row
-        nptotal = 0
-        npflagged = 0
-        for poln in range(np):
-            ntotal += 1
-            nptotal += 1
-            ncflagged = 0
-            for chan in range(nc):
-                if flagArr[poln][chan][iid]:
-                    ncflagged += 1
-            npflagged = float(ncflagged)/float(nc)
-            nflagged += float(ncflagged)/float(nc)
-            #
-            outDict['ant'][antIdx][poln]['total'] += 1
-            outDict['spw'][spwIdx][poln]['total'] += 1
-            outDict['antspw'][antIdx][spwIdx][poln]['total'] += 1
-            #
-            outDict['ant'][antIdx][poln]['flagged'] += npflagged
-            outDict['spw'][spwIdx][poln]['flagged'] += npflagged
-            outDict['antspw'][antIdx][spwIdx][poln]['flagged'] += npflagged
-            #
+    # Keep the keys in order of first appearance in the table
+    antIds = cube.antennas
+    spwIds = cube.spws
+    npol = cube.shape[2]
+    # Counts and flagged fractions in dense (ant, spw, poln) cubes
+    totCube, flgCube = cube.flagged_solutions(keep=('antenna', 'spw', 'pol'))
 
+    ntotal = int(totCube.sum())
+    nflagged = float(flgCube.sum())
     outDict['all']['total'] = ntotal
     outDict['all']['flagged'] = nflagged
     if ntotal>0:
@@ -1203,45 +1504,200 @@ def getCalFlaggedSoln(calTable):
     else:
         outDict['all']['fraction'] = 0.0
 
-    # Go back and get fractions
-    for antIdx in outDict['ant'].keys():
-        nptotal = 0
-        npflagged = 0
-        for poln in outDict['ant'][antIdx].keys():
-            nctotal = outDict['ant'][antIdx][poln]['total']
-            ncflagged = outDict['ant'][antIdx][poln]['flagged']
-            outDict['ant'][antIdx][poln]['fraction'] = float(ncflagged)/float(nctotal)
-            #
-            nptotal += nctotal
-            npflagged += ncflagged
-        medDict['total'].append(nptotal)
-        medDict['flagged'].append(npflagged)
-        medDict['fraction'].append(float(npflagged)/float(nptotal))
-    #
-    for spwIdx in outDict['spw'].keys():
-        for poln in outDict['spw'][spwIdx].keys():
-            nptotal = outDict['spw'][spwIdx][poln]['total']
-            npflagged = outDict['spw'][spwIdx][poln]['flagged']
-            outDict['spw'][spwIdx][poln]['fraction'] = float(npflagged)/float(nptotal)
-    #
-    for antIdx in outDict['antspw'].keys():
-        for spwIdx in outDict['antspw'][antIdx].keys():
-            for poln in outDict['antspw'][antIdx][spwIdx].keys():
-                nptotal = outDict['antspw'][antIdx][spwIdx][poln]['total']
-                npflagged = outDict['antspw'][antIdx][spwIdx][poln]['flagged']
-                outDict['antspw'][antIdx][spwIdx][poln]['fraction'] = float(npflagged)/float(nptotal)
-    # do medians
+    def stats(nctotal, ncflagged):
+        return {
+                'total': int(nctotal),
+                'flagged': float(ncflagged),
+                'fraction': float(ncflagged)/float(nctotal),
+        }
+
+    antTot = totCube.sum(axis=1)
+    antFlg = flgCube.sum(axis=1)
+    spwTot = totCube.sum(axis=0)
+    spwFlg = flgCube.sum(axis=0)
+    for ia, antIdx in enumerate(antIds.tolist()):
+        outDict['ant'][antIdx] = {
+                poln: stats(antTot[ia, poln], antFlg[ia, poln])
+                for poln in range(npol) if antTot[ia, poln] > 0
+        }
+        outDict['antspw'][antIdx] = {}
+        for js, spwIdx in enumerate(spwIds.tolist()):
+            if totCube[ia, js].sum() == 0:
+                continue
+            outDict['antspw'][antIdx][spwIdx] = {
+                    poln: stats(totCube[ia, js, poln], flgCube[ia, js, poln])
+                    for poln in range(npol) if totCube[ia, js, poln] > 0
+            }
+    for js, spwIdx in enumerate(spwIds.tolist()):
+        outDict['spw'][spwIdx] = {
+                poln: stats(spwTot[js, poln], spwFlg[js, poln])
+                for poln in range(npol) if spwTot[js, poln] > 0
+        }
+
+    # do medians over antenna, summed over spw and polarization
+    nptotal = antTot.sum(axis=1)
+    npflagged = antFlg.sum(axis=1)
+    medDict = {}
+    medDict['total'] = nptotal
+    medDict['flagged'] = npflagged
+    medDict['fraction'] = npflagged / nptotal
     outDict['antmedian'] = {}
     for item in medDict.keys():
-        alist = medDict[item]
-        aarr = numpy.array(alist)
-        amed = numpy.median(aarr)
-        outDict['antmedian'][item] = amed
+        outDict['antmedian'][item] = numpy.median(medDict[item])
     outDict['antmedian']['number'] = len(medDict['fraction'])
 
     return outDict
 
 
+class ScanView(Mapping):
+    """
+    Read-only view of a single scan in a `ScanTable`, with the same keys as
+    the per-scan dictionary previously created by `buildscans`.  Values are
+    computed from the table arrays when accessed.
+    """
+    __slots__ = ('_table', '_index')
+
+    _keys = (
+            'scan_start', 'scan_end', 'scan_mid', 'scan_int', 'field', 'rra',
+            'rdec', 'spw', 'intents', 'dd', 'npol', 'times',
+    )
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __repr__(self):
+        return f'ScanView(scan={self._table.scan_numbers[self._index]})'
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, key):
+        st = self._table
+        ii = self._index
+        if key in ('scan_start', 'scan_end', 'scan_int', 'rra', 'rdec'):
+            return float(getattr(st, key)[ii])
+        elif key == 'scan_mid':
+            return 0.5 * (float(st.scan_start[ii]) + float(st.scan_end[ii]))
+        elif key == 'field':
+            return int(st.field[ii])
+        elif key == 'intents':
+            return st.intents[ii]
+        elif key == 'spw':
+            return st.spws[st.spw_offsets[ii]:st.spw_offsets[ii+1]].tolist()
+        elif key == 'dd':
+            return self._dds().tolist()
+        elif key == 'npol':
+            return [st.dd_info[idd]['npol'] for idd in self._dds().tolist()]
+        elif key == 'times':
+            start, stop = st.dd_offsets[ii], st.dd_offsets[ii+1]
+            return {
+                    int(st.dds[kk]): st.times[st.time_offsets[kk]:st.time_offsets[kk+1]]
+                    for kk in range(start, stop)
+            }
+        raise KeyError(key)
+
+    def _dds(self):
+        st = self._table
+        return st.dds[st.dd_offsets[self._index]:st.dd_offsets[self._index+1]]
+
+
+class _ScanMapping(Mapping):
+    __slots__ = ('_table',)
+
+    def __init__(self, table):
+        self._table = table
+
+    def __iter__(self):
+        return iter(self._table.scan_numbers.tolist())
+
+    def __len__(self):
+        return len(self._table.scan_numbers)
+
+    def __getitem__(self, scan):
+        st = self._table
+        ii = numpy.searchsorted(st.scan_numbers, scan)
+        if ii >= len(st.scan_numbers) or st.scan_numbers[ii] != scan:
+            raise KeyError(scan)
+        return ScanView(st, ii)
+
+
+class ScanTable(Mapping):
+    """
+    Scan information for a measurement set held in flat NumPy arrays.
+
+    Indexing with ``'DataDescription'`` returns the data description lookup
+    dictionary and indexing with ``'Scans'`` returns a read-only mapping of
+    scan number to a `ScanView`, so that existing code using the dictionary
+    returned by `buildscans` continues to work.  The visibility times of all
+    scans and data descriptions are stored in a single array, with the times
+    of the k-th (scan, dd) pair in ``times[time_offsets[k]:time_offsets[k+1]]``.
+
+    Attributes
+    ----------
+    dd_info : dict
+        Data description lookup keyed by DD ID.
+    scan_numbers : array
+        Sorted scan numbers.
+    scan_start, scan_end, scan_int, rra, rdec : array
+        Per-scan times (s), integration time (s), and field direction (rad).
+    field : array
+        Per-scan field ID.
+    intents : list
+        Per-scan intent strings of the first sub-scan.
+    spws, spw_offsets : array
+        Flattened per-scan spw IDs and the offsets of each scan into them.
+    dds, dd_offsets : array
+        Flattened per-scan DD IDs and the offsets of each scan into them.
+    times, time_offsets : array
+        Flattened visibility times and the offsets of each (scan, dd) pair.
+    """
+    __slots__ = (
+            'dd_info', 'scan_numbers', 'scan_start', 'scan_end', 'scan_int',
+            'field', 'rra', 'rdec', 'intents', 'spws', 'spw_offsets', 'dds',
+            'dd_offsets', 'times', 'time_offsets',
+    )
+
+    _keys = ('DataDescription', 'Scans')
+
+    def __init__(self, **arrays):
+        for name in self.__slots__:
+            setattr(self, name, arrays[name])
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, state[name])
+
+    def __repr__(self):
+        return f'ScanTable(nscans={len(self.scan_numbers)}, ntimes={len(self.times)})'
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, key):
+        if key == 'DataDescription':
+            return self.dd_info
+        elif key == 'Scans':
+            return _ScanMapping(self)
+        raise KeyError(key)
+
+    @property
+    def nbytes(self):
+        return sum(
+                getattr(self, name).nbytes for name in self.__slots__
+                if isinstance(getattr(self, name), numpy.ndarray)
+        )
+
+
 def buildscans(msfile):
     """
     Compile scan information for a measurement set.
@@ -1253,7 +1709,8 @@ def buildscans(msfile):
 
             msfile   -   name of MS
 
-    Output: scandict (return value)
+    Output: scandict (return value), a `ScanTable` that may be indexed
+            like the nested dictionary shown below
 
     Examples:
 
@@ -1339,6 +1796,7 @@ def buildscans(msfile):
     Updated S.T. Myers 2012-05-14  v1.1 add corrtype
     Updated S.T. Myers 2012-06-27  v1.2 add corrdesc lookup
     Updated S.T. Myers 2012-11-13  v2.0 STM casa 4.0 new calls
+    Updated 2026-10-17  v3.0 return array-backed ScanTable
     """
     # dictionary with lookup for correlation strings
     # from http://casa.nrao.edu/docs/doxygen/html/classcasa_1_1Stokes.html
@@ -1471,157 +1929,94 @@ def buildscans(msfile):
     nstates = intentlist.__len__()
     print('Found '+str(nstates)+' StateIds')
     #
-    # Now get FIELD table directions
+    # Now get FIELD table directions, indexed as [ra/dec, 0, field]
     tb.open(msfile+"/FIELD")
-    fnamearr=tb.getcol("NAME")
     fpdirarr=tb.getcol("PHASE_DIR")
     tb.close()
-    flist = fnamearr.tolist()
-    nfields = len(flist)
-    (nd1, nd2, npf) = fpdirarr.shape
-    fielddict = {}
-    for ifld in range(nfields):
-        fielddict[ifld] = {}
-        fielddict[ifld]['name'] = flist[ifld]
-        # these are numpy.float64
-        fielddict[ifld]['rra'] = fpdirarr[0,0,ifld]
-        fielddict[ifld]['rdec'] = fpdirarr[1,0,ifld]
     #
     # Now compile list of visibility times and info
     #
-    # Extract times from the Main Table
-    # Build lookup for DDs by scan_number
-    timdict = {}
-    ddlookup = {}
-    ddscantimes = {}
+    # Extract times from the Main Table per DD
+    ddcol = []
+    scancol = []
+    timecol = []
     ntottimes=0
     for idd in range(ndd):
         # Select this DD (after reset if needed)
         if idd>0: ms.selectinit(reset=True)
         ms.selectinit(idd)
-        #recf = ms.getdata(["flag"])
-        #(nx,nc,ni) = recf['flag'].shape
         # get the times
-        rect = ms.getdata(["time","field_id","scan_number"],ifraxis=True)
+        rect = ms.getdata(["time","scan_number"],ifraxis=True)
         nt = rect['time'].shape[0]
         ntottimes+=nt
         print('Found '+str(nt)+' times in DD='+str(idd))
-        #
-        timdict[idd] = {}
-        timdict[idd]['time'] = rect['time']
-        timdict[idd]['field_id'] = rect['field_id']
-        timdict[idd]['scan_number'] = rect['scan_number']
-        #
-        for it in range(nt):
-            isc = rect['scan_number'][it]
-            tim = rect['time'][it]
-            if isc in ddlookup:
-                if ddlookup[isc].count(idd)<1:
-                    ddlookup[isc].append(idd)
-                if idd in ddscantimes[isc]:
-                    ddscantimes[isc][idd].append(tim)
-                else:
-                    ddscantimes[isc][idd] = [tim]
-            else:
-                ddlookup[isc] = [idd]
-                ddscantimes[isc] = {}
-                ddscantimes[isc][idd] = [tim]
-
-    #
+        ddcol.append(numpy.full(nt, idd))
+        scancol.append(rect['scan_number'])
+        timecol.append(rect['time'])
     print('Found total '+str(ntottimes)+' times')
 
     ms.close()
 
-    # compile a list of scan times
-    #
-    #scd = mysc['summary']
-    scanlist = []
-    scanindex = {}
-    scl = scd.keys()
-    for sscan in scl:
-        isc = int(sscan)
-        scanlist.append(isc)
-        scanindex[isc]=sscan
-
-    scanlist.sort()
+    ddcol = numpy.concatenate(ddcol) if ndd > 0 else numpy.array([], dtype=int)
+    scancol = numpy.concatenate(scancol) if ndd > 0 else numpy.array([], dtype=int)
+    timecol = numpy.concatenate(timecol) if ndd > 0 else numpy.array([])
+    # Group the times by scan and then DD, keeping the time order within each
+    order = numpy.lexsort((numpy.arange(len(timecol)), ddcol, scancol))
+    ddcol = ddcol[order]
+    scancol = scancol[order]
+    times = timecol[order]
+    # Boundaries of each (scan, dd) pair, and of each scan within the pairs
+    newpair = numpy.ones(len(times), dtype=bool)
+    newpair[1:] = (scancol[1:] != scancol[:-1]) | (ddcol[1:] != ddcol[:-1])
+    pairstart = numpy.flatnonzero(newpair)
+    time_offsets = numpy.append(pairstart, len(times))
+    pairscan = scancol[pairstart]
+    dds = ddcol[pairstart]
 
+    # compile a list of scan times
+    scanlist = sorted(int(sscan) for sscan in scd.keys())
     nscans = len(scanlist)
     print('Found '+str(nscans)+' scans min='+str(min(scanlist))+' max='+str(max(scanlist)))
-
-    scantimes = []
-    scandict = {}
-
-    # Put DataDescription lookup into dictionary
-    scandict['DataDescription'] = ddindex
-
-    # Put Scan information in dictionary
-    scandict['Scans'] = {}
-    for isc in scanlist:
-        sscan = scanindex[isc]
+    scan_numbers = numpy.array(scanlist)
+    dd_offsets = numpy.searchsorted(pairscan, numpy.append(scan_numbers, numpy.iinfo(numpy.int64).max))
+
+    scan_start = numpy.empty(nscans)
+    scan_end = numpy.empty(nscans)
+    scan_int = numpy.empty(nscans)
+    field = numpy.empty(nscans, dtype=int)
+    intents = []
+    spws = []
+    for ii, isc in enumerate(scanlist):
+        scan = scd[str(isc)]
         # sub-scans, differentiated by StateId
-        subs = scd[sscan].keys()
-        #
-        scan_start = -1.
-        scan_end = -1.
-        for ss in subs:
-            bt = scd[sscan][ss]['BeginTime']
-            et = scd[sscan][ss]['EndTime']
-            if scan_start>0.:
-                if bt<scan_start:
-                    scan_start=bt
-            else:
-                scan_start=bt
-            if scan_end>0.:
-                if et>scan_end:
-                    scan_end=et
-            else:
-                scan_end=et
-        scan_mid = 0.5*(scan_start + scan_end)
-
-        scan_int = scd[sscan]['0']['IntegrationTime']
-
-        scantimes.append(scan_mid)
-
-        scandict['Scans'][isc] = {}
-        scandict['Scans'][isc]['scan_start'] = scan_start
-        scandict['Scans'][isc]['scan_end'] = scan_end
-        scandict['Scans'][isc]['scan_mid'] = scan_mid
-        scandict['Scans'][isc]['scan_int'] = scan_int
-
-        ifld = scd[sscan]['0']['FieldId']
-        scandict['Scans'][isc]['field'] = ifld
-        scandict['Scans'][isc]['rra'] = fielddict[ifld]['rra']
-        scandict['Scans'][isc]['rdec'] = fielddict[ifld]['rdec']
-
-        spws = scd[sscan]['0']['SpwIds']
-        scandict['Scans'][isc]['spw'] = spws.tolist()
-
-        # state id of first sub-scan
-        stateid = scd[sscan]['0']['StateId']
-        # get intents from STATE table
-        intents = intentlist[stateid]
-        # this is a string with comma-separated intents
-        scandict['Scans'][isc]['intents'] = intents
-
-        # DDs for this scan
-        ddlist = ddlookup[isc]
-        scandict['Scans'][isc]['dd'] = ddlist
-
-        # number of polarizations for this list of dds
-        ddnpollist = []
-        for idd in ddlist:
-            npol = ddindex[idd]['npol']
-            ddnpollist.append(npol)
-        scandict['Scans'][isc]['npol'] = ddnpollist
-
-        # visibility times per dd in this scan
-        #
-        scandict['Scans'][isc]['times'] = {}
-        for idd in ddlist:
-            scandict['Scans'][isc]['times'][idd] = ddscantimes[isc][idd]
-
-    mysize = scandict.__sizeof__()
-    print('Size of scandict in memory is '+str(mysize)+' bytes')
+        scan_start[ii] = min(scan[ss]['BeginTime'] for ss in scan)
+        scan_end[ii] = max(scan[ss]['EndTime'] for ss in scan)
+        scan_int[ii] = scan['0']['IntegrationTime']
+        field[ii] = scan['0']['FieldId']
+        spws.append(numpy.asarray(scan['0']['SpwIds']))
+        # intents of the state id of first sub-scan, this is a string with
+        # comma-separated intents
+        intents.append(intentlist[scan['0']['StateId']])
+    spw_offsets = numpy.cumsum([0] + [len(spw) for spw in spws])
+
+    scandict = ScanTable(
+            dd_info=ddindex,
+            scan_numbers=scan_numbers,
+            scan_start=scan_start,
+            scan_end=scan_end,
+            scan_int=scan_int,
+            field=field,
+            rra=fpdirarr[0,0,field],
+            rdec=fpdirarr[1,0,field],
+            intents=intents,
+            spws=numpy.concatenate(spws) if nscans > 0 else numpy.array([], dtype=int),
+            spw_offsets=spw_offsets,
+            dds=dds,
+            dd_offsets=dd_offsets,
+            times=times,
+            time_offsets=time_offsets,
+    )
+    print('Size of scandict arrays in memory is '+str(scandict.nbytes)+' bytes')
     return scandict
 
 
@@ -1856,6 +2251,8 @@ def getBCalStatistics(calTable, innerbuff=0.1):
     ---------
     Version 2012-11-20 v1.0 STM casa 4.0 version
     Version 2012-12-17 v1.0 STM casa 4.1 version, phase, real, imag stats
+    Version 2026-10-17 v2.0 masked-array statistics over all bins at once
+    Version 2026-10-17 v2.1 samples from the shared CalSolutionCube
     """
     # define range for "inner" channels
     if innerbuff >= 0.0 and innerbuff < 0.5:
@@ -1871,26 +2268,17 @@ def getBCalStatistics(calTable, innerbuff=0.1):
 
     mytb = table()
 
-    mytb.open(calTable)
+    cols = read_caltable(calTable)
 
     # Check that this is a B Jones table
-    caltype = mytb.getkeyword('VisCal')
+    caltype = cols.viscal
     if caltype=='B Jones':
         print('This is a B Jones table, proceeding')
     else:
         print('This is NOT a B Jones table, aborting')
         return outDict
 
-    antCol = mytb.getcol('ANTENNA1')
-    spwCol = mytb.getcol('SPECTRAL_WINDOW_ID')
-    fldCol = mytb.getcol('FIELD_ID')
-
-    # these columns are possibly variable in size
-    #flagCol = mytb.getcol('FLAG')
-    flagVarCol = mytb.getvarcol('FLAG')
-    #dataCol = mytb.getcol('CPARAM')
-    dataVarCol = mytb.getvarcol('CPARAM')
-    mytb.close()
+    cube = cols.cube
 
     # get names from ANTENNA table
     mytb.open(calTable+'/ANTENNA')
@@ -1936,255 +2324,103 @@ def getBCalStatistics(calTable, innerbuff=0.1):
         bblist = rxBasebandDict[rx].keys()
         print('Rx band '+str(rx)+' has basebands: '+str(bblist))
 
-    # Initialize a list to hold the results
-    # Get shape of FLAG
-    #(np,nc,ni) = flagCol.shape
-    # Get shape of CPARAM
-    #(np,nc,ni) = dataCol.shape
-    rowlist = dataVarCol.keys()
-    nrows = len(rowlist)
-
     # Populate output dictionary structure
     outDict['antspw'] = {}
     outDict['antband'] = {}
 
-    # Our fields will be: running 'n','mean','min','max' for 'amp'
-    # Note - running mean(n+1) = ( n*mean(n) + x(n+1) )/(n+1) = mean(n) + (x(n+1)-mean(n))/(n+1)
-
-    # Ok now go through for each row and possibly channel
-    ntotal = 0
-    ninner = 0
-    nflagged = 0
-    ngood = 0
-    ninnergood = 0
-    for rrow in rowlist:
-        rown = rrow.strip('r')
-        idx = int(rown)-1
-        antIdx = antCol[idx]
-        spwIdx = spwCol[idx]
-        #
-        dataArr = dataVarCol[rrow]
-        flagArr = flagVarCol[rrow]
-        # Get the shape of this data row
-        (np,nc,ni) = dataArr.shape
-        # ni should be 1 for this
-        iid = 0
-
-        # receiver and baseband and subband
-        rx = spwDict[spwIdx]['RX']
-        bb = spwDict[spwIdx]['Baseband']
-        sb = spwDict[spwIdx]['Subband']
-
-        # Set up dictionaries if needed
-        parts = ['all','inner']
-        quants = ['amp','phase','real','imag']
-        vals = ['min','max','mean','var']
-        if antIdx in outDict['antspw']:
-            if spwIdx not in outDict['antspw'][antIdx]:
-                outDict['antspw'][antIdx][spwIdx] = {}
-                for poln in range(np):
-                    outDict['antspw'][antIdx][spwIdx][poln] = {}
-                    for part in parts:
-                        outDict['antspw'][antIdx][spwIdx][poln][part] = {}
-                        outDict['antspw'][antIdx][spwIdx][poln][part]['total'] = 0
-                        outDict['antspw'][antIdx][spwIdx][poln][part]['number'] = 0
-                        for quan in quants:
-                            outDict['antspw'][antIdx][spwIdx][poln][part][quan] = {}
-                            for val in vals:
-                                outDict['antspw'][antIdx][spwIdx][poln][part][quan][val] = 0.0
-            if rx in outDict['antband'][antIdx]:
-                if bb not in outDict['antband'][antIdx][rx]:
-                    outDict['antband'][antIdx][rx][bb] = {}
-                    for part in parts:
-                        outDict['antband'][antIdx][rx][bb][part] = {}
-                        outDict['antband'][antIdx][rx][bb][part]['total'] = 0
-                        outDict['antband'][antIdx][rx][bb][part]['number'] = 0
-                        for quan in quants:
-                            outDict['antband'][antIdx][rx][bb][part][quan] = {}
-                            for val in vals:
-                                outDict['antband'][antIdx][rx][bb][part][quan][val] = 0.0
-            else:
-                outDict['antband'][antIdx][rx] = {}
-                outDict['antband'][antIdx][rx][bb] = {}
-                for part in parts:
-                    outDict['antband'][antIdx][rx][bb][part] = {}
-                    outDict['antband'][antIdx][rx][bb][part]['total'] = 0
-                    outDict['antband'][antIdx][rx][bb][part]['number'] = 0
-                    for quan in quants:
-                        outDict['antband'][antIdx][rx][bb][part][quan] = {}
-                        for val in vals:
-                            outDict['antband'][antIdx][rx][bb][part][quan][val] = 0.0
-
-        else:
-            outDict['antspw'][antIdx] = {}
-            outDict['antspw'][antIdx][spwIdx] = {}
-            for poln in range(np):
-                outDict['antspw'][antIdx][spwIdx][poln] = {}
-                for part in parts:
-                    outDict['antspw'][antIdx][spwIdx][poln][part] = {}
-                    outDict['antspw'][antIdx][spwIdx][poln][part]['total'] = 0
-                    outDict['antspw'][antIdx][spwIdx][poln][part]['number'] = 0
-                    for quan in quants:
-                        outDict['antspw'][antIdx][spwIdx][poln][part][quan] = {}
-                        for val in vals:
-                            outDict['antspw'][antIdx][spwIdx][poln][part][quan][val] = 0.0
-
-            outDict['antband'][antIdx] = {}
-            outDict['antband'][antIdx][rx] = {}
-            outDict['antband'][antIdx][rx][bb] = {}
-            for part in parts:
-                outDict['antband'][antIdx][rx][bb][part] = {}
-                outDict['antband'][antIdx][rx][bb][part]['total'] = 0
-                outDict['antband'][antIdx][rx][bb][part]['number'] = 0
-                for quan in quants:
-                    outDict['antband'][antIdx][rx][bb][part][quan] = {}
-                    for val in vals:
-                        outDict['antband'][antIdx][rx][bb][part][quan][val] = 0.0
+    parts = ['all','inner']
+    quants = ['amp','phase','real','imag']
+    vals = ['min','max','mean','var']
+
+    # Dense bin indices for the antenna, spw and rx/baseband of the cube
+    antIds = cube.antennas
+    spwIds = cube.spws
+    bandList = [(rx,bb) for rx in rxBasebandDict for bb in rxBasebandDict[rx]]
+    spwBand = numpy.array([
+            bandList.index((spwDict[ispw]['RX'], spwDict[ispw]['Baseband']))
+            for ispw in range(nspw)
+    ])
+    bandIndex = spwBand[spwIds]
+    nantIds, nspwIds, nband = len(antIds), len(spwIds), len(bandList)
+    npol = cube.shape[2]
+    innerChan = cube.inner_channels(fcrange[0])
+
+    # Per (ant, spw, poln, time) solution bins and channel counts
+    (ia, js, ip, it) = numpy.nonzero(cube.solutions())
+    rowBins = {
+            'antspw': (ia * nspwIds + js) * npol + ip,
+            'antband': ia * nband + bandIndex[js],
+    }
+    rowTotal = {'all': cube.nchan[js], 'inner': innerChan.sum(axis=1)[js]}
+    # The unflagged samples with their bins
+    good = cube.good
+    (ia, js, ip, ic, it) = numpy.nonzero(good)
+    sampBins = {
+            'antspw': (ia * nspwIds + js) * npol + ip,
+            'antband': ia * nband + bandIndex[js],
+    }
+    sampInner = innerChan[js, ic]
+    sampData = cube.data[good].astype(complex)
+    sampQuant = {
+            'amp': numpy.absolute(sampData),
+            'phase': numpy.angle(sampData, deg=True),
+            'real': numpy.real(sampData),
+            'imag': numpy.imag(sampData),
+    }
 
-        #
-        # Sum up the in-row (per pol per chan) flags for this row
-        nptotal = 0
-        npflagged = 0
-        for poln in range(np):
-            ntotal += 1
-            nptotal += 1
-            ncflagged = 0
-            ncgood = 0
-            ncinnergood = 0
-            for chan in range(nc):
-                outDict['antspw'][antIdx][spwIdx][poln]['all']['total'] += 1
-                outDict['antband'][antIdx][rx][bb]['all']['total'] += 1
-                #
-                fc = 1
-                if nc>0:
-                    fc = float(chan)/float(nc)
-                if fc>=fcrange[0] and fc<fcrange[1]:
-                    outDict['antspw'][antIdx][spwIdx][poln]['inner']['total'] += 1
-                    outDict['antband'][antIdx][rx][bb]['inner']['total'] += 1
-                #
-                if flagArr[poln][chan][iid]:
-                    # a flagged data point
-                    ncflagged += 1
-                else:
-                    cx = dataArr[poln][chan][iid]
-                    # get quantities from complex data
-                    ampx = numpy.absolute(cx)
-                    phasx = numpy.angle(cx,deg=True)
-                    realx = numpy.real(cx)
-                    imagx = numpy.imag(cx)
-                    #
-                    # put in dictionary
-                    cdict = {}
-                    cdict['amp'] = ampx
-                    cdict['phase'] = phasx
-                    cdict['real'] = realx
-                    cdict['imag'] = imagx
-                    # an unflagged data point
-                    ncgood += 1
-                    # Data stats
-                    # By antspw per poln
-                    nx = outDict['antspw'][antIdx][spwIdx][poln]['all']['number']
-                    if nx==0:
-                        outDict['antspw'][antIdx][spwIdx][poln]['all']['number'] = 1
-                        for quan in quants:
-                            for val in vals:
-                                outDict['antspw'][antIdx][spwIdx][poln]['all'][quan][val] = cdict[quan]
-                    else:
-                        for quan in quants:
-                            vx = cdict[quan]
-                            if vx>outDict['antspw'][antIdx][spwIdx][poln]['all'][quan]['max']:
-                                outDict['antspw'][antIdx][spwIdx][poln]['all'][quan]['max'] = vx
-                            if vx<outDict['antspw'][antIdx][spwIdx][poln]['all'][quan]['min']:
-                                outDict['antspw'][antIdx][spwIdx][poln]['all'][quan]['min'] = vx
-                            # Running mean(n+1) = mean(n) + (x(n+1)-mean(n))/(n+1)
-                            meanx = outDict['antspw'][antIdx][spwIdx][poln]['all'][quan]['mean']
-                            runx = meanx + (vx - meanx)/float(nx+1)
-                            outDict['antspw'][antIdx][spwIdx][poln]['all'][quan]['mean'] = runx
-                            # Running var(n+1) = {n*var(n)+[x(n+1)-mean(n)][x(n+1)-mean(n+1)]}/(n+1)
-                            varx = outDict['antspw'][antIdx][spwIdx][poln]['all'][quan]['var']
-                            qx = nx*varx + (vx-meanx)*(vx-runx)
-                            outDict['antspw'][antIdx][spwIdx][poln]['all'][quan]['var'] = qx/float(nx+1)
-                    outDict['antspw'][antIdx][spwIdx][poln]['all']['number'] += 1
-                    # Now the rx-band stats
-                    ny = outDict['antband'][antIdx][rx][bb]['all']['number']
-                    if ny==0:
-                        outDict['antband'][antIdx][rx][bb]['all']['number'] = 1
-                        for quan in quants:
-                            for val in vals:
-                                outDict['antband'][antIdx][rx][bb]['all'][quan][val] = cdict[quan]
-                    else:
-                        for quan in quants:
-                            vy = cdict[quan]
-                            if vy>outDict['antband'][antIdx][rx][bb]['all'][quan]['max']:
-                                outDict['antband'][antIdx][rx][bb]['all'][quan]['max'] = vy
-                            if vy<outDict['antband'][antIdx][rx][bb]['all'][quan]['min']:
-                                outDict['antband'][antIdx][rx][bb]['all'][quan]['min'] = vy
-                            # Running mean(n+1) = mean(n) + (x(n+1)-mean(n))/(n+1)
-                            meany = outDict['antband'][antIdx][rx][bb]['all'][quan]['mean']
-                            runy = meany + (vy - meany)/float(ny+1)
-                            outDict['antband'][antIdx][rx][bb]['all'][quan]['mean'] = runy
-                            # Running var(n+1) = {n*var(n)+[x(n+1)-mean(n)][x(n+1)-mean(n+1)]}/(n+1)
-                            vary = outDict['antband'][antIdx][rx][bb]['all'][quan]['var']
-                            qy = ny*vary + (vy-meany)*(vy-runy)
-                            outDict['antband'][antIdx][rx][bb]['all'][quan]['var'] = qy/float(ny+1)
-                        outDict['antband'][antIdx][rx][bb]['all']['number'] += 1
-                    #
-                    if fc>=fcrange[0] and fc<fcrange[1]:
-                        # this chan lies in the "inner" part of the spw
-                        ncinnergood += 1
-                        # Data stats
-                        # By antspw per poln
-                        nx = outDict['antspw'][antIdx][spwIdx][poln]['inner']['number']
-                        if nx==0:
-                            outDict['antspw'][antIdx][spwIdx][poln]['inner']['number'] = 1
-                            for quan in quants:
-                                for val in vals:
-                                    outDict['antspw'][antIdx][spwIdx][poln]['inner'][quan][val] = cdict[quan]
-                        else:
-                            for quan in quants:
-                                vx = cdict[quan]
-                                if vx>outDict['antspw'][antIdx][spwIdx][poln]['inner'][quan]['max']:
-                                    outDict['antspw'][antIdx][spwIdx][poln]['inner'][quan]['max'] = vx
-                                if vx<outDict['antspw'][antIdx][spwIdx][poln]['inner'][quan]['min']:
-                                    outDict['antspw'][antIdx][spwIdx][poln]['inner'][quan]['min'] = vx
-                                # Running mean(n+1) = mean(n) + (x(n+1)-mean(n))/(n+1)
-                                meanx = outDict['antspw'][antIdx][spwIdx][poln]['inner'][quan]['mean']
-                                runx = meanx + (vx - meanx)/float(nx+1)
-                                outDict['antspw'][antIdx][spwIdx][poln]['inner'][quan]['mean'] = runx
-                                # Running var(n+1) = {n*var(n)+[x(n+1)-mean(n)][x(n+1)-mean(n+1)]}/(n+1)
-                                varx = outDict['antspw'][antIdx][spwIdx][poln]['inner'][quan]['var']
-                                qx = nx*varx + (vx-meanx)*(vx-runx)
-                                outDict['antspw'][antIdx][spwIdx][poln]['inner'][quan]['var'] = qx/float(nx+1)
-                                outDict['antspw'][antIdx][spwIdx][poln]['inner']['number'] += 1
-                        # Now the rx-band stats
-                        ny = outDict['antband'][antIdx][rx][bb]['inner']['number']
-                        if ny==0:
-                            outDict['antband'][antIdx][rx][bb]['inner']['number'] = 1
-                            for quan in quants:
-                                for val in vals:
-                                    outDict['antband'][antIdx][rx][bb]['inner'][quan][val] = cdict[quan]
-                        else:
-                            for quan in quants:
-                                vy = cdict[quan]
-                                if vy>outDict['antband'][antIdx][rx][bb]['inner'][quan]['max']:
-                                    outDict['antband'][antIdx][rx][bb]['inner'][quan]['max'] = vy
-                                if vy<outDict['antband'][antIdx][rx][bb]['inner'][quan]['min']:
-                                    outDict['antband'][antIdx][rx][bb]['inner'][quan]['min'] = vy
-                                # Running mean(n+1) = mean(n) + (x(n+1)-mean(n))/(n+1)
-                                meany = outDict['antband'][antIdx][rx][bb]['inner'][quan]['mean']
-                                runy = meany + (vy - meany)/float(ny+1)
-                                outDict['antband'][antIdx][rx][bb]['inner'][quan]['mean'] = runy
-                                # Running var(n+1) = {n*var(n)+[x(n+1)-mean(n)][x(n+1)-mean(n+1)]}/(n+1)
-                                vary = outDict['antband'][antIdx][rx][bb]['inner'][quan]['var']
-                                qy = ny*vary + (vy-meany)*(vy-runy)
-                                outDict['antband'][antIdx][rx][bb]['inner'][quan]['var'] = qy/float(ny+1)
-                            outDict['antband'][antIdx][rx][bb]['inner']['number'] += 1
-
-
-            npflagged = float(ncflagged)/float(nc)
-            nflagged += float(ncflagged)/float(nc)
-            ngood += ncgood
-            ninnergood += ncinnergood
+    # Statistics for every bin of each level, part and quantity at once
+    nbins = {'antspw': nantIds * nspwIds * npol, 'antband': nantIds * nband}
+    levelStats = {}
+    for level in rowBins:
+        nrowBin = numpy.bincount(rowBins[level], minlength=nbins[level])
+        levelStats[level] = {'present': nrowBin > 0}
+        for part in parts:
+            select = slice(None) if part == 'all' else sampInner
+            total = numpy.bincount(
+                    rowBins[level], weights=rowTotal[part], minlength=nbins[level],
+            )
+            partStats = {'total': total}
+            for quan in quants:
+                number, partStats[quan] = _binned_stats(
+                        sampQuant[quan][select], sampBins[level][select], nbins[level],
+                )
+            partStats['number'] = number
+            levelStats[level][part] = partStats
+
+    def stats_entry(level, ibin):
+        entry = {}
+        for part in parts:
+            partStats = levelStats[level][part]
+            entry[part] = {
+                    'total': int(partStats['total'][ibin]),
+                    'number': int(partStats['number'][ibin]),
+            }
+            for quan in quants:
+                entry[part][quan] = {
+                        val: float(partStats[quan][val][ibin]) for val in vals
+                }
+        return entry
+
+    for ia, antIdx in enumerate(antIds.tolist()):
+        outDict['antspw'][antIdx] = {}
+        for js, spwIdx in enumerate(spwIds.tolist()):
+            polDict = {}
+            for poln in range(npol):
+                ibin = (ia * nspwIds + js) * npol + poln
+                if levelStats['antspw']['present'][ibin]:
+                    polDict[poln] = stats_entry('antspw', ibin)
+            if len(polDict) > 0:
+                outDict['antspw'][antIdx][spwIdx] = polDict
+        outDict['antband'][antIdx] = {}
+        for kb, (rx, bb) in enumerate(bandList):
+            ibin = ia * nband + kb
+            if levelStats['antband']['present'][ibin]:
+                outDict['antband'][antIdx].setdefault(rx, {})[bb] = stats_entry('antband', ibin)
+
+    ntotal = len(rowTotal['all'])
+    ninner = ntotal
+    ngood = len(sampData)
+    ninnergood = int(sampInner.sum())
 
     # Assemble rest of dictionary
     outDict['antDict'] = antDict
@@ -2,7 +2,9 @@
 
 import os
 import re
+import shutil
 import sys
+import time
 import warnings
 from glob import glob
 
@@ -17,6 +19,8 @@ with warnings.catch_warnings() as w:
     tb = table()
 
 from evla_pipe import utils
+from evla_pipe.rflag import run_rflag
+from evla_pipe.scheduler import TaskScheduler, set_scheduler
 
 
 SDM_NAME = "test.sdm"
@@ -288,3 +292,81 @@ def test_getbcalstats():
     assert results["rxBasebandDict"]["EVLA_L"]["A0C0"] == [0, 1, 2, 3]
 
 
+TRIAL_SECONDS = 2.0
+
+
+def sleep_solver(calTable, calMs, priorcals, refAnt):
+    # Module-level so that the worker processes can look it up by name.
+    start = time.time()
+    time.sleep(TRIAL_SECONDS)
+    os.makedirs(calTable)
+    return {
+            "all": {"total": 1, "fraction": 1.0},
+            "antmedian": {"fraction": 1.0},
+            "interval": (start, time.time()),
+    }
+
+
+def test_speculative_search_concurrent(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ntrials = 4
+    trials = [
+            dict(calMs=MS_NAME, priorcals=["gain_curves.g"], refAnt=str(ii))
+            for ii in range(ntrials)
+    ]
+    intervals = []
+    scheduler = TaskScheduler(nprocs=ntrials)
+    set_scheduler(scheduler)
+    try:
+        with scheduler:
+            # Start all of the workers first so that their start up does not
+            # stagger the trials.
+            for _ in range(ntrials):
+                scheduler.submit("warm up", time.sleep, args=(0.5,))
+            scheduler.wait()
+            index, _, passed = utils.speculative_search(
+                    sleep_solver, "trial.g", trials, 0.5,
+                    log_trial=lambda ii, result: intervals.append(result["interval"]),
+            )
+    finally:
+        set_scheduler(None)
+    assert index == ntrials - 1 and not passed
+    assert os.path.exists("trial.g")
+    # Every trial started before any of them finished.
+    assert len(intervals) == ntrials
+    assert max(start for start, _ in intervals) < min(end for _, end in intervals)
+
+
+def rflag_flags(vis, nprocs):
+    scheduler = TaskScheduler(nprocs=nprocs)
+    set_scheduler(scheduler)
+    try:
+        with scheduler:
+            run_rflag(
+                    vis,
+                    correlation="ABS_RR,LL",
+                    ntime="scan",
+                    combinescans=False,
+                    datacolumn="corrected",
+                    timedevscale=4.0,
+                    freqdevscale=4.0,
+                    extendflags=False,
+                    display="",
+            )
+    finally:
+        set_scheduler(None)
+    try:
+        tb.open(vis)
+        return tb.getcol("FLAG")
+    finally:
+        tb.close()
+
+
+def test_rflag_partitioned_matches_serial(tmp_path):
+    serial_ms = str(tmp_path / "serial.ms")
+    partitioned_ms = str(tmp_path / "partitioned.ms")
+    shutil.copytree(MS_NAME, serial_ms)
+    shutil.copytree(MS_NAME, partitioned_ms)
+    serial = rflag_flags(serial_ms, nprocs=1)
+    partitioned = rflag_flags(partitioned_ms, nprocs=2)
+    assert np.array_equal(serial, partitioned)